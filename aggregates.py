@@ -0,0 +1,132 @@
+import threading
+
+from storage import DEFAULT_CLASS_ID
+
+
+class AttendanceAggregates:
+    """
+    Dashboard counts kept up to date from store change events
+
+    Maintains enrollment counts per class, attendance counts per date and
+    attendance counts per class and date. Attendance is counted under the
+    person's current class, and only for people who are still enrolled, so
+    moving or removing an enrollment moves or drops its history. Each change
+    costs O(changed records) plus, for class moves and removals, the
+    length of the affected people's attendance history; reading the
+    aggregates costs O(output size).
+    """
+
+    def __init__(self, enrollment_store, attendance_log):
+        self.enrollment_store = enrollment_store
+        self.attendance_log = attendance_log
+        self._lock = threading.RLock()
+
+        self._person_class = {}       # Person id -> class id, for enrolled people
+        self._enrollment_counts = {}  # Class id -> number of enrollments
+        self._person_dates = {}       # Person id -> dates with a record (repeats kept)
+        self._date_counts = {}        # Date -> number of records
+        self._class_dates = {}        # Class id -> {date: number of records}
+
+        enrollment_store.subscribe(self._on_enrollments)
+        attendance_log.subscribe(self._on_attendance)
+
+    # Counting helpers
+
+    def _count_history(self, person_id, class_id, delta):
+        """Add delta for each of a person's attendance dates under class_id"""
+        dates = self._person_dates.get(person_id)
+        if not dates:
+            return
+        class_dates = self._class_dates.setdefault(class_id, {})
+        for date in dates:
+            count = class_dates.get(date, 0) + delta
+            if count:
+                class_dates[date] = count
+            else:
+                del class_dates[date]
+        if not class_dates:
+            del self._class_dates[class_id]
+
+    def _enroll(self, record):
+        person_id, class_id = record['id'], record.get('class_id', DEFAULT_CLASS_ID)
+        if person_id in self._person_class:
+            self._unenroll(person_id)
+        self._person_class[person_id] = class_id
+        self._enrollment_counts[class_id] = self._enrollment_counts.get(class_id, 0) + 1
+        self._count_history(person_id, class_id, 1)
+
+    def _unenroll(self, person_id):
+        class_id = self._person_class.pop(person_id, None)
+        if class_id is None:
+            return
+        self._enrollment_counts[class_id] -= 1
+        if not self._enrollment_counts[class_id]:
+            del self._enrollment_counts[class_id]
+        self._count_history(person_id, class_id, -1)
+
+    def _record(self, date, person_id):
+        self._date_counts[date] = self._date_counts.get(date, 0) + 1
+        self._person_dates.setdefault(person_id, []).append(date)
+        class_id = self._person_class.get(person_id)
+        if class_id is not None:
+            class_dates = self._class_dates.setdefault(class_id, {})
+            class_dates[date] = class_dates.get(date, 0) + 1
+
+    # Store listeners
+
+    def _on_enrollments(self, event, payload):
+        with self._lock:
+            if event == 'reload':
+                self._person_class = {}
+                self._enrollment_counts = {}
+                self._class_dates = {}
+                for record in payload:
+                    self._enroll(record)
+            elif event == 'add':
+                for record in payload:
+                    self._enroll(record)
+            elif event == 'remove':
+                for record in payload:
+                    self._unenroll(record['id'])
+            elif event == 'update':
+                for old, new in payload:
+                    self._unenroll(old['id'])
+                    self._enroll(new)
+
+    def _on_attendance(self, event, payload):
+        with self._lock:
+            if event == 'reload':
+                self._person_dates = {}
+                self._date_counts = {}
+                self._class_dates = {}
+                for date, records in payload.items():
+                    for record in records:
+                        self._record(date, record['id'])
+            elif event == 'mark':
+                for date, record in payload:
+                    self._record(date, record['id'])
+
+    # Accessors
+
+    def snapshot(self):
+        """
+        Return the current aggregates
+
+        Returns:
+            Dict with 'total_enrollments', 'enrollment_counts' ({class_id:
+            count}), 'attendance_by_date' ({date: count}) and
+            'attendance_by_class' ({class_id: {date: count}}), dates in
+            chronological order
+        """
+        # Pick up changes made by other processes first
+        self.enrollment_store.refresh()
+        self.attendance_log.refresh()
+
+        with self._lock:
+            return {
+                'total_enrollments': len(self._person_class),
+                'enrollment_counts': dict(self._enrollment_counts),
+                'attendance_by_date': dict(sorted(self._date_counts.items())),
+                'attendance_by_class': {class_id: dict(sorted(dates.items()))
+                                        for class_id, dates in self._class_dates.items()}
+            }
@@ -2,18 +2,31 @@ import os
 import logging
 import io
 import csv
+import zlib
+import re
 from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session, send_file, Response
 from werkzeug.utils import secure_filename
+import click
 import json
 import time
-import pandas as pd
+import uuid
+import threading
+import shutil
+import tempfile
+import zipfile
 from datetime import datetime
 import face_utils
-from fpdf import FPDF
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-import numpy as np
+import storage
+import binary_store
+import sql_store
+from caching import LRUCache
+from aggregates import AttendanceAggregates
+from presence import PresenceIndex
+import chat_query
+from attendance_query import AttendanceTable, encode_cursor, decode_cursor
+import reports
+import charts
+import bulk_import
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -29,55 +42,319 @@ ENROLLMENTS_FILE = 'enrollments.json'
 ATTENDANCE_FILE = 'attendance.json'
 CLASSES_FILE = 'classes.json'
 CHARTS_FOLDER = 'static/charts'
+REPORTS_FOLDER = os.environ.get('REPORTS_FOLDER', 'reports')
+
+# Enrollment storage: 'json' keeps everything in ENROLLMENTS_FILE, 'binary'
+# uses the template/metadata/thumbnail files in ENROLLMENTS_DIR (convert
+# with `python binary_store.py enrollments.json enrollments`)
+ENROLLMENT_FORMAT = os.environ.get('ENROLLMENT_FORMAT', 'json')
+ENROLLMENTS_DIR = os.environ.get('ENROLLMENTS_DIR', 'enrollments')
+
+# Storage backend: 'json' keeps the data in the files above, 'sqlite' keeps
+# classes, enrollments and attendance in the DATABASE_PATH database
+# (convert with `python sql_store.py attendance.db`)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'attendance.db')
+
+# Debugging aid: when set, recognition frames that are rejected (no face or
+# no match) are kept in this directory, up to REJECTED_FRAMES_LIMIT files
+REJECTED_FRAMES_FOLDER = os.environ.get('REJECTED_FRAMES_FOLDER')
+REJECTED_FRAMES_LIMIT = int(os.environ.get('REJECTED_FRAMES_LIMIT', '200'))
+
+# Most frames accepted by one /api/recognize/batch request
+MAX_BATCH_IMAGES = 32
+
+# Recognition requests are turned away with 429 and a Retry-After of
+# RECOGNITION_RETRY_AFTER seconds while this many frames are being
+# recognized by the process; kiosks back off and send lighter frames
+MAX_RECOGNITION_FRAMES = int(os.environ.get('MAX_RECOGNITION_FRAMES', '64'))
+RECOGNITION_RETRY_AFTER = int(os.environ.get('RECOGNITION_RETRY_AFTER', '2'))
+
+# Page size of /api/attendance when no limit is given, and the largest allowed
+ATTENDANCE_PAGE_SIZE = int(os.environ.get('ATTENDANCE_PAGE_SIZE', '100'))
+MAX_ATTENDANCE_PAGE_SIZE = int(os.environ.get('MAX_ATTENDANCE_PAGE_SIZE', '1000'))
+
+# Attendance rows materialized at a time while streaming a CSV export
+CSV_EXPORT_CHUNK_ROWS = int(os.environ.get('CSV_EXPORT_CHUNK_ROWS', '1000'))
+
+# PDF reports are rendered by this many worker processes and the most
+# recent REPORT_CACHE_SIZE are kept in REPORTS_FOLDER
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2'))
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', '100'))
+REPORT_ID_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# Worker processes encoding the photos of a bulk enrollment import; one
+# per core if 0
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', '0'))
+
+# Finished imports can be polled for IMPORT_JOB_TTL seconds; only the most
+# recent MAX_IMPORT_JOBS are kept
+IMPORT_JOB_TTL = int(os.environ.get('IMPORT_JOB_TTL', '3600'))
+MAX_IMPORT_JOBS = int(os.environ.get('MAX_IMPORT_JOBS', '20'))
+
+# Recognition results for recently seen frames
+RECOGNITION_CACHE_SIZE = int(os.environ.get('RECOGNITION_CACHE_SIZE', '1024'))
+RECOGNITION_CACHE_TTL = int(os.environ.get('RECOGNITION_CACHE_TTL', '300'))
+
+# Chatbot answers for recently asked questions
+CHATBOT_CACHE_SIZE = int(os.environ.get('CHATBOT_CACHE_SIZE', '256'))
 
 # Create necessary directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CHARTS_FOLDER, exist_ok=True)
 
-# Initialize face enrollments if file doesn't exist
-if not os.path.exists(ENROLLMENTS_FILE):
-    with open(ENROLLMENTS_FILE, 'w') as f:
-        json.dump([], f)
+if STORAGE_BACKEND == 'sqlite':
+    # The stores share one database; counts and listings are indexed queries
+    database = sql_store.Database(DATABASE_PATH)
+    enrollment_store = sql_store.SQLiteEnrollmentStore(database)
+    attendance_log = sql_store.SQLiteAttendanceLog(database)
+    class_store = sql_store.SQLiteClassStore(database)
+    analytics_aggregates = sql_store.SQLiteAggregates(database)
+    attendance_table = sql_store.SQLiteAttendanceTable(database)
+    presence_index = sql_store.SQLitePresence(database)
 else:
-    # Check if we need to update existing enrollments to the new format
-    try:
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            
-        updated = False
-        
-        # Check each enrollment for the new features format
-        for enrollment in enrollments:
-            if 'encoding' in enrollment and 'features' not in enrollment['encoding'] and 'image_path' in enrollment:
-                # This enrollment needs to be updated to the new format
+    # Initialize face enrollments if file doesn't exist; enrollments saved in
+    # the old encoding format are upgraded with `flask --app main upgrade-encodings`
+    if not os.path.exists(ENROLLMENTS_FILE):
+        storage.write_json_atomic(ENROLLMENTS_FILE, [])
+
+    # Initialize attendance records if file doesn't exist
+    if not os.path.exists(ATTENDANCE_FILE):
+        storage.write_json_atomic(ATTENDANCE_FILE, {})
+
+    # Initialize classes with a default class if file doesn't exist
+    if not os.path.exists(CLASSES_FILE):
+        storage.write_json_atomic(CLASSES_FILE, [storage.default_class()])
+
+    # Enrollments and attendance are loaded once per process and shared by all routes
+    if ENROLLMENT_FORMAT == 'binary':
+        enrollment_store = binary_store.BinaryEnrollmentStore(ENROLLMENTS_DIR)
+    else:
+        enrollment_store = storage.EnrollmentStore(ENROLLMENTS_FILE)
+    attendance_log = storage.AttendanceLog(ATTENDANCE_FILE)
+    class_store = storage.ClassStore(CLASSES_FILE)
+
+    # Dashboard counts, updated as the stores change rather than recomputed
+    analytics_aggregates = AttendanceAggregates(enrollment_store, attendance_log)
+
+    # Columnar copy of the attendance for the record listings and exports
+    attendance_table = AttendanceTable(attendance_log, enrollment_store)
+
+    # Who was present on each day, as bitsets, for the chatbot
+    presence_index = PresenceIndex(enrollment_store, attendance_log)
+
+# Background PDF rendering, shared by the export routes
+report_jobs = reports.ReportJobs(REPORTS_FOLDER, workers=REPORT_WORKERS, max_files=REPORT_CACHE_SIZE)
+
+# Bulk enrollment imports started by this process, by job id
+import_jobs = bulk_import.ImportJobs(ttl=IMPORT_JOB_TTL, max_finished=MAX_IMPORT_JOBS)
+
+# Match results keyed by (frame hash, class filter, enrollment version), so
+# repeated frames skip extraction and matching. Entries stop being reachable
+# as soon as the enrollments change, in this process or another.
+recognition_cache = LRUCache(maxsize=RECOGNITION_CACHE_SIZE, ttl=RECOGNITION_CACHE_TTL)
+
+# Chatbot answers keyed by (parsed question, data version); see query_attendance
+chatbot_cache = LRUCache(maxsize=CHATBOT_CACHE_SIZE)
+
+@app.cli.command('upgrade-encodings')
+def upgrade_encodings_command():
+    """Re-extract the encodings of enrollments saved in the old format."""
+    if ENROLLMENT_FORMAT != 'json' or STORAGE_BACKEND != 'json':
+        raise click.ClickException("Upgrade the encodings in enrollments.json before converting it")
+    
+    encodings = {}
+    for enrollment in enrollment_store.all():
+        # Enrollments without the features format need their image re-processed
+        if 'encoding' in enrollment and 'features' not in enrollment['encoding'] and 'image_path' in enrollment:
+            if os.path.exists(enrollment['image_path']):
                 logger.info(f"Updating enrollment for {enrollment['name']}")
-                
-                # Re-process the image to get the new encoding format
-                if os.path.exists(enrollment['image_path']):
-                    new_encoding = face_utils.extract_face_encoding(enrollment['image_path'])
-                    if new_encoding:
-                        enrollment['encoding'] = new_encoding
-                        updated = True
-        
-        # Save updated enrollments if any were changed
-        if updated:
-            logger.info("Saving updated enrollments with new feature format")
-            with open(ENROLLMENTS_FILE, 'w') as f:
-                json.dump(enrollments, f)
-                
+                new_encoding = face_utils.extract_face_encoding(enrollment['image_path'])
+                if new_encoding:
+                    encodings[enrollment['id']] = new_encoding
+            else:
+                logger.warning(f"Image of enrollment {enrollment['id']} not found, leaving it as is")
+    
+    count = enrollment_store.update_encodings(encodings)
+    click.echo(f"Upgraded {count} enrollments to the new encoding format")
+
+@app.cli.command('import-enrollments')
+@click.argument('photos', type=click.Path(exists=True))
+@click.argument('roster', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', type=int, default=None, help='Worker processes, one per core by default')
+def import_enrollments_command(photos, roster, workers):
+    """Enroll everyone on a CSV roster from a directory or zip of photos."""
+    try:
+        rows = bulk_import.read_roster(roster)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    started = time.perf_counter()
+    def progress(done, total):
+        click.echo(f"Encoded {done}/{total} photos ({done / (time.perf_counter() - started):.0f}/s)")
+    
+    result = bulk_import.import_enrollments(enrollment_store, class_store.all(), photos, rows, UPLOAD_FOLDER,
+                                            workers=workers, progress=progress)
+    for failure in result['failed']:
+        click.echo(f"Skipped {failure['image']} ({failure['name']}): {failure['error']}")
+    click.echo(f"Enrolled {result['enrolled']} of {result['total']} in {result['seconds']:.1f}s "
+               f"({result['photos_per_second']:.0f} photos/s)")
+
+def expected_version():
+    """
+    Return the data version a change request is based on, from an If-Match
+    header or a 'version' field, or None to apply the change regardless
+    """
+    if request.if_match and not request.if_match.star_tag:
+        return next(iter(request.if_match), None)
+    return request.form.get('version') or None
+
+def version_conflict_response(name):
+    return jsonify({
+        'success': False,
+        'error': f'The {name} were changed by someone else. Please reload and try again.'
+    }), 409
+
+def spool_rejected_frame(image_file, reason):
+    """Keep a copy of a rejected recognition frame if REJECTED_FRAMES_FOLDER is set"""
+    if not REJECTED_FRAMES_FOLDER:
+        return
+    
+    try:
+        os.makedirs(REJECTED_FRAMES_FOLDER, exist_ok=True)
+        filename = f"{reason}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+        image_file.stream.seek(0)
+        image_file.save(os.path.join(REJECTED_FRAMES_FOLDER, filename))
+        
+        # Drop the oldest frames beyond the limit
+        frames = sorted(os.scandir(REJECTED_FRAMES_FOLDER), key=lambda entry: entry.stat().st_mtime)
+        for entry in frames[:max(len(frames) - REJECTED_FRAMES_LIMIT, 0)]:
+            os.remove(entry.path)
     except Exception as e:
-        logger.exception("Error updating enrollments to new format")
+        logger.warning(f"Could not keep rejected frame: {e}")
+
+# Frames being recognized by this process, see reserve_recognition
+recognition_load = {'frames': 0}
+recognition_load_lock = threading.Lock()
+
+def reserve_recognition(count):
+    """
+    Count frames as being recognized, unless the process is at MAX_RECOGNITION_FRAMES
+    
+    A request is always admitted when nothing else is being recognized,
+    whatever its size. Frames reserved must be released with
+    release_recognition.
+    
+    Returns:
+        Whether the frames were reserved
+    """
+    with recognition_load_lock:
+        if recognition_load['frames'] and recognition_load['frames'] + count > MAX_RECOGNITION_FRAMES:
+            return False
+        recognition_load['frames'] += count
+        return True
+
+def release_recognition(count):
+    with recognition_load_lock:
+        recognition_load['frames'] -= count
 
-# Initialize attendance records if file doesn't exist
-if not os.path.exists(ATTENDANCE_FILE):
-    with open(ATTENDANCE_FILE, 'w') as f:
-        json.dump({}, f)
+def recognition_busy_response():
+    """Ask a kiosk to retry a recognition request later"""
+    response = jsonify({
+        'success': False,
+        'error': 'The server is busy, please try again shortly',
+        'retry_after': RECOGNITION_RETRY_AFTER
+    })
+    response.headers['Retry-After'] = str(RECOGNITION_RETRY_AFTER)
+    return response, 429
+
+def cached_frames(frame_hashes, class_id):
+    """
+    Answer recognition frames from the cache, by their face_utils.hash_image
+    
+    Returns:
+        List with (matched enrollment or None, whether a face was found) for
+        each cached frame and None for the others
+    """
+    # Pick up enrollments added or removed by other processes, which change the version
+    enrollment_store.refresh()
+    version = enrollment_store.version
+    results = []
+    for frame_hash in frame_hashes:
+        cached = recognition_cache.get((frame_hash, class_id, version))
+        if cached is not None:
+            match_id, has_face = cached
+            cached = (enrollment_store.get(match_id) if match_id else None, has_face)
+        results.append(cached)
+    return results
+
+def match_encodings(face_encodings, class_id, frame_hashes):
+    """
+    Match extracted face encodings and cache the results for cached_frames
+    
+    Args:
+        face_encodings: Encodings of the frames, None for frames without a face
+        class_id: Only match enrollments in this class
+        frame_hashes: face_utils.hash_image of each frame
+    
+    Returns:
+        List with the matched enrollment or None for each encoding
+    """
+    # Read the version first, so a result is never cached under a newer one
+    enrollment_store.refresh()
+    version = enrollment_store.version
+    face_index = enrollment_store.face_index()
+    matches = face_utils.find_matching_faces(face_encodings, face_index, class_id=class_id)
+    for frame_hash, face_encoding, match in zip(frame_hashes, face_encodings, matches):
+        recognition_cache.put((frame_hash, class_id, version), (match['id'] if match else None, face_encoding is not None))
+    return matches
+
+def match_frames(image_files, class_id):
+    """
+    Extract and match recognition frames, answering repeated frames from the cache
+    
+    Returns:
+        List of (matched enrollment or None, whether a face was found) per frame
+    """
+    frame_hashes = [face_utils.hash_image(image_file.stream) for image_file in image_files]
+    results = cached_frames(frame_hashes, class_id)
+    
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        face_encodings = [face_utils.extract_face_encoding(image_files[i].stream) for i in misses]
+        matches = match_encodings(face_encodings, class_id, [frame_hashes[i] for i in misses])
+        for i, face_encoding, match in zip(misses, face_encodings, matches):
+            results[i] = (match, face_encoding is not None)
+    
+    return results
+
+def mark_matches(matches):
+    """
+    Record attendance for the matched people with a single write
+    
+    Returns:
+        List with, for each match, whether it added a new attendance record
+        (None where there was no match)
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    current_time = datetime.now().strftime('%H:%M:%S')
+    new_attendance = iter(attendance_log.mark_many(
+        (match['id'], today, current_time, match.get('class_id', 'default')) for match in matches if match
+    ))
+    return [next(new_attendance) if match else None for match in matches]
 
-# Initialize classes if file doesn't exist
-if not os.path.exists(CLASSES_FILE):
-    with open(CLASSES_FILE, 'w') as f:
-        # Create a default class
-        json.dump([{"id": "default", "name": "Default Class", "created_at": datetime.now().isoformat()}], f)
+def recognition_result(match, new_attendance):
+    """Describe a recognized person for the recognition endpoints"""
+    result = {
+        'recognized': True,
+        'id': match['id'],
+        'name': match['name'],
+        'class_id': match.get('class_id', 'default'),
+        'newAttendance': new_attendance
+    }
+    if not new_attendance:
+        result['message'] = 'Attendance already recorded for today'
+    return result
 
 # Routes
 @app.route('/')
@@ -94,53 +371,8 @@ def attendance():
 
 @app.route('/records')
 def records():
-    # Load attendance records
-    try:
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        attendance_data = {}
-    
-    # Load enrollment data to map IDs to names and classes
-    try:
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            # Create dictionaries mapping ID to name and class
-            id_to_info = {entry['id']: {'name': entry['name'], 'class_id': entry.get('class_id', 'default')} 
-                         for entry in enrollments}
-    except (FileNotFoundError, json.JSONDecodeError):
-        enrollments = []
-        id_to_info = {}
-    
-    # Load classes for class name lookup
-    try:
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-    except (FileNotFoundError, json.JSONDecodeError):
-        class_names = {'default': 'Default Class'}
-    
-    # Process attendance records for display
-    formatted_records = []
-    for date, records in attendance_data.items():
-        for record in records:
-            person_id = record['id']
-            person_info = id_to_info.get(person_id, {'name': f"Unknown ({person_id})", 'class_id': 'default'})
-            class_id = record.get('class_id', person_info['class_id'])
-            
-            formatted_records.append({
-                'name': person_info['name'],
-                'id': person_id,
-                'class_id': class_id,
-                'class_name': class_names.get(class_id, 'Default Class'),
-                'date': date,
-                'time': record['time']
-            })
-    
-    # Sort records by date and time (newest first)
-    formatted_records.sort(key=lambda x: (x['date'], x['time']), reverse=True)
-    
-    return render_template('records.html', records=formatted_records)
+    # The records are fetched page by page from /api/attendance
+    return render_template('records.html')
 
 @app.route('/api/enroll', methods=['POST'])
 def enroll_face():
@@ -171,26 +403,12 @@ def enroll_face():
             os.remove(filepath)  # Clean up the temporary file
             return jsonify({'success': False, 'error': 'No face detected in the image'}), 400
         
-        # Load existing enrollments
-        try:
-            with open(ENROLLMENTS_FILE, 'r') as f:
-                enrollments = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            enrollments = []
-        
         # Validate class_id exists
-        try:
-            with open(CLASSES_FILE, 'r') as f:
-                classes = json.load(f)
-                class_exists = any(c['id'] == class_id for c in classes)
-                
-                if not class_exists:
-                    class_id = 'default'  # Fallback to default if class doesn't exist
-        except (FileNotFoundError, json.JSONDecodeError):
-            class_id = 'default'  # Fallback to default
+        if class_store.get(class_id) is None:
+            class_id = 'default'  # Fallback to default if class doesn't exist
         
-        # Add new enrollment
-        enrollments.append({
+        # Add new enrollment and save
+        enrollment_store.add({
             'id': person_id,
             'name': name,
             'class_id': class_id,
@@ -199,16 +417,49 @@ def enroll_face():
             'enrolled_at': datetime.now().isoformat()
         })
         
-        # Save updated enrollments
-        with open(ENROLLMENTS_FILE, 'w') as f:
-            json.dump(enrollments, f)
-        
         return jsonify({'success': True, 'id': person_id, 'name': name, 'class_id': class_id})
     
     except Exception as e:
         logger.exception("Error in face enrollment")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/enroll/bulk', methods=['POST'])
+def bulk_enroll():
+    try:
+        # A zip of photos and the CSV roster naming the person in each
+        if 'photos' not in request.files or 'roster' not in request.files:
+            return jsonify({'success': False, 'error': 'A zip file of photos and a CSV roster are required'}), 400
+        
+        directory = tempfile.mkdtemp(prefix='import-')
+        try:
+            photos_path = os.path.join(directory, 'photos.zip')
+            roster_path = os.path.join(directory, 'roster.csv')
+            request.files['photos'].save(photos_path)
+            request.files['roster'].save(roster_path)
+            if not zipfile.is_zipfile(photos_path):
+                raise ValueError('The photos must be a zip file')
+            rows = bulk_import.read_roster(roster_path)
+        except ValueError as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # The photos are encoded in the background; poll the job for progress
+        job = bulk_import.ImportJob(enrollment_store, class_store.all(), photos_path, rows, UPLOAD_FOLDER,
+                                    workers=IMPORT_WORKERS, cleanup=lambda: shutil.rmtree(directory, ignore_errors=True))
+        import_jobs.start(job)
+        return jsonify(dict({'success': True, 'job_id': job.id}, **job.status())), 202
+    
+    except Exception as e:
+        logger.exception("Error starting bulk enrollment")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/enroll/bulk/<job_id>', methods=['GET'])
+def bulk_enroll_status(job_id):
+    job = import_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown import job'}), 404
+    return jsonify(dict({'success': True, 'job_id': job_id}, **job.status()))
+
 @app.route('/api/recognize', methods=['POST'])
 def recognize_face():
     try:
@@ -217,112 +468,95 @@ def recognize_face():
             return jsonify({'success': False, 'error': 'No image file provided'}), 400
         
         image_file = request.files['image']
-        class_id = request.form.get('class_id', None)  # Optional class filter
-        
-        # Save the image temporarily
-        filename = secure_filename(f"recognize_{int(time.time())}.jpg")
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        image_file.save(filepath)
-        
-        # Extract face encoding
-        face_encoding = face_utils.extract_face_encoding(filepath)
-        
-        if face_encoding is None:
-            os.remove(filepath)  # Clean up the temporary file
-            return jsonify({'success': False, 'error': 'No face detected in the image'}), 400
+        class_id = request.form.get('class_id') or None  # Optional class filter; '' means none
         
-        # Load existing enrollments
+        # Extract and match straight from the upload, without a temporary file
+        if not reserve_recognition(1):
+            return recognition_busy_response()
         try:
-            with open(ENROLLMENTS_FILE, 'r') as f:
-                enrollments = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            enrollments = []
+            match, has_face = match_frames([image_file], class_id)[0]
+        finally:
+            release_recognition(1)
         
-        # Filter enrollments by class_id if specified
-        if class_id:
-            filtered_enrollments = [e for e in enrollments if e.get('class_id', 'default') == class_id]
-        else:
-            filtered_enrollments = enrollments
-        
-        # Find matching face
-        match = face_utils.find_matching_face(face_encoding, filtered_enrollments)
-        
-        # Clean up the temporary file
-        os.remove(filepath)
+        if not has_face:
+            spool_rejected_frame(image_file, 'noface')
+            return jsonify({'success': False, 'error': 'No face detected in the image'}), 400
         
         if match:
-            # Record attendance
+            # Record attendance unless the person was already marked today
             today = datetime.now().strftime('%Y-%m-%d')
             current_time = datetime.now().strftime('%H:%M:%S')
             
-            try:
-                with open(ATTENDANCE_FILE, 'r') as f:
-                    attendance_data = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                attendance_data = {}
-            
-            # Initialize the date entry if it doesn't exist
-            if today not in attendance_data:
-                attendance_data[today] = []
-            
-            # Check if person has already been marked for today
-            person_already_marked = any(
-                record['id'] == match['id'] for record in attendance_data[today]
+            new_attendance = attendance_log.mark(
+                match['id'], today, current_time, class_id=match.get('class_id', 'default')
             )
             
-            if not person_already_marked:
-                # Add attendance record with class info
-                attendance_data[today].append({
-                    'id': match['id'],
-                    'time': current_time,
-                    'class_id': match.get('class_id', 'default')
-                })
-                
-                # Save updated attendance data
-                with open(ATTENDANCE_FILE, 'w') as f:
-                    json.dump(attendance_data, f)
-                
-                return jsonify({
-                    'success': True, 
-                    'recognized': True,
-                    'id': match['id'],
-                    'name': match['name'],
-                    'class_id': match.get('class_id', 'default'),
-                    'newAttendance': True
-                })
-            else:
-                return jsonify({
-                    'success': True, 
-                    'recognized': True,
-                    'id': match['id'],
-                    'name': match['name'],
-                    'class_id': match.get('class_id', 'default'),
-                    'newAttendance': False,
-                    'message': 'Attendance already recorded for today'
-                })
+            return jsonify(dict({'success': True}, **recognition_result(match, new_attendance)))
         else:
+            spool_rejected_frame(image_file, 'nomatch')
             return jsonify({'success': True, 'recognized': False})
     
     except Exception as e:
         logger.exception("Error in face recognition")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/recognize/batch', methods=['POST'])
+def recognize_faces_batch():
+    try:
+        # Accept several frames as repeated 'images' (or 'image') fields
+        image_files = request.files.getlist('images') or request.files.getlist('image')
+        if not image_files:
+            return jsonify({'success': False, 'error': 'No image files provided'}), 400
+        if len(image_files) > MAX_BATCH_IMAGES:
+            return jsonify({'success': False, 'error': f'At most {MAX_BATCH_IMAGES} images per batch'}), 400
+        
+        class_id = request.form.get('class_id') or None  # Optional class filter; '' means none
+        
+        # Match all frames in one pass over the enrollments
+        if not reserve_recognition(len(image_files)):
+            return recognition_busy_response()
+        try:
+            frames = match_frames(image_files, class_id)
+        finally:
+            release_recognition(len(image_files))
+        
+        # Record all attendance with a single write
+        new_attendance = mark_matches([match for match, has_face in frames])
+        
+        results = []
+        for image_file, (match, has_face), is_new in zip(image_files, frames, new_attendance):
+            if not has_face:
+                spool_rejected_frame(image_file, 'noface')
+                results.append({'recognized': False, 'error': 'No face detected in the image'})
+            elif match:
+                results.append(recognition_result(match, is_new))
+            else:
+                spool_rejected_frame(image_file, 'nomatch')
+                results.append({'recognized': False})
+        
+        return jsonify({'success': True, 'results': results})
+    
+    except Exception as e:
+        logger.exception("Error in batch face recognition")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/recognize/cache', methods=['GET'])
+def recognition_cache_stats():
+    return jsonify({'success': True, 'cache': recognition_cache.stats()})
+
 @app.route('/api/get_enrollments', methods=['GET'])
 def get_enrollments():
     try:
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-        
         # Optional class filter
         class_id = request.args.get('class_id', None)
+        if class_id:
+            enrollments = enrollment_store.for_class(class_id)
+        else:
+            enrollments = enrollment_store.all()
         
         # Return only non-sensitive data
         simplified_enrollments = []
         for enrollment in enrollments:
-            # Filter by class if requested
-            if class_id and enrollment.get('class_id', 'default') != class_id:
-                continue
-                
             simplified_enrollments.append({
                 'id': enrollment['id'],
                 'name': enrollment['name'],
@@ -330,10 +564,9 @@ def get_enrollments():
                 'enrolled_at': enrollment['enrolled_at']
             })
         
-        return jsonify({'success': True, 'enrollments': simplified_enrollments})
+        return jsonify({'success': True, 'enrollments': simplified_enrollments,
+                        'version': enrollment_store.version_tag()})
     
-    except (FileNotFoundError, json.JSONDecodeError):
-        return jsonify({'success': True, 'enrollments': []})
     except Exception as e:
         logger.exception("Error getting enrollments")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -341,37 +574,24 @@ def get_enrollments():
 @app.route('/api/enrollments/<enrollment_id>', methods=['DELETE'])
 def delete_enrollment(enrollment_id):
     try:
-        # Load enrollments
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-        
-        # Find the enrollment to delete
-        enrollment_index = None
-        for i, enrollment in enumerate(enrollments):
-            if enrollment['id'] == enrollment_id:
-                enrollment_index = i
-                break
+        # Remove the enrollment and save; of concurrent deletes only one
+        # finds it
+        deleted_enrollment = enrollment_store.remove(enrollment_id, expected_version=expected_version())
         
-        if enrollment_index is None:
+        if deleted_enrollment is None:
             return jsonify({'success': False, 'error': 'Enrollment not found'}), 404
         
         # Remove the enrollment image if it exists
-        deleted_enrollment = enrollments[enrollment_index]
         if 'image_path' in deleted_enrollment and os.path.exists(deleted_enrollment['image_path']):
             try:
                 os.remove(deleted_enrollment['image_path'])
             except Exception as e:
                 logger.warning(f"Could not delete enrollment image: {e}")
         
-        # Remove the enrollment
-        enrollments.pop(enrollment_index)
-        
-        # Save updated enrollments
-        with open(ENROLLMENTS_FILE, 'w') as f:
-            json.dump(enrollments, f)
-        
         return jsonify({'success': True, 'message': 'Enrollment deleted successfully'})
     
+    except storage.VersionConflict:
+        return version_conflict_response('enrollments')
     except Exception as e:
         logger.exception("Error deleting enrollment")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -387,14 +607,13 @@ def analytics():
 @app.route('/api/classes', methods=['GET'])
 def get_classes():
     try:
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-        return jsonify({'success': True, 'classes': classes})
+        # The version can be sent back in an If-Match header so that a
+        # change is refused if the classes were changed meanwhile
+        classes = class_store.all()
+        response = jsonify({'success': True, 'classes': classes, 'version': class_store.version_tag()})
+        response.headers['ETag'] = f'"{class_store.version_tag()}"'
+        return response
     
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Return default class if file doesn't exist
-        default_class = [{"id": "default", "name": "Default Class", "created_at": datetime.now().isoformat()}]
-        return jsonify({'success': True, 'classes': default_class})
     except Exception as e:
         logger.exception("Error getting classes")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -407,29 +626,13 @@ def create_class():
         if not name:
             return jsonify({'success': False, 'error': 'Class name is required'}), 400
         
-        # Generate a unique ID for the class
-        class_id = f"class_{int(time.time())}"
-        
-        # Load existing classes
-        try:
-            with open(CLASSES_FILE, 'r') as f:
-                classes = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            classes = [{"id": "default", "name": "Default Class", "created_at": datetime.now().isoformat()}]
-        
-        # Add new class
-        classes.append({
-            'id': class_id,
-            'name': name,
-            'created_at': datetime.now().isoformat()
-        })
-        
-        # Save updated classes
-        with open(CLASSES_FILE, 'w') as f:
-            json.dump(classes, f)
+        # Add the class with a unique id and save
+        new_class = class_store.add(name, expected_version=expected_version())
         
-        return jsonify({'success': True, 'id': class_id, 'name': name})
+        return jsonify({'success': True, 'id': new_class['id'], 'name': name})
     
+    except storage.VersionConflict:
+        return version_conflict_response('classes')
     except Exception as e:
         logger.exception("Error creating class")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -441,47 +644,20 @@ def delete_class(class_id):
         if class_id == 'default':
             return jsonify({'success': False, 'error': 'Cannot delete the default class'}), 400
         
-        # Load classes
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-        
-        # Find the class to delete
-        class_index = None
-        for i, cls in enumerate(classes):
-            if cls['id'] == class_id:
-                class_index = i
-                break
-        
-        if class_index is None:
+        # Remove the class and save
+        if class_store.remove(class_id, expected_version=expected_version()) is None:
             return jsonify({'success': False, 'error': 'Class not found'}), 404
         
-        # Remove the class
-        classes.pop(class_index)
-        
-        # Save updated classes
-        with open(CLASSES_FILE, 'w') as f:
-            json.dump(classes, f)
-        
-        # Update all enrollments that were in this class to be in the default class
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-        
-        # Count how many enrollments were updated
-        updated_count = 0
-        for enrollment in enrollments:
-            if enrollment.get('class_id') == class_id:
-                enrollment['class_id'] = 'default'
-                updated_count += 1
-        
-        # Save updated enrollments
-        with open(ENROLLMENTS_FILE, 'w') as f:
-            json.dump(enrollments, f)
+        # Move all enrollments that were in this class to the default class
+        updated_count = enrollment_store.reassign_class(class_id, 'default')
         
         return jsonify({
             'success': True, 
             'message': f'Class deleted successfully. {updated_count} enrollments moved to Default Class.'
         })
     
+    except storage.VersionConflict:
+        return version_conflict_response('classes')
     except Exception as e:
         logger.exception("Error deleting class")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -491,49 +667,42 @@ def get_attendance():
     try:
         # Optional filters
         date = request.args.get('date', None)
-        class_id = request.args.get('class_id', None)
-        
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Load enrollments for name lookup
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            id_to_info = {e['id']: {'name': e['name'], 'class_id': e.get('class_id', 'default')} for e in enrollments}
-        
-        # Filter by date if specified
-        if date and date in attendance_data:
-            filtered_data = {date: attendance_data[date]}
-        else:
-            filtered_data = attendance_data
-        
-        # Process and format data
-        formatted_records = []
-        for curr_date, records in filtered_data.items():
-            for record in records:
-                person_id = record['id']
-                person_info = id_to_info.get(person_id, {'name': f"Unknown ({person_id})", 'class_id': 'default'})
-                
-                # Filter by class if requested
-                if class_id and person_info['class_id'] != class_id:
-                    continue
-                    
-                formatted_records.append({
-                    'id': person_id,
-                    'name': person_info['name'],
-                    'class_id': record.get('class_id', person_info['class_id']),  # Use record's class_id if available
-                    'date': curr_date,
-                    'time': record['time']
-                })
-        
-        # Sort by date and time (newest first)
-        formatted_records.sort(key=lambda x: (x['date'], x['time']), reverse=True)
-        
-        return jsonify({'success': True, 'records': formatted_records})
-    
+        class_id = request.args.get('class_id', None)  # Person's current class
+        record_class_id = request.args.get('record_class_id', None)  # Class shown in the record
+        date_from = request.args.get('from', None)
+        date_to = request.args.get('to', None)
+
+        # Pagination: at most `limit` records per response, continuing after
+        # the record `cursor` points to (the previous response's next_cursor)
+        try:
+            limit = int(request.args.get('limit', ATTENDANCE_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'limit must be an integer'}), 400
+        if not 1 <= limit <= MAX_ATTENDANCE_PAGE_SIZE:
+            return jsonify({'success': False, 'error': f'limit must be between 1 and {MAX_ATTENDANCE_PAGE_SIZE}'}), 400
+
+        cursor = request.args.get('cursor')
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        # Records sorted by date, time and id (newest first); class_id filters on
+        # the person's current class, as the CSV export does, and
+        # record_class_id on each record's own class, as the records page shows it
+        formatted_records, total, next_key = attendance_table.page(
+            date=date, class_id=class_id, date_from=date_from, date_to=date_to, after=after, limit=limit,
+            record_class_id=record_class_id)
+
+        return jsonify({
+            'success': True,
+            'records': formatted_records,
+            'total': total,
+            'next_cursor': encode_cursor(next_key) if next_key else None
+        })
+
     except (FileNotFoundError, json.JSONDecodeError):
-        return jsonify({'success': True, 'records': []})
+        return jsonify({'success': True, 'records': [], 'total': 0, 'next_cursor': None})
     except Exception as e:
         logger.exception("Error getting attendance records")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -541,65 +710,26 @@ def get_attendance():
 @app.route('/api/analytics', methods=['GET'])
 def get_analytics():
     try:
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Load enrollments for name lookup
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
+        # Counts maintained incrementally by the stores' change events
+        aggregates = analytics_aggregates.snapshot()
             
         # Load classes
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-        
-        # Calculate statistics
-        total_enrollments = len(enrollments)
-        class_counts = {}
-        
-        # Count enrollments by class
-        for enrollment in enrollments:
-            class_id = enrollment.get('class_id', 'default')
-            if class_id not in class_counts:
-                class_counts[class_id] = 0
-            class_counts[class_id] += 1
-        
-        # Count attendance by date
-        attendance_by_date = {}
-        for date, records in attendance_data.items():
-            attendance_by_date[date] = len(records)
-        
-        # Calculate attendance by class
-        attendance_by_class = {}
-        for date, records in attendance_data.items():
-            for record in records:
-                person_id = record['id']
-                # Find the person's class
-                for enrollment in enrollments:
-                    if enrollment['id'] == person_id:
-                        class_id = enrollment.get('class_id', 'default')
-                        if class_id not in attendance_by_class:
-                            attendance_by_class[class_id] = {}
-                        if date not in attendance_by_class[class_id]:
-                            attendance_by_class[class_id][date] = 0
-                        attendance_by_class[class_id][date] += 1
-                        break
+        class_names = class_store.names()
         
         # Format analytics data
         analytics = {
-            'total_enrollments': total_enrollments,
+            'total_enrollments': aggregates['total_enrollments'],
             'classes': [{
                 'id': class_id,
                 'name': class_names.get(class_id, 'Unknown Class'),
                 'enrollment_count': count
-            } for class_id, count in class_counts.items()],
-            'attendance_by_date': [{'date': date, 'count': count} for date, count in attendance_by_date.items()],
+            } for class_id, count in aggregates['enrollment_counts'].items()],
+            'attendance_by_date': [{'date': date, 'count': count} for date, count in aggregates['attendance_by_date'].items()],
             'attendance_by_class': [{
                 'class_id': class_id,
                 'class_name': class_names.get(class_id, 'Unknown Class'),
                 'attendance': [{'date': date, 'count': count} for date, count in dates.items()]
-            } for class_id, dates in attendance_by_class.items()]
+            } for class_id, dates in aggregates['attendance_by_class'].items()]
         }
         
         # Create and save charts
@@ -617,58 +747,67 @@ def export_attendance_csv():
         # Optional filters
         date = request.args.get('date', None)
         class_id = request.args.get('class_id', None)
+        date_from = request.args.get('from', None)
+        date_to = request.args.get('to', None)
+        compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+        
+        # Class names for lookup
+        class_names = class_store.names()
+        
+        # Records in the order they were taken, a chunk at a time
+        chunks = attendance_table.iter_query(date=date, class_id=class_id, date_from=date_from, date_to=date_to,
+                                             newest_first=False, chunk_size=CSV_EXPORT_CHUNK_ROWS)
+        
+        def generate_csv():
+            # Each chunk of rows is written to a small buffer, emitted and cleared
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['Name', 'ID', 'Class', 'Date', 'Time'])
+            
+            for records in chunks:
+                for record in records:
+                    writer.writerow([
+                        record['name'],
+                        record['id'],
+                        class_names.get(record['class_id'], 'Unknown Class'),
+                        record['date'],
+                        record['time']
+                    ])
+                yield output.getvalue().encode('utf-8')
+                output.seek(0)
+                output.truncate()
+            
+            if output.tell():
+                yield output.getvalue().encode('utf-8')
+        
+        def generate_gzip(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            for block in data:
+                compressed = compressor.compress(block)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
+        
+        def log_errors(data):
+            # Headers are already sent once streaming starts, so errors can
+            # only cut the download short
+            try:
+                yield from data
+            except Exception:
+                logger.exception("Error streaming attendance CSV")
+                raise
         
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Load enrollments for name lookup
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            id_to_info = {e['id']: {'name': e['name'], 'class_id': e.get('class_id', 'default')} for e in enrollments}
-        
-        # Load classes for class name lookup
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-        
-        # Filter by date if specified
-        if date and date in attendance_data:
-            filtered_data = {date: attendance_data[date]}
-        else:
-            filtered_data = attendance_data
-        
-        # Create a CSV string
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['Name', 'ID', 'Class', 'Date', 'Time'])
-        
-        for curr_date, records in filtered_data.items():
-            for record in records:
-                person_id = record['id']
-                person_info = id_to_info.get(person_id, {'name': f"Unknown ({person_id})", 'class_id': 'default'})
-                
-                # Filter by class if requested
-                if class_id and person_info['class_id'] != class_id:
-                    continue
-                
-                record_class_id = record.get('class_id', person_info['class_id'])
-                class_name = class_names.get(record_class_id, 'Unknown Class')
-                
-                writer.writerow([
-                    person_info['name'],
-                    person_id,
-                    class_name,
-                    curr_date,
-                    record['time']
-                ])
-        
-        # Create response with CSV
-        output.seek(0)
+        # Stream the CSV as it is produced, optionally gzip-compressed
         filename = f"attendance_{datetime.now().strftime('%Y%m%d')}.csv"
+        body = generate_csv()
+        mimetype = "text/csv"
+        if compress:
+            body = generate_gzip(body)
+            filename += '.gz'
+            mimetype = "application/gzip"
         return Response(
-            output,
-            mimetype="text/csv",
+            log_errors(body),
+            mimetype=mimetype,
             headers={"Content-Disposition": f"attachment;filename={filename}"}
         )
     
@@ -677,452 +816,254 @@ def export_attendance_csv():
         flash('Error exporting data. Please try again.', 'error')
         return redirect(url_for('records'))
 
+def attendance_report_job(args):
+    """
+    Start (or find) the background job for an attendance PDF report
+
+    Args:
+        args: Mapping with the optional 'date', 'class_id', 'from' and 'to'
+            filters
+
+    Returns:
+        Tuple of (job id, status) as ReportJobs.status()
+    """
+    filters = {name: args.get(name) for name in ('date', 'class_id', 'from', 'to') if args.get(name)}
+    
+    # Class names for lookup
+    class_names = class_store.names()
+    
+    # The class names are small enough to be part of the key themselves
+    data_version = [attendance_log.stamp(), enrollment_store.stamp(), class_names]
+    key = reports.report_key('attendance_pdf', filters, data_version)
+    status = report_jobs.status(key)
+    if status in ('done', 'queued', 'running'):
+        return key, status
+    
+    # Records sorted by date and time (newest first), rendered in a worker
+    records, _ = attendance_table.query(date=filters.get('date'), class_id=filters.get('class_id'),
+                                        date_from=filters.get('from'), date_to=filters.get('to'))
+    rows = [(record['name'], class_names.get(record['class_id'], 'Unknown Class'), record['date'], record['time'])
+            for record in records]
+    class_id = filters.get('class_id')
+    class_name = class_names.get(class_id, 'Unknown Class') if class_id else None
+    return key, report_jobs.submit(key, reports.write_attendance_pdf, rows, class_name)
+
+def report_job_response(job_id, status):
+    response = {
+        'success': True,
+        'job_id': job_id,
+        'status': status,
+        'status_url': url_for('report_status', job_id=job_id)
+    }
+    if status == 'done':
+        response['download_url'] = url_for('download_report', job_id=job_id)
+    elif status == 'failed':
+        response['error'] = report_jobs.error(job_id)
+    return jsonify(response), 200 if status == 'done' else 202
+
 @app.route('/export_attendance_pdf')
 def export_attendance_pdf():
     try:
-        # Optional filters
-        date = request.args.get('date', None)
-        class_id = request.args.get('class_id', None)
-        
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Load enrollments for name lookup
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            id_to_info = {e['id']: {'name': e['name'], 'class_id': e.get('class_id', 'default')} for e in enrollments}
-        
-        # Load classes for class name lookup
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-            
-        # Filter by date if specified
-        if date and date in attendance_data:
-            filtered_data = {date: attendance_data[date]}
-        else:
-            filtered_data = attendance_data
-            
-        # Create a PDF
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # Set up PDF styling
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 10, "Attendance Report", 0, 1, 'C')
-        pdf.set_font("Arial", 'I', 10)
-        pdf.cell(0, 10, f"Generated on {datetime.now().strftime('%Y-%m-%d at %H:%M:%S')}", 0, 1, 'C')
-        pdf.ln(10)
-        
-        if class_id:
-            class_name = class_names.get(class_id, 'Unknown Class')
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, f"Class: {class_name}", 0, 1)
-        
-        # Set up the table headers
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(60, 10, "Name", 1, 0)
-        pdf.cell(40, 10, "Class", 1, 0)
-        pdf.cell(30, 10, "Date", 1, 0)
-        pdf.cell(30, 10, "Time", 1, 1)
-        
-        # Add data rows
-        pdf.set_font("Arial", '', 10)
-        
-        # Collect and sort all records
-        all_records = []
-        for curr_date, records in filtered_data.items():
-            for record in records:
-                person_id = record['id']
-                person_info = id_to_info.get(person_id, {'name': f"Unknown ({person_id})", 'class_id': 'default'})
-                
-                # Filter by class if requested
-                if class_id and person_info['class_id'] != class_id:
-                    continue
-                
-                record_class_id = record.get('class_id', person_info['class_id'])
-                class_name = class_names.get(record_class_id, 'Unknown Class')
-                
-                all_records.append({
-                    'name': person_info['name'],
-                    'class': class_name,
-                    'date': curr_date,
-                    'time': record['time']
-                })
-        
-        # Sort by date and time
-        all_records.sort(key=lambda x: (x['date'], x['time']), reverse=True)
-        
-        # Add records to PDF
-        for record in all_records:
-            # Check if we need to add a new page
-            if pdf.get_y() > 250:
-                pdf.add_page()
-                # Re-add headers on new page
-                pdf.set_font("Arial", 'B', 12)
-                pdf.cell(60, 10, "Name", 1, 0)
-                pdf.cell(40, 10, "Class", 1, 0)
-                pdf.cell(30, 10, "Date", 1, 0)
-                pdf.cell(30, 10, "Time", 1, 1)
-                pdf.set_font("Arial", '', 10)
-            
-            pdf.cell(60, 10, record['name'], 1, 0)
-            pdf.cell(40, 10, record['class'], 1, 0)
-            pdf.cell(30, 10, record['date'], 1, 0)
-            pdf.cell(30, 10, record['time'], 1, 1)
-        
-        # Output the PDF
-        pdf_output = pdf.output(dest='S').encode('latin-1')
-        filename = f"attendance_{datetime.now().strftime('%Y%m%d')}.pdf"
-        
-        return Response(
-            pdf_output,
-            mimetype="application/pdf",
-            headers={"Content-Disposition": f"attachment;filename={filename}"}
-        )
+        # Reports are rendered in the background; a cached one is sent
+        # straight away, otherwise the job is started and described
+        job_id, status = attendance_report_job(request.args)
+        if status == 'done':
+            return download_report(job_id)
+        return report_job_response(job_id, status)
     
     except Exception as e:
         logger.exception("Error exporting attendance to PDF")
         flash('Error exporting data. Please try again.', 'error')
         return redirect(url_for('records'))
 
+@app.route('/api/reports/attendance_pdf', methods=['POST'])
+def create_attendance_report():
+    try:
+        # Filters from a JSON body or the query string
+        args = request.get_json(silent=True) or request.args
+        job_id, status = attendance_report_job(args)
+        return report_job_response(job_id, status)
+    
+    except Exception as e:
+        logger.exception("Error starting attendance report")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/reports/<job_id>', methods=['GET'])
+def report_status(job_id):
+    status = report_jobs.status(job_id) if REPORT_ID_PATTERN.fullmatch(job_id) else None
+    if status is None:
+        return jsonify({'success': False, 'error': 'Report not found'}), 404
+    return report_job_response(job_id, status)
+
+@app.route('/api/reports/<job_id>/download', methods=['GET'])
+def download_report(job_id):
+    if not REPORT_ID_PATTERN.fullmatch(job_id) or report_jobs.status(job_id) != 'done':
+        return jsonify({'success': False, 'error': 'Report not ready'}), 404
+    filename = f"attendance_{datetime.now().strftime('%Y%m%d')}.pdf"
+    return send_file(os.path.abspath(report_jobs.path(job_id)), mimetype="application/pdf",
+                     as_attachment=True, download_name=filename)
+
 @app.route('/chatbot')
 def chatbot():
     return render_template('chatbot.html')
 
-@app.route('/api/attendance/query', methods=['POST'])
-def query_attendance():
-    try:
-        data = request.get_json()
-        query = data.get('query', '').lower()
-        class_id = data.get('class_id')
-
-        # Load all necessary data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-
-        today = datetime.now().strftime('%Y-%m-%d')
-
-        # If asking about classes, return available options
-        if 'which classes' in query or 'list classes' in query:
-            class_list = [f"- {c['name']}" for c in classes]
-            return jsonify({
-                'success': True,
-                'response': "Available classes:\n" + "\n".join(class_list),
-                'requires_class': False
-            })
+def names_in_enrollment_order(person_ids, class_id=None):
+    """Return the names of the given people, in the order they enrolled"""
+    enrollments = enrollment_store.for_class(class_id) if class_id else enrollment_store.all()
+    return [e['name'] for e in enrollments if e['id'] in person_ids]
 
-        # Handle attendance queries for all classes if no specific class selected
-        if ('who was present' in query or 'who was absent' in query) and not class_id:
+def chatbot_data_version():
+    """Return a counter that goes up with every change to the enrollments, attendance or classes"""
+    enrollment_store.refresh()
+    attendance_log.refresh()
+    class_store.refresh()
+    return enrollment_store.version + attendance_log.version + class_store.version
+
+def chatbot_answer(intent, class_id, period, date_from, date_to, days):
+    """
+    Answer a chatbot question parsed by chat_query.parse_query
+
+    Returns:
+        The response fields, without 'success'
+    """
+    classes = class_store.all()
+    class_names = class_store.names()
+    where = f"in {class_names.get(class_id, 'Unknown Class')}" if class_id else "across all classes"
+    # Questions about dates are answered from the days with any attendance
+    dates = presence_index.dates(date_from, date_to) if period else []
+
+    # If asking about classes, return available options
+    if intent == 'list_classes':
+        class_list = [f"- {c['name']}" for c in classes]
+        return {'response': "Available classes:\n" + "\n".join(class_list), 'requires_class': False}
+
+    # Attendance rate over a period, for a class or for everyone
+    if intent == 'attendance_rate':
+        presences, possible = presence_index.attendance_rate(dates, class_id)
+        if not possible:
+            return {'response': f"No attendance recorded {period} {where}"}
+        return {'response': f"Attendance rate {period} {where}: {100 * presences / possible:.1f}% "
+                            f"({presences} of {possible} over {len(dates)} days)"}
+
+    # Students absent on several days of a period
+    if intent == 'absent_days':
+        names = names_in_enrollment_order(presence_index.absent_at_least(dates, days, class_id), class_id) if days else []
+        if names:
+            return {'response': f"Absent at least {days} days {period} {where}:\n- " + "\n- ".join(names)}
+        return {'response': f"No students absent at least {days} days {period} {where}"}
+
+    # Who was present or absent on any of the days of a period
+    if intent in ('present', 'absent'):
+        if not dates:
+            return {'response': f"No attendance recorded {period}"}
+        state = 'Present' if intent == 'present' else 'Absent'
+        people = presence_index.present_at_least if intent == 'present' else presence_index.absent_at_least
+
+        # One line per class if no specific class selected
+        if not class_id:
             response = []
             for class_info in classes:
-                class_id = class_info['id']
-                class_name = class_info['name']
-                class_enrollments = [e for e in enrollments if e.get('class_id') == class_id]
-                
-                if today in attendance_data:
-                    present_ids = [r['id'] for r in attendance_data[today] if r.get('class_id') == class_id]
-                    names = [e['name'] for e in class_enrollments if e['id'] in present_ids]
-                    if names:
-                        response.append(f"{class_name}: {', '.join(names)}")
-                    else:
-                        response.append(f"{class_name}: No students present")
-            
-            return jsonify({
-                'success': True,
-                'response': "Present today:\n" + "\n".join(response)
-            })
+                names = names_in_enrollment_order(people(dates, 1, class_info['id']), class_info['id'])
+                response.append(f"{class_info['name']}: {', '.join(names) or f'No students {state.lower()}'}")
+            return {'response': f"{state} {period}:\n" + "\n".join(response)}
 
-        # Total students query
-        if 'total student' in query or 'how many student' in query:
-            if class_id:
-                class_students = [e for e in enrollments if e.get('class_id') == class_id]
-                class_name = class_names.get(class_id, 'Unknown Class')
-                return jsonify({
-                    'success': True,
-                    'response': f"Total students in {class_name}: {len(class_students)}"
-                })
-            total = len(enrollments)
-            return jsonify({
-                'success': True,
-                'response': f"Total students enrolled: {total}"
-            })
+        class_name = class_names.get(class_id, 'Unknown Class')
+        names = names_in_enrollment_order(people(dates, 1, class_id), class_id)
+        if names:
+            return {'response': f"{state} {period} in {class_name}:\n- " + "\n- ".join(names)}
+        return {'response': f"No students {state.lower()} {period} in {class_name}"}
 
-        # Student names query
-        if 'student names' in query or 'list students' in query:
-            if class_id:
-                class_students = [e for e in enrollments if e.get('class_id') == class_id]
-                class_name = class_names.get(class_id, 'Unknown Class')
-                names = [f"- {e['name']}" for e in class_students]
-                return jsonify({
-                    'success': True,
-                    'response': f"Students in {class_name}:\n" + "\n".join(names)
-                })
-            return jsonify({
-                'success': True,
-                'response': "Please select a class:",
-                'requires_class': True,
-                'classes': [{'id': c['id'], 'name': c['name']} for c in classes]
-            })
+    # Total students query
+    if intent == 'total_students':
+        if class_id:
+            class_name = class_names.get(class_id, 'Unknown Class')
+            return {'response': f"Total students in {class_name}: {presence_index.class_size(class_id)}"}
+        return {'response': f"Total students enrolled: {enrollment_store.count()}"}
 
-        # Present/Absent queries with class filter
-        if class_id and today in attendance_data:
-            class_enrollments = [e for e in enrollments if e.get('class_id') == class_id]
+    # Student names query
+    if intent == 'list_students':
+        if class_id:
             class_name = class_names.get(class_id, 'Unknown Class')
-            
-            if 'who was present' in query:
-                present_ids = [r['id'] for r in attendance_data[today] if r.get('class_id') == class_id]
-                names = [e['name'] for e in class_enrollments if e['id'] in present_ids]
-                if names:
-                    return jsonify({
-                        'success': True,
-                        'response': f"Present today in {class_name}:\n- " + "\n- ".join(names)
-                    })
-                return jsonify({
-                    'success': True,
-                    'response': f"No students present today in {class_name}"
-                })
-                
-            elif 'who was absent' in query:
-                present_ids = [r['id'] for r in attendance_data[today] if r.get('class_id') == class_id]
-                names = [e['name'] for e in class_enrollments if e['id'] not in present_ids]
-                if names:
-                    return jsonify({
-                        'success': True,
-                        'response': f"Absent today in {class_name}:\n- " + "\n- ".join(names)
-                    })
-                return jsonify({
-                    'success': True,
-                    'response': f"No students absent today in {class_name}"
-                })
-
-        # Show help message for unknown queries
-        return jsonify({
-            'success': True,
-            'response': "I can help you with:\n- Who was present today?\n- Who was absent today?\n- Show attendance trends\n- Total students\n- List students\n- List classes"
-        })
+            names = [f"- {e['name']}" for e in enrollment_store.for_class(class_id)]
+            return {'response': f"Students in {class_name}:\n" + "\n".join(names)}
+        return {
+            'response': "Please select a class:",
+            'requires_class': True,
+            'classes': [{'id': c['id'], 'name': c['name']} for c in classes]
+        }
 
-    except Exception as e:
-        logger.exception("Error processing chatbot query")
-        return jsonify({'success': False, 'error': str(e)}), 500
+    # Show help message for unknown queries
+    return {'response': "I can help you with:\n- Who was present today?\n- Who was absent yesterday?\n- Attendance rate this month\n- Who was absent 3 days this week?\n- Total students\n- List students\n- List classes"}
+
+@app.route('/api/attendance/query', methods=['POST'])
+def query_attendance():
+    try:
+        data = request.get_json()
+        key = chat_query.parse_query(data.get('query', ''), data.get('class_id'))
+
+        # Answers are cached until the data changes; the key holds the
+        # actual dates, so questions about today move on at midnight
+        version = chatbot_data_version()
+        answer = chatbot_cache.get((key, version))
+        if answer is None:
+            answer = chatbot_answer(*key)
+            chatbot_cache.put((key, version), answer)
+        return jsonify(dict(answer, success=True))
 
     except Exception as e:
         logger.exception("Error processing chatbot query")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def export_attendance_pdf():
-    try:
-        # Optional filters
-        date = request.args.get('date', None)
-        class_id = request.args.get('class_id', None)
-        
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Load enrollments for name lookup
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-            id_to_info = {e['id']: {'name': e['name'], 'class_id': e.get('class_id', 'default')} for e in enrollments}
-        
-        # Load classes for class name lookup
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-            
-        # Filter by date if specified
-        if date and date in attendance_data:
-            filtered_data = {date: attendance_data[date]}
-        else:
-            filtered_data = attendance_data
-            
-        # Create a PDF
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # Set up PDF styling
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 10, "Attendance Report", 0, 1, 'C')
-        pdf.set_font("Arial", 'I', 10)
-        pdf.cell(0, 10, f"Generated on {datetime.now().strftime('%Y-%m-%d at %H:%M:%S')}", 0, 1, 'C')
-        pdf.ln(10)
-        
-        if class_id:
-            class_name = class_names.get(class_id, 'Unknown Class')
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, f"Class: {class_name}", 0, 1)
-        
-        # Set up the table headers
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(60, 10, "Name", 1, 0)
-        pdf.cell(40, 10, "Class", 1, 0)
-        pdf.cell(30, 10, "Date", 1, 0)
-        pdf.cell(30, 10, "Time", 1, 1)
-        
-        # Add data rows
-        pdf.set_font("Arial", '', 10)
-        
-        # Collect and sort all records
-        all_records = []
-        for curr_date, records in filtered_data.items():
-            for record in records:
-                person_id = record['id']
-                person_info = id_to_info.get(person_id, {'name': f"Unknown ({person_id})", 'class_id': 'default'})
-                
-                # Filter by class if requested
-                if class_id and person_info['class_id'] != class_id:
-                    continue
-                
-                record_class_id = record.get('class_id', person_info['class_id'])
-                class_name = class_names.get(record_class_id, 'Unknown Class')
-                
-                all_records.append({
-                    'name': person_info['name'],
-                    'class': class_name,
-                    'date': curr_date,
-                    'time': record['time']
-                })
-        
-        # Sort by date and time
-        all_records.sort(key=lambda x: (x['date'], x['time']), reverse=True)
-        
-        # Add records to PDF
-        for record in all_records:
-            # Check if we need to add a new page
-            if pdf.get_y() > 250:
-                pdf.add_page()
-                # Re-add headers on new page
-                pdf.set_font("Arial", 'B', 12)
-                pdf.cell(60, 10, "Name", 1, 0)
-                pdf.cell(40, 10, "Class", 1, 0)
-                pdf.cell(30, 10, "Date", 1, 0)
-                pdf.cell(30, 10, "Time", 1, 1)
-                pdf.set_font("Arial", '', 10)
-            
-            pdf.cell(60, 10, record['name'], 1, 0)
-            pdf.cell(40, 10, record['class'], 1, 0)
-            pdf.cell(30, 10, record['date'], 1, 0)
-            pdf.cell(30, 10, record['time'], 1, 1)
-        
-        # Output the PDF
-        pdf_output = pdf.output(dest='S').encode('latin-1')
-        filename = f"attendance_{datetime.now().strftime('%Y%m%d')}.pdf"
-        
-        return Response(
-            pdf_output,
-            mimetype="application/pdf",
-            headers={"Content-Disposition": f"attachment;filename={filename}"}
-        )
+@app.route('/api/attendance/query/cache', methods=['GET'])
+def chatbot_cache_stats():
+    return jsonify({'success': True, 'cache': chatbot_cache.stats()})
+
+def chart_data_version():
+    """Return a token that changes whenever the charts' data may have"""
+    return (attendance_log.stamp(), enrollment_store.stamp(), class_store.version_tag())
+
+def attendance_by_date_data():
+    # Attendance counts of the last 14 days in the log, in chronological order
+    date_counts = analytics_aggregates.snapshot()['attendance_by_date']
+    return [[date, count] for date, count in list(date_counts.items())[-14:]]
+
+def enrollment_by_class_data():
+    # Class names for lookup
+    class_names = class_store.names()
     
-    except Exception as e:
-        logger.exception("Error exporting attendance to PDF")
-        flash('Error exporting data. Please try again.', 'error')
-        return redirect(url_for('records'))
+    # Enrollment counts by class
+    class_counts = analytics_aggregates.snapshot()['enrollment_counts']
+    return [[class_names.get(cid, 'Unknown'), count] for cid, count in class_counts.items()]
+
+# Chart images, re-rendered in the background as the data changes
+chart_cache = charts.ChartCache(CHARTS_FOLDER, {
+    'attendance_by_date': (attendance_by_date_data, charts.attendance_by_date_png),
+    'enrollment_by_class': (enrollment_by_class_data, charts.enrollment_by_class_png)
+})
+enrollment_store.subscribe(chart_cache.invalidate)
+attendance_log.subscribe(chart_cache.invalidate)
+
+def send_chart(name):
+    """Serve a cached chart image, revalidated by ETag and Last-Modified"""
+    path, key = chart_cache.lookup(name, chart_data_version())
+    return send_file(os.path.abspath(path), mimetype='image/png', etag=key, conditional=True, max_age=0)
 
 @app.route('/attendance_by_date_chart')
 def attendance_by_date_chart():
     try:
-        # Load attendance data
-        with open(ATTENDANCE_FILE, 'r') as f:
-            attendance_data = json.load(f)
-        
-        # Count attendance by date
-        dates = []
-        counts = []
-        
-        # Get the last 14 days of data
-        sorted_dates = sorted(attendance_data.keys(), reverse=True)[:14]
-        sorted_dates.reverse()  # Put in chronological order for the chart
-        
-        for date in sorted_dates:
-            dates.append(date)
-            counts.append(len(attendance_data[date]))
-        
-        # Create the chart
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.bar(dates, counts, color='skyblue')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Attendance Count')
-        ax.set_title('Daily Attendance')
-        
-        # Rotate date labels for better readability
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        
-        # Save chart to memory
-        output = io.BytesIO()
-        FigureCanvas(fig).print_png(output)
-        
-        return Response(output.getvalue(), mimetype='image/png')
+        return send_chart('attendance_by_date')
     
     except Exception as e:
         logger.exception("Error generating attendance chart")
         # Return a simple error image
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.text(0.5, 0.5, 'Error generating chart', ha='center', va='center')
-        ax.set_axis_off()
-        
-        output = io.BytesIO()
-        FigureCanvas(fig).print_png(output)
-        
-        return Response(output.getvalue(), mimetype='image/png')
+        return Response(charts.error_png(), mimetype='image/png')
 
 @app.route('/enrollment_by_class_chart')
 def enrollment_by_class_chart():
     try:
-        # Load enrollments
-        with open(ENROLLMENTS_FILE, 'r') as f:
-            enrollments = json.load(f)
-        
-        # Load classes for name lookup
-        with open(CLASSES_FILE, 'r') as f:
-            classes = json.load(f)
-            class_names = {c['id']: c['name'] for c in classes}
-        
-        # Count enrollments by class
-        class_counts = {}
-        for enrollment in enrollments:
-            class_id = enrollment.get('class_id', 'default')
-            if class_id not in class_counts:
-                class_counts[class_id] = 0
-            class_counts[class_id] += 1
-        
-        # Prepare data for chart
-        class_labels = [class_names.get(cid, 'Unknown') for cid in class_counts.keys()]
-        counts = list(class_counts.values())
-        
-        # Create the chart
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.bar(class_labels, counts, color='lightgreen')
-        ax.set_xlabel('Class')
-        ax.set_ylabel('Number of Students')
-        ax.set_title('Enrollments by Class')
-        
-        # Rotate labels if there are many classes
-        if len(class_labels) > 3:
-            plt.xticks(rotation=45)
-        plt.tight_layout()
-        
-        # Save chart to memory
-        output = io.BytesIO()
-        FigureCanvas(fig).print_png(output)
-        
-        return Response(output.getvalue(), mimetype='image/png')
+        return send_chart('enrollment_by_class')
     
     except Exception as e:
         logger.exception("Error generating enrollment chart")
         # Return a simple error image
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.text(0.5, 0.5, 'Error generating chart', ha='center', va='center')
-        ax.set_axis_off()
-        
-        output = io.BytesIO()
-        FigureCanvas(fig).print_png(output)
-        
-        return Response(output.getvalue(), mimetype='image/png')
+        return Response(charts.error_png(), mimetype='image/png')
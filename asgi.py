@@ -0,0 +1,409 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.wrappers import Request
+
+import face_utils
+import app as web
+
+logger = logging.getLogger(__name__)
+
+# Recognition frames are encoded in this many worker processes, or on the
+# thread pool if 0. With several server workers, divide the cores between them.
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', str(os.cpu_count() or 1)))
+
+# Frames from concurrent requests arriving within this many seconds of the
+# first waiting one are matched together, up to MATCH_BATCH_SIZE frames
+MATCH_BATCH_WINDOW = float(os.environ.get('MATCH_BATCH_WINDOW', '0.01'))
+MATCH_BATCH_SIZE = int(os.environ.get('MATCH_BATCH_SIZE', '64'))
+
+# Threads running the Flask routes and the matching and attendance writes
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '32'))
+
+# Largest request body accepted
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', str(64 * 1024 * 1024)))
+
+
+class Recognizer:
+    """
+    Recognition shared by all concurrent requests
+
+    Each frame is first looked up in the app's recognition cache, and only
+    encoded in a worker process if it isn't there. The frames then wait in
+    a queue, and those that arrive within MATCH_BATCH_WINDOW of the first
+    are matched in one call per class (apart from cached ones), with their
+    attendance recorded in a single write, on a thread. The process
+    pool uses spawned processes, like the report workers, and is only
+    started on the first frame.
+    """
+
+    def __init__(self, threads, workers=RECOGNITION_WORKERS, window=MATCH_BATCH_WINDOW, max_size=MATCH_BATCH_SIZE):
+        self.threads = threads
+        self.workers = workers
+        self.window = window
+        self.max_size = max_size
+        self.frames = 0    # Frames of the requests being answered
+        self._pool = None
+        self._queue = []   # (frame, future) waiting to be matched, see match_and_mark
+        self._timer = None
+
+    def _encoders(self):
+        if not self.workers:
+            return self.threads
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def reserve(self, count):
+        """
+        Count a request's frames as being recognized, unless there are
+        already web.MAX_RECOGNITION_FRAMES (see app.reserve_recognition)
+
+        Returns:
+            Whether the frames were reserved; release them with release()
+        """
+        if self.frames and self.frames + count > web.MAX_RECOGNITION_FRAMES:
+            return False
+        self.frames += count
+        return True
+
+    def release(self, count):
+        self.frames -= count
+
+    async def recognize(self, frame, class_id=None):
+        """
+        Recognize a frame and record the attendance of the person matched
+
+        Args:
+            frame: The image bytes
+            class_id: Only match enrollments in this class
+
+        Returns:
+            Tuple of (matched enrollment or None, whether attendance was
+            newly recorded or None without a match, whether a face was found)
+        """
+        loop = asyncio.get_running_loop()
+        frame_hash, cached = await loop.run_in_executor(self.threads, lookup_frame, frame, class_id)
+        if cached is not None:
+            has_face = cached[1]
+            if not has_face:
+                return None, None, False
+            face_encoding = None
+        else:
+            face_encoding = await loop.run_in_executor(self._encoders(), face_utils.extract_face_encoding, frame)
+            # Frames without a face are still queued, so they are cached
+            has_face = face_encoding is not None
+
+        future = loop.create_future()
+        self._queue.append(((frame_hash, class_id, face_encoding, cached), future))
+        if len(self._queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        match, new_attendance = await future
+        return match, new_attendance, has_face
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._match(batch))
+
+    async def _match(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.threads, match_and_mark, [frame for frame, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            # The request may have gone away meanwhile
+            if not future.done():
+                future.set_result(result)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def lookup_frame(frame, class_id):
+    """Return a frame's hash and its app.cached_frames result"""
+    frame_hash = face_utils.hash_image(frame)
+    return frame_hash, web.cached_frames([frame_hash], class_id)[0]
+
+
+def match_and_mark(frames):
+    """
+    Match a batch of frames and record the attendance of everyone matched
+
+    Args:
+        frames: List of (frame hash, class id, face encoding, cached result)
+            tuples, where the cached result is lookup_frame's and the face
+            encoding is only used (and may be None) when that is None
+
+    Returns:
+        List of (matched enrollment or None, whether attendance was newly
+        recorded) per frame
+    """
+    matches = [None] * len(frames)
+    by_class = {}
+    for i, (_, class_id, _, cached) in enumerate(frames):
+        if cached is not None:
+            matches[i] = cached[0]
+        else:
+            by_class.setdefault(class_id, []).append(i)
+    for class_id, positions in by_class.items():
+        found = web.match_encodings([frames[i][2] for i in positions], class_id, [frames[i][0] for i in positions])
+        for i, match in zip(positions, found):
+            matches[i] = match
+    return list(zip(matches, web.mark_matches(matches)))
+
+
+threads = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+recognizer = Recognizer(threads)
+
+
+# Recognition routes, answered without holding a thread while frames are
+# encoded and matched; they respond like the Flask routes of the same paths,
+# as (payload, status) or (payload, status, extra headers)
+
+def busy_response():
+    payload = {
+        'success': False,
+        'error': 'The server is busy, please try again shortly',
+        'retry_after': web.RECOGNITION_RETRY_AFTER
+    }
+    return payload, 429, [(b'retry-after', str(web.RECOGNITION_RETRY_AFTER).encode('latin-1'))]
+
+
+async def recognize_face(request):
+    if 'image' not in request.files:
+        return {'success': False, 'error': 'No image file provided'}, 400
+
+    image_file = request.files['image']
+    class_id = request.form.get('class_id') or None  # Optional class filter; '' means none
+    if not recognizer.reserve(1):
+        return busy_response()
+    try:
+        match, new_attendance, has_face = await recognizer.recognize(image_file.read(), class_id)
+    finally:
+        recognizer.release(1)
+
+    if not has_face:
+        await in_thread(web.spool_rejected_frame, image_file, 'noface')
+        return {'success': False, 'error': 'No face detected in the image'}, 400
+    if match:
+        return dict({'success': True}, **web.recognition_result(match, new_attendance)), 200
+    await in_thread(web.spool_rejected_frame, image_file, 'nomatch')
+    return {'success': True, 'recognized': False}, 200
+
+
+async def recognize_faces_batch(request):
+    # Accept several frames as repeated 'images' (or 'image') fields
+    image_files = request.files.getlist('images') or request.files.getlist('image')
+    if not image_files:
+        return {'success': False, 'error': 'No image files provided'}, 400
+    if len(image_files) > web.MAX_BATCH_IMAGES:
+        return {'success': False, 'error': f'At most {web.MAX_BATCH_IMAGES} images per batch'}, 400
+
+    class_id = request.form.get('class_id') or None  # Optional class filter; '' means none
+    if not recognizer.reserve(len(image_files)):
+        return busy_response()
+    try:
+        frames = await asyncio.gather(*(recognizer.recognize(image_file.read(), class_id) for image_file in image_files))
+    finally:
+        recognizer.release(len(image_files))
+
+    results = []
+    for image_file, (match, new_attendance, has_face) in zip(image_files, frames):
+        if not has_face:
+            await in_thread(web.spool_rejected_frame, image_file, 'noface')
+            results.append({'recognized': False, 'error': 'No face detected in the image'})
+        elif match:
+            results.append(web.recognition_result(match, new_attendance))
+        else:
+            await in_thread(web.spool_rejected_frame, image_file, 'nomatch')
+            results.append({'recognized': False})
+    return {'success': True, 'results': results}, 200
+
+
+ROUTES = {
+    ('POST', '/api/recognize'): (recognize_face, "Error in face recognition"),
+    ('POST', '/api/recognize/batch'): (recognize_faces_batch, "Error in batch face recognition"),
+}
+
+
+async def in_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(threads, fn, *args)
+
+
+def wsgi_environ(scope, body):
+    """Build the WSGI environ of an HTTP request"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ('; ' if name == 'cookie' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class RequestTooLarge(Exception):
+    """Raised for request bodies larger than MAX_REQUEST_BYTES"""
+
+
+async def read_body(scope, receive):
+    """
+    Read a request's body
+
+    Returns:
+        The body bytes, or None if the client disconnected
+
+    Raises:
+        RequestTooLarge: If the body is larger than MAX_REQUEST_BYTES
+    """
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'content-length' and value.isdigit() and int(value) > MAX_REQUEST_BYTES:
+            raise RequestTooLarge()
+
+    parts = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        parts.append(message.get('body', b''))
+        size += len(parts[-1])
+        if size > MAX_REQUEST_BYTES:
+            raise RequestTooLarge()
+        if not message.get('more_body'):
+            return b''.join(parts)
+
+
+async def send_json(send, payload, status, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def call_flask(environ, send):
+    """Run a request through the Flask app on the thread pool, streaming its response"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None  # Flask never uses write()
+
+    def start():
+        result = web.app(environ, start_response)
+        return result, iter(result)
+
+    result, chunks = await in_thread(start)
+    try:
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        # Streamed responses (CSV exports, files) are pulled a chunk at a time
+        while True:
+            chunk = await in_thread(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await in_thread(result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            recognizer.shutdown()
+            web.report_jobs.shutdown()
+            threads.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point, e.g. `uvicorn asgi:app`
+
+    The recognition routes are handled here asynchronously (see
+    Recognizer); every other request goes to the Flask app on a thread
+    pool, so slow requests and writes waiting on file locks never hold up
+    the event loop or one another.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+    try:
+        body = await read_body(scope, receive)
+    except RequestTooLarge:
+        await send_json(send, {'success': False, 'error': 'Request body too large'}, 413)
+        return
+    if body is None:
+        return
+    environ = wsgi_environ(scope, body)
+
+    route = ROUTES.get((scope['method'], scope['path']))
+    if route is None:
+        await call_flask(environ, send)
+        return
+
+    handler, error_message = route
+    try:
+        request = Request(environ)
+        # Parse the multipart form off the event loop
+        await in_thread(lambda: request.files)
+        response = await handler(request)
+    except Exception as e:
+        logger.exception(error_message)
+        response = {'success': False, 'error': str(e)}, 500
+    await send_json(send, *response)
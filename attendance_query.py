@@ -0,0 +1,432 @@
+import json
+import base64
+import bisect
+import binascii
+import threading
+
+import numpy as np
+
+from storage import DEFAULT_CLASS_ID
+
+
+class _Vocabulary:
+    """Interned values with codes in order of first appearance"""
+
+    def __init__(self):
+        self.values = []
+        self.code_of = {}
+        self._ranks = None
+        self._sorted = None
+        self._objects = None
+
+    def intern(self, value):
+        code = self.code_of.get(value)
+        if code is None:
+            code = self.code_of[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def ranks(self):
+        """Return an array giving each code's position in sorted value order"""
+        if self._ranks is None or len(self._ranks) != len(self.values):
+            order = sorted(range(len(self.values)), key=self.values.__getitem__)
+            ranks = np.empty(len(self.values), dtype=np.int64)
+            ranks[order] = np.arange(len(self.values))
+            self._ranks = ranks
+            self._sorted = [self.values[code] for code in order]
+        return self._ranks
+
+    def position(self, value, right=False):
+        """
+        Return (rank, exact): the rank value has or would have in sorted
+        order (after any equal value if right is set) and whether it is
+        one of the values
+        """
+        self.ranks()
+        find = bisect.bisect_right if right else bisect.bisect_left
+        rank = find(self._sorted, value)
+        return rank, not right and rank < len(self._sorted) and self._sorted[rank] == value
+
+    def objects(self):
+        """Return the values as an object array, for vectorized lookups by code"""
+        if self._objects is None or len(self._objects) != len(self.values):
+            self._objects = np.empty(len(self.values), dtype=object)
+            self._objects[:] = self.values
+        return self._objects
+
+
+class AttendanceTable:
+    """
+    Columnar copy of the attendance log for filtered, sorted queries
+
+    Each record is a row of integer codes (date, time, person and the
+    record's own class, -1 if it has none) into interned vocabularies, kept
+    in sync through the log's change events. Queries filter and sort the
+    code arrays with NumPy and only build dicts for the rows returned; the
+    date index and the full newest-first order are kept until the next
+    change.
+
+    Rows are returned in the same order as walking the log's
+    {date: [records]} dict (dates in first-seen order, records in order), or
+    newest first by (date, time) with ties in that order, which matches a
+    stable reverse sort of the walked records.
+    """
+
+    def __init__(self, attendance_log, enrollment_store):
+        self.attendance_log = attendance_log
+        self.enrollment_store = enrollment_store
+        self._lock = threading.RLock()
+        self._reset()
+        attendance_log.subscribe(self._on_attendance)
+
+    def _reset(self, capacity=1024):
+        self._size = 0
+        self._date = np.zeros(capacity, dtype=np.int32)
+        self._time = np.zeros(capacity, dtype=np.int32)
+        self._person = np.zeros(capacity, dtype=np.int32)
+        self._record_class = np.zeros(capacity, dtype=np.int32)
+        self._dates = _Vocabulary()
+        self._times = _Vocabulary()
+        self._persons = _Vocabulary()
+        self._classes = _Vocabulary()
+        self._date_index = None
+        self._newest_first = None
+        self._keyset = None
+        self._person_info = None
+
+    def _columns(self):
+        return (self._date, self._time, self._person, self._record_class)
+
+    def _append(self, date_code, record):
+        if self._size == len(self._date):
+            old_columns = self._columns()
+            self._date, self._time, self._person, self._record_class = (
+                np.resize(column, 2 * len(column)) for column in old_columns)
+        row = self._size
+        self._date[row] = date_code
+        self._time[row] = self._times.intern(record['time'])
+        self._person[row] = self._persons.intern(record['id'])
+        self._record_class[row] = self._classes.intern(record['class_id']) if 'class_id' in record else -1
+        self._size += 1
+
+    def _on_attendance(self, event, payload):
+        with self._lock:
+            if event == 'reload':
+                self._reset(max(1024, sum(len(records) for records in payload.values())))
+                for date, records in payload.items():
+                    date_code = self._dates.intern(date)
+                    for record in records:
+                        self._append(date_code, record)
+            elif event == 'mark':
+                for date, record in payload:
+                    self._append(self._dates.intern(date), record)
+            self._date_index = None
+            self._newest_first = None
+
+    # Query helpers
+
+    def _index(self):
+        """
+        Return (rows, starts) where rows lists all rows grouped by date code
+        in walking order and starts[code] is where that date's rows begin
+        """
+        if self._date_index is None or self._date_index[2] != self._size:
+            rows = np.argsort(self._date[:self._size], kind='stable')
+            starts = np.searchsorted(self._date[rows], np.arange(len(self._dates.values) + 1))
+            self._date_index = (rows, starts, self._size)
+        return self._date_index[:2]
+
+    def _sort_newest_first(self, rows):
+        """Stably sort rows by (date, time), newest first"""
+        date_rank = self._dates.ranks()[self._date[rows]]
+        time_rank = self._times.ranks()[self._time[rows]]
+        key = date_rank * len(self._times.values) + time_rank
+        return rows[np.argsort(-key, kind='stable')]
+
+    def _keyset_order(self):
+        """
+        Return (negated keys, rows, scales) for all rows sorted by (date,
+        time, id), newest first
+
+        A row's key is date_rank * scales[0] + time_rank * scales[1] +
+        person_rank. Ranks only shift monotonically as values are added, so
+        an earlier order stays sorted: rows marked since then are sorted on
+        their own and merged in, which is linear rather than a full sort.
+        """
+        person_count = len(self._persons.values)
+        scales = (len(self._times.values) * person_count, person_count)
+        state = (self._size, len(self._dates.values), scales)
+        if self._keyset is not None and self._keyset[0] == state:
+            return self._keyset[1:]
+
+        keys = (self._dates.ranks()[self._date[:self._size]] * scales[0]
+                + self._times.ranks()[self._time[:self._size]] * scales[1]
+                + self._persons.ranks()[self._person[:self._size]])
+        if self._keyset is None:
+            rows = np.argsort(-keys, kind='stable')
+        else:
+            rows = self._keyset[2]
+            new_rows = np.arange(len(rows), self._size)
+            new_rows = new_rows[np.argsort(-keys[new_rows], kind='stable')]
+            rows = np.insert(rows, np.searchsorted(-keys[rows], -keys[new_rows], side='right'), new_rows)
+        self._keyset = (state, -keys[rows], rows, scales)
+        return self._keyset[1:]
+
+    def _key_bound(self, date, time=None, person_id=None):
+        """
+        Return the smallest key that is not less than (date, time,
+        person_id) in the order of _keyset_order; values that were never
+        recorded fall between their neighbours
+        """
+        (date_scale, time_scale) = self._keyset[3]
+        date_rank, exact = self._dates.position(date)
+        bound = date_rank * date_scale
+        if exact and time is not None:
+            time_rank, exact = self._times.position(time)
+            bound += time_rank * time_scale
+            if exact and person_id is not None:
+                bound += self._persons.position(person_id)[0]
+        return bound
+
+    def _date_rows(self, date, date_from, date_to, newest_first):
+        """Return the rows for a date filter in walking or newest-first order"""
+        rows, starts = self._index()
+        if date is not None and date in self._dates.code_of:
+            code = self._dates.code_of[date]
+            rows = rows[starts[code]:starts[code + 1]]
+            return self._sort_newest_first(rows) if newest_first else rows
+        if date_from is None and date_to is None:
+            if not newest_first:
+                return rows
+            # The full sort is kept until the next change
+            if self._newest_first is None:
+                self._newest_first = self._sort_newest_first(rows)
+            return self._newest_first
+
+        codes = [code for code, value in enumerate(self._dates.values)
+                 if (date_from is None or value >= date_from) and (date_to is None or value <= date_to)]
+        rows = np.concatenate([rows[starts[code]:starts[code + 1]] for code in codes] or [rows[:0]])
+        return self._sort_newest_first(rows) if newest_first else rows
+
+    def _person_columns(self, id_to_info, version):
+        """
+        Return (names, class codes) arrays indexed by person code, from the
+        enrollments; people no longer enrolled are 'Unknown (id)' in the
+        'default' class
+        """
+        key = (version, len(self._persons.values))
+        if self._person_info is None or self._person_info[0] != key:
+            default_code = self._classes.intern(DEFAULT_CLASS_ID)
+            names = np.empty(len(self._persons.values), dtype=object)
+            class_codes = np.empty(len(self._persons.values), dtype=np.int32)
+            for code, person_id in enumerate(self._persons.values):
+                person_info = id_to_info.get(person_id)
+                if person_info is None:
+                    names[code] = f"Unknown ({person_id})"
+                    class_codes[code] = default_code
+                else:
+                    names[code] = person_info['name']
+                    class_codes[code] = self._classes.intern(person_info['class_id'])
+            self._person_info = (key, names, class_codes)
+        return self._person_info[1:]
+
+    # Queries
+
+    def query(self, date=None, class_id=None, date_from=None, date_to=None, newest_first=True, offset=0, limit=None):
+        """
+        Return attendance rows joined with the enrollments
+
+        Args:
+            date: Only this date's records; ignored if there are none, as
+                the routes have always done
+            class_id: Only records of people currently in this class
+                (people no longer enrolled count as 'default')
+            date_from: Only records on or after this date
+            date_to: Only records on or before this date
+            newest_first: Sort by date and time, newest first; otherwise
+                keep the log's order
+            offset: Number of matching rows to skip
+            limit: Most rows to return, or None for all
+
+        Returns:
+            Tuple of (rows, total): rows are dicts with 'id', 'name',
+            'class_id' (the record's own class if it has one, otherwise
+            the person's current class), 'date' and 'time'; total is the
+            number of matching rows before offset and limit
+        """
+        self.attendance_log.refresh()
+        id_to_info = self.enrollment_store.id_to_info()
+        version = self.enrollment_store.version
+
+        with self._lock:
+            rows, names, person_classes = self._select(date, class_id, date_from, date_to, newest_first,
+                                                       id_to_info, version)
+            total = len(rows)
+            rows = rows[offset:None if limit is None else offset + limit]
+            columns = self._output_columns(rows, names, person_classes)
+
+        return self._records(columns), total
+
+    def iter_query(self, date=None, class_id=None, date_from=None, date_to=None, newest_first=True, chunk_size=1000):
+        """
+        Yield the rows of query() in lists of up to chunk_size
+
+        The matching rows are picked when iteration starts and only
+        chunk_size dicts exist at a time. Records marked after that are
+        left out, and a reload of the log meanwhile does not affect the
+        rows still to come, since it replaces the columns rather than
+        changing them.
+        """
+        self.attendance_log.refresh()
+        id_to_info = self.enrollment_store.id_to_info()
+        version = self.enrollment_store.version
+
+        with self._lock:
+            rows, names, person_classes = self._select(date, class_id, date_from, date_to, newest_first,
+                                                       id_to_info, version)
+            state = self._state()
+
+        for start in range(0, len(rows), chunk_size):
+            with self._lock:
+                columns = self._output_columns(rows[start:start + chunk_size], names, person_classes, state)
+            yield self._records(columns)
+
+    def _select(self, date, class_id, date_from, date_to, newest_first, id_to_info, version):
+        """Return (rows, names, person classes) for query(); call with the lock held"""
+        rows = self._date_rows(date, date_from, date_to, newest_first)
+
+        names, person_classes = self._person_columns(id_to_info, version)
+        if class_id:
+            class_code = self._classes.code_of.get(class_id)
+            if class_code is None:
+                rows = rows[:0]
+            else:
+                rows = rows[person_classes[self._person[rows]] == class_code]
+        return rows, names, person_classes
+
+    def page(self, date=None, class_id=None, date_from=None, date_to=None, after=None, limit=100,
+             record_class_id=None):
+        """
+        Return one page of attendance rows, newest first, by keyset
+
+        Rows are ordered by (date, time, id), newest first, and a page
+        starts right after the (date, time, id) key of the previous page's
+        last row, so its cost depends on the page size rather than on how
+        deep into the history it is, and records marked meanwhile never
+        shift later pages.
+
+        Args:
+            date: Only this date's records; ignored if there are none, as
+                query() does
+            class_id: Only records of people currently in this class
+            date_from: Only records on or after this date
+            date_to: Only records on or before this date
+            after: (date, time, id) key of the last row already returned,
+                or None for the first page
+            limit: Most rows to return
+            record_class_id: Only rows whose 'class_id' is this class, that
+                is the record's own class, or the person's current class for
+                records without one
+
+        Returns:
+            Tuple of (rows, total, next_key): rows are dicts as returned by
+            query(), total is the number of rows matching the filters
+            across all pages and next_key is the key to pass as `after`
+            for the next page, or None on the last page
+        """
+        self.attendance_log.refresh()
+        id_to_info = self.enrollment_store.id_to_info()
+        version = self.enrollment_store.version
+
+        with self._lock:
+            if date is not None and date in self._dates.code_of:
+                date_from = date_to = date
+            neg_keys, rows, scales = self._keyset_order()
+
+            # Date bounds and the cursor are all contiguous ranges of the order
+            start, end = 0, len(rows)
+            if date_to is not None:
+                upper = self._dates.position(date_to, right=True)[0] * scales[0]
+                start = np.searchsorted(neg_keys, -upper, side='right')
+            if date_from is not None:
+                end = np.searchsorted(neg_keys, -self._key_bound(date_from), side='right')
+            end = max(start, end)
+            page_start = start
+            if after is not None:
+                page_start = max(start, min(end, np.searchsorted(neg_keys, -self._key_bound(*after), side='right')))
+
+            names, person_classes = self._person_columns(id_to_info, version)
+            if class_id or record_class_id:
+                candidates = rows[start:end]
+                keep = np.ones(len(candidates), dtype=bool)
+                # An unknown class gets code -2, which no row has
+                if class_id:
+                    keep &= person_classes[self._person[candidates]] == self._classes.code_of.get(class_id, -2)
+                if record_class_id:
+                    record_classes = self._record_class[candidates]
+                    shown_classes = np.where(record_classes >= 0, record_classes,
+                                             person_classes[self._person[candidates]])
+                    keep &= shown_classes == self._classes.code_of.get(record_class_id, -2)
+                matches = np.flatnonzero(keep)
+                total = len(matches)
+                matches = matches[np.searchsorted(matches, page_start - start):]
+                selected = rows[start + matches[:limit + 1]]
+            else:
+                total = int(end - start)
+                selected = rows[page_start:min(end, page_start + limit + 1)]
+
+            has_more = len(selected) > limit
+            columns = self._output_columns(selected[:limit], names, person_classes)
+
+        records = self._records(columns)
+        next_key = None
+        if has_more and records:
+            last = records[-1]
+            next_key = (last['date'], last['time'], last['id'])
+        return records, total, next_key
+
+    def _state(self):
+        """Return the columns and vocabularies, which a reload replaces rather than changes"""
+        return (self._date, self._time, self._person, self._record_class,
+                self._dates, self._times, self._persons, self._classes)
+
+    def _output_columns(self, rows, names, person_classes, state=None):
+        """Look up the output values of rows column by column"""
+        date, time, person, record_class, dates, times, persons, classes = state or self._state()
+        person_codes = person[rows]
+        record_classes = record_class[rows]
+        class_codes = np.where(record_classes >= 0, record_classes, person_classes[person_codes])
+        return zip(
+            persons.objects()[person_codes].tolist(),
+            names[person_codes].tolist(),
+            classes.objects()[class_codes].tolist(),
+            dates.objects()[date[rows]].tolist(),
+            times.objects()[time[rows]].tolist()
+        )
+
+    @staticmethod
+    def _records(columns):
+        return [{'id': person_id, 'name': name, 'class_id': class_id, 'date': date, 'time': time}
+                for person_id, name, class_id, date, time in columns]
+
+
+def encode_cursor(key):
+    """Return an opaque URL-safe cursor for a (date, time, id) page key"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (date, time, id) page key of a cursor from encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not (isinstance(key, list) and len(key) == 3 and all(isinstance(value, str) for value in key)):
+        raise ValueError('Invalid cursor')
+    return tuple(key)
+
@@ -0,0 +1,379 @@
+"""
+Benchmark the recognition pipeline and the reporting routes
+
+Generates a synthetic data set in a temporary directory, runs each stage
+through the same code paths the app uses (the Flask test client for
+routes) and reports throughput and latency percentiles as JSON.
+
+    python -m benchmarks --enrollments 10000 --days 180 --output results.json
+    python -m benchmarks --enrollments 10000 --compare results.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+import face_utils
+import binary_store
+import sql_store
+from benchmarks.synthetic import write_dataset, synthetic_frame, synthetic_encoding
+
+STAGES = [
+    'startup', 'load_enrollments', 'build_index', 'extract', 'match', 'match_class', 'match_exact', 'match_exact_bands',
+    'recognize', 'recognize_cached', 'recognize_batch',
+    'attendance_api', 'records', 'analytics', 'export_csv', 'export_pdf', 'export_pdf_cached',
+    'chart_attendance', 'chart_enrollment', 'chatbot'
+]
+
+
+def latency_stats(samples):
+    """Summarize a list of durations in seconds"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': total / len(ordered) * 1000,
+        'p50_ms': percentile(50),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000,
+        'ops_per_sec': len(ordered) / total if total else None
+    }
+
+
+def measure(fn, repeat, warmup=1):
+    """Call fn(i) repeat times after warmup calls and return latency stats"""
+    for i in range(warmup):
+        fn(i)
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+
+def check_exact_matches(queries, enrollments, tolerance=0.60):
+    """
+    Compare FaceIndex results with a brute-force scan using score_enrollment
+
+    Returns:
+        Dict with the number of queries checked and mismatches found
+    """
+    index = face_utils.FaceIndex(enrollments)
+    mismatches = 0
+    for query in queries:
+        best, best_score = None, 0
+        for enrollment in enrollments:
+            score = face_utils.score_enrollment(query, enrollment)
+            if score is not None and score > best_score and score > tolerance:
+                best, best_score = enrollment, score
+        if index.search(query, tolerance)['match'] is not best:
+            mismatches += 1
+    return {'count': len(queries), 'mismatches': mismatches}
+
+
+def near_duplicate(rng, encoding, flips):
+    """Return a copy of an encoding with `flips` pHash bits flipped and jittered regions"""
+    phash = list(encoding['features']['phash'])
+    for bit in rng.sample(range(face_utils.PHASH_BITS), flips):
+        phash[bit] = '1' if phash[bit] == '0' else '0'
+    return {
+        'hash': '%032x' % rng.getrandbits(128),
+        'thumbnail': '',
+        'features': {
+            'phash': ''.join(phash),
+            'regions': [value + rng.gauss(0, 2.0) for value in encoding['features']['regions']]
+        }
+    }
+
+
+def brute_force_search(query, enrollments):
+    """
+    Rank enrollments with score_enrollment, as FaceIndex.search should
+
+    Returns:
+        Tuple of (best, score, runner-up, runner-up score), None and 0.0
+        where there is none; ties go to the earliest enrollment
+    """
+    scored = []
+    for position, enrollment in enumerate(enrollments):
+        score = face_utils.score_enrollment(query, enrollment)
+        if score is not None:
+            scored.append((-score, position))
+    scored.sort()
+    best = [(enrollments[position], -score) for score, position in scored[:2]]
+    best += [(None, 0.0)] * (2 - len(best))
+    (best, score), (runner_up, runner_up_score) = best
+    return best, score, runner_up, runner_up_score
+
+
+def check_band_matches(rng, enrollment_count, query_count, tolerances=(0.86, 0.90, 0.95)):
+    """
+    Compare FaceIndex searches that use the pHash band tables with a
+    brute-force scan using score_enrollment
+
+    The band tables are only used for strict tolerances on large indexes,
+    so the enrollments are small clusters of near-duplicates (and the
+    queries near-duplicates of them, exact copies or strangers) to get
+    matches and close runners-up at those tolerances. The check is run on
+    a fresh index, after adding rows the tables don't cover yet, and after
+    removing rows.
+
+    Returns:
+        Dict with the number of searches checked, how many used the band
+        tables, and the mismatches in match, score or runner-up found
+    """
+    enrollment_count = max(enrollment_count, face_utils.MIN_BAND_ROWS)
+    bases = []
+    enrollments = []
+    while len(enrollments) < enrollment_count + enrollment_count // 10:
+        base = synthetic_encoding(rng, 0)
+        bases.append(base)
+        for _ in range(rng.randint(1, 4)):
+            enrollments.append({'id': f'person_{len(enrollments)}', 'name': f'Student {len(enrollments)}',
+                                'class_id': 'default', 'encoding': near_duplicate(rng, base, rng.randint(0, 12))})
+
+    queries = []
+    for i in range(query_count):
+        kind = i % 4
+        if kind == 0:
+            queries.append(synthetic_encoding(rng, 0))
+        elif kind == 1:
+            queries.append(rng.choice(enrollments)['encoding'])
+        else:
+            queries.append(near_duplicate(rng, rng.choice(bases), rng.randint(0, 10)))
+
+    index = face_utils.FaceIndex(enrollments[:enrollment_count])
+    stats = {'count': 0, 'band_searches': 0, 'mismatches': 0}
+
+    def check():
+        live = [enrollment for enrollment in index.enrollments if enrollment is not None]
+        for query in queries:
+            best, score, runner_up, runner_up_score = brute_force_search(query, live)
+            for tolerance in tolerances:
+                result = index.search(query, tolerance)
+                stats['count'] += 1
+                stats['band_searches'] += index._band_radius(tolerance) is not None
+                match = best if score > tolerance else None
+                ok = result['match'] is match and (match is None or abs(result['score'] - score) < 1e-6)
+                # The index only ranks runners-up that could pass the tolerance
+                if runner_up_score > tolerance:
+                    ok = ok and result['runner_up'] is runner_up and abs(result['runner_up_score'] - runner_up_score) < 1e-6
+                else:
+                    ok = ok and result['runner_up_score'] <= runner_up_score + 1e-6
+                stats['mismatches'] += not ok
+
+    check()
+    # Rows added after the band tables were built are scanned directly
+    for enrollment in enrollments[enrollment_count:]:
+        index.add(enrollment)
+    check()
+    for enrollment in enrollments[::7]:
+        index.remove(enrollment['id'])
+    check()
+    return stats
+
+
+def start_app(data_dir):
+    """Import the app in a fresh interpreter, as a web worker does on boot"""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=data_dir, env=env, check=True, capture_output=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='facescan-bench-')
+
+    start = time.perf_counter()
+    dataset = write_dataset(data_dir, enrollments=args.enrollments, classes=args.classes, days=args.days,
+                            attendance_rate=args.attendance_rate, enrolled_frames=args.frames,
+                            thumbnail_bytes=args.thumbnail_bytes, seed=args.seed)
+    generate_seconds = time.perf_counter() - start
+
+    if args.enrollment_format == 'binary':
+        binary_store.migrate_json_enrollments(os.path.join(data_dir, 'enrollments.json'),
+                                              os.path.join(data_dir, 'enrollments'), overwrite=True)
+    os.environ['ENROLLMENT_FORMAT'] = args.enrollment_format
+    if args.storage_backend == 'sqlite':
+        sql_store.migrate_json(*(os.path.join(data_dir, name) for name in
+                                 ('enrollments.json', 'attendance.json', 'classes.json', 'attendance.db')),
+                               overwrite=True)
+    os.environ['STORAGE_BACKEND'] = args.storage_backend
+
+    # The app keeps its data files relative to the working directory
+    os.chdir(data_dir)
+    import app as app_module
+    logging.disable(logging.INFO)
+    client = app_module.app.test_client()
+    store = app_module.enrollment_store
+
+    frames = dataset['frames']
+    unknown_frames = [synthetic_frame(rng) for _ in range(max(args.repeat, 8))]
+    known_queries = [face_utils.extract_face_encoding(frame) for frame in frames]
+    unknown_queries = [synthetic_encoding(rng, 0) for _ in range(max(args.repeat, 1))]
+    queries = [q for pair in zip(known_queries, unknown_queries) for q in pair] or unknown_queries
+    class_ids = dataset['class_ids']
+    last_date = dataset['dates'][-1] if dataset['dates'] else None
+
+    def post_frames(url, frames_to_send, field='image'):
+        data = {field: [(io.BytesIO(frame), 'capture.jpg') for frame in frames_to_send]}
+        response = client.post(url, data=data, content_type='multipart/form-data')
+        assert response.status_code < 500, response.data[:200]
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code < 500, response.data[:200]
+        response.get_data()
+
+    recognize_frames = frames + unknown_frames
+
+    def export_pdf(cached):
+        # From requesting the report to downloading it, rendering it afresh
+        # unless cached
+        if not cached:
+            for name in os.listdir(app_module.report_jobs.directory):
+                os.remove(os.path.join(app_module.report_jobs.directory, name))
+        job = client.post('/api/reports/attendance_pdf', json={'date': last_date}).get_json()
+        while job['status'] in ('queued', 'running'):
+            time.sleep(0.01)
+            job = client.get(job['status_url']).get_json()
+        assert job['status'] == 'done', job
+        get(job['download_url'])
+
+    def json_enrollments():
+        # Full records with encodings, whatever format the app runs with
+        with open(os.path.join(data_dir, 'enrollments.json')) as f:
+            return json.load(f)
+
+    stages = {
+        'startup': lambda: measure(lambda i: start_app(data_dir), args.startup_repeat),
+        'load_enrollments': lambda: measure(lambda i: (setattr(store, '_loaded', False), store.all()), 1, warmup=0),
+        'build_index': lambda: measure(lambda i: store._build_face_index(), 1, warmup=0),
+        'extract': lambda: measure(lambda i: face_utils.extract_face_encoding(recognize_frames[i % len(recognize_frames)]), args.repeat),
+        'match': lambda: measure(lambda i: face_utils.find_matching_face(queries[i % len(queries)], store.face_index()), args.repeat),
+        'match_class': lambda: measure(lambda i: face_utils.find_matching_face(
+            queries[i % len(queries)], store.face_index(), class_id=class_ids[i % len(class_ids)]), args.repeat),
+        'match_exact': lambda: check_exact_matches(queries[:args.exact_queries], json_enrollments()[:args.exact_enrollments]),
+        'match_exact_bands': lambda: check_band_matches(rng, args.band_enrollments, args.exact_queries),
+        'recognize': lambda: measure(lambda i: post_frames('/api/recognize', [recognize_frames[i % len(recognize_frames)]]), args.repeat, warmup=0),
+        'recognize_cached': lambda: measure(lambda i: post_frames('/api/recognize', [recognize_frames[0]]), args.repeat),
+        'recognize_batch': lambda: measure(lambda i: post_frames(
+            '/api/recognize/batch', [rng.choice(recognize_frames) for _ in range(args.batch_size)], 'images'), args.repeat),
+        'attendance_api': lambda: measure(lambda i: get('/api/attendance'), args.route_repeat),
+        'records': lambda: measure(lambda i: get('/records'), args.route_repeat),
+        'analytics': lambda: measure(lambda i: get('/api/analytics'), args.route_repeat),
+        'export_csv': lambda: measure(lambda i: get('/export_attendance_csv'), args.route_repeat),
+        'export_pdf': lambda: measure(lambda i: export_pdf(cached=False), args.route_repeat),
+        'export_pdf_cached': lambda: measure(lambda i: export_pdf(cached=True), args.route_repeat),
+        'chart_attendance': lambda: measure(lambda i: get('/attendance_by_date_chart'), args.route_repeat),
+        'chart_enrollment': lambda: measure(lambda i: get('/enrollment_by_class_chart'), args.route_repeat),
+        'chatbot': lambda: measure(lambda i: client.post('/api/attendance/query', json={
+            'query': 'who was present today', 'class_id': class_ids[i % len(class_ids)]}), args.route_repeat),
+    }
+
+    results = {}
+    for name in args.stages:
+        results[name] = stages[name]()
+        print(format_stage(name, results[name]), file=sys.stderr)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'data_dir': data_dir,
+            'generate_seconds': generate_seconds,
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        },
+        'stages': results
+    }
+
+
+def format_stage(name, stats):
+    if 'p50_ms' not in stats:
+        return f"{name:<18} {json.dumps(stats)}"
+    return (f"{name:<18} p50 {stats['p50_ms']:9.3f} ms  p99 {stats['p99_ms']:9.3f} ms  "
+            f"{stats['ops_per_sec'] or 0:10.1f} ops/s")
+
+
+def compare(results, baseline):
+    """Print p50/p99 ratios of results against a previous run"""
+    print(f"{'stage':<18} {'p50 ratio':>10} {'p99 ratio':>10}")
+    for name, stats in results['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base or 'p50_ms' not in stats or 'p50_ms' not in base:
+            continue
+        print(f"{name:<18} {stats['p50_ms'] / base['p50_ms']:10.2f} {stats['p99_ms'] / base['p99_ms']:10.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--enrollments', type=int, default=1000, help='number of enrolled students')
+    parser.add_argument('--classes', type=int, default=20, help='number of classes')
+    parser.add_argument('--days', type=int, default=30, help='days of attendance history')
+    parser.add_argument('--attendance-rate', type=float, default=0.8, help='chance a student is present on a day')
+    parser.add_argument('--frames', type=int, default=100, help='students enrolled from real synthetic frames')
+    parser.add_argument('--thumbnail-bytes', type=int, default=face_utils.THUMBNAIL_BYTES,
+                        help='thumbnail size per synthetic enrollment (0 to save space at large scales)')
+    parser.add_argument('--enrollment-format', choices=['json', 'binary'], default='json',
+                        help='enrollment storage format the app runs with')
+    parser.add_argument('--storage-backend', choices=['json', 'sqlite'], default='json',
+                        help='storage backend the app runs with')
+    parser.add_argument('--repeat', type=int, default=200, help='iterations for recognition stages')
+    parser.add_argument('--startup-repeat', type=int, default=5, help='app start-ups to time')
+    parser.add_argument('--route-repeat', type=int, default=10, help='iterations for reporting routes')
+    parser.add_argument('--batch-size', type=int, default=8, help='frames per batch recognition request')
+    parser.add_argument('--exact-queries', type=int, default=50, help='queries for the exactness check')
+    parser.add_argument('--exact-enrollments', type=int, default=5000, help='enrollments for the exactness check')
+    parser.add_argument('--band-enrollments', type=int, default=2 * face_utils.MIN_BAND_ROWS,
+                        help='enrollments for the exactness check of the band tables (at least MIN_BAND_ROWS)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='directory for the synthetic data (default: a new temporary directory)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import os
+import json
+import base64
+import random
+from datetime import date, datetime, timedelta
+
+import face_utils
+
+
+def synthetic_frame(rng, size=None):
+    """Return random bytes the size of a 640x480 webcam JPEG"""
+    if size is None:
+        size = rng.randint(30 * 1024, 90 * 1024)
+    return rng.randbytes(size)
+
+
+def synthetic_encoding(rng, thumbnail_bytes=face_utils.THUMBNAIL_BYTES):
+    """
+    Return a random face encoding shaped like extract_face_encoding's output
+
+    Region values of compressed image data average close to 127.5, so they
+    are drawn around that value as real frames would produce.
+    """
+    return {
+        'hash': '%032x' % rng.getrandbits(128),
+        'thumbnail': base64.b64encode(rng.randbytes(thumbnail_bytes)).decode('utf-8'),
+        'features': {
+            'phash': format(rng.getrandbits(face_utils.PHASH_BITS), '064b'),
+            'regions': [rng.gauss(127.5, 2.0) for _ in range(face_utils.REGION_COUNT)]
+        }
+    }
+
+
+def write_dataset(directory, enrollments=1000, classes=20, days=30, attendance_rate=0.8,
+                  enrolled_frames=100, thumbnail_bytes=face_utils.THUMBNAIL_BYTES, seed=0):
+    """
+    Write synthetic enrollments.json, attendance.json and classes.json
+
+    The first enrolled_frames students get encodings extracted from real
+    synthetic frames, which are returned so that recognition can be
+    benchmarked with faces that match. Attendance covers the last `days`
+    days with each student present with probability attendance_rate.
+
+    Returns:
+        Dict with the generated 'frames' (bytes), 'class_ids' and 'dates'
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    class_ids = ['default'] + [f'class_{i}' for i in range(1, classes)]
+    with open(os.path.join(directory, 'classes.json'), 'w') as f:
+        json.dump([{'id': class_id, 'name': f'Class {i}', 'created_at': datetime.now().isoformat()}
+                   for i, class_id in enumerate(class_ids)], f)
+
+    frames = []
+    person_ids = []
+    person_classes = []
+    with open(os.path.join(directory, 'enrollments.json'), 'w') as f:
+        f.write('[')
+        for i in range(enrollments):
+            if i < enrolled_frames:
+                frame = synthetic_frame(rng)
+                frames.append(frame)
+                encoding = face_utils.extract_face_encoding(frame)
+            else:
+                encoding = synthetic_encoding(rng, thumbnail_bytes)
+
+            person_id = f'person_{i}'
+            class_id = class_ids[i % len(class_ids)]
+            person_ids.append(person_id)
+            person_classes.append(class_id)
+            if i:
+                f.write(',')
+            json.dump({
+                'id': person_id,
+                'name': f'Student {i}',
+                'class_id': class_id,
+                'encoding': encoding,
+                'image_path': os.path.join('uploads', f'{person_id}.jpg'),
+                'enrolled_at': datetime.now().isoformat()
+            }, f)
+        f.write(']')
+
+    # Attendance is written one day at a time to keep memory flat
+    dates = [(date.today() - timedelta(days=offset)).isoformat() for offset in range(days, 0, -1)]
+    with open(os.path.join(directory, 'attendance.json'), 'w') as f:
+        f.write('{')
+        for day_index, day in enumerate(dates):
+            records = []
+            for person_id, class_id in zip(person_ids, person_classes):
+                if rng.random() < attendance_rate:
+                    seconds = rng.randint(8 * 3600, 10 * 3600)
+                    records.append({
+                        'id': person_id,
+                        'time': f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}',
+                        'class_id': class_id
+                    })
+            if day_index:
+                f.write(',')
+            f.write(f'{json.dumps(day)}:{json.dumps(records)}')
+        f.write('}')
+
+    return {'frames': frames, 'class_ids': class_ids, 'dates': dates}
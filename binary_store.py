@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import base64
+import binascii
+import logging
+import argparse
+
+import numpy as np
+
+import face_utils
+from storage import EnrollmentStore, file_lock, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# An enrollment directory holds:
+#   metadata.json     names, class ids and the other small fields of each
+#                     enrollment, plus the names of the current data files
+#   templates.N.bin   fixed-width face_utils.TEMPLATE_DTYPE records after a
+#                     header, memory-mapped straight into the matcher
+#   thumbnails.N.bin  raw thumbnail bytes, only read on demand
+# N is a generation number that changes whenever the data files are
+# rewritten, so metadata.json never refers to a half-written file
+METADATA_FILE = 'metadata.json'
+FORMAT_VERSION = 1
+TEMPLATE_MAGIC = b'FSTPL\x00\x00\x00'
+TEMPLATE_HEADER_SIZE = 16
+
+# The data files are rewritten once removed rows outnumber the live ones
+# (and there are at least this many)
+MIN_COMPACT_ROWS = 1024
+
+
+def _template_header():
+    fields = np.array([FORMAT_VERSION, face_utils.TEMPLATE_DTYPE.itemsize], dtype='<u4')
+    return TEMPLATE_MAGIC + fields.tobytes()
+
+
+def _data_files(generation):
+    return {
+        'generation': generation,
+        'templates': f'templates.{generation}.bin',
+        'thumbnails': f'thumbnails.{generation}.bin'
+    }
+
+
+def read_templates(path):
+    """
+    Memory-map a template file
+
+    The mapping is copy-on-write: the matcher may modify rows in memory
+    without touching the file. A partial record at the end left by an
+    interrupted append is ignored.
+
+    Returns:
+        Array of face_utils.TEMPLATE_DTYPE records
+    """
+    with open(path, 'rb') as f:
+        header = f.read(TEMPLATE_HEADER_SIZE)
+    if header != _template_header():
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} template file")
+
+    count = (os.path.getsize(path) - TEMPLATE_HEADER_SIZE) // face_utils.TEMPLATE_DTYPE.itemsize
+    if not count:
+        return np.zeros(0, dtype=face_utils.TEMPLATE_DTYPE)
+    return np.memmap(path, dtype=face_utils.TEMPLATE_DTYPE, mode='c', offset=TEMPLATE_HEADER_SIZE, shape=(count,))
+
+
+def write_templates(path, templates):
+    with open(path, 'wb') as f:
+        f.write(_template_header())
+        f.write(np.ascontiguousarray(templates).tobytes())
+
+
+def split_enrollment(record, template):
+    """
+    Split an enrollment record into its metadata and thumbnail
+
+    Args:
+        record: Enrollment record with its full 'encoding'
+        template: The record's face_utils.TEMPLATE_DTYPE template
+
+    Returns:
+        Tuple of (metadata dict, thumbnail bytes). The metadata keeps every
+        field except the encoding, which is only kept (without thumbnail)
+        when the template can't represent it.
+    """
+    encoding = record.get('encoding') or {}
+    metadata = {key: value for key, value in record.items() if key != 'encoding'}
+    if template['flags'] & face_utils.TEMPLATE_IRREGULAR:
+        metadata['encoding'] = {key: value for key, value in encoding.items() if key != 'thumbnail'}
+
+    try:
+        thumbnail = base64.b64decode(encoding.get('thumbnail') or '', validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        logger.warning(f"Dropping malformed thumbnail of enrollment {record.get('id')}")
+        thumbnail = b''
+    return metadata, thumbnail
+
+
+def migrate_json_enrollments(json_path, directory, overwrite=False):
+    """
+    Convert an enrollments.json file into an enrollment directory
+
+    Args:
+        json_path: Path of the JSON enrollments file, which is left in place
+        directory: Enrollment directory to create
+        overwrite: Replace an existing enrollment directory's contents
+
+    Returns:
+        Number of enrollments migrated
+    """
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    if os.path.exists(metadata_path) and not overwrite:
+        raise FileExistsError(f"{metadata_path} already exists")
+
+    with open(json_path, 'r') as f:
+        records = json.load(f)
+
+    os.makedirs(directory, exist_ok=True)
+    files = _data_files(0)
+    templates = face_utils.pack_templates([record.get('encoding') for record in records])
+
+    enrollments = []
+    with open(os.path.join(directory, files['thumbnails']), 'wb') as thumbnails:
+        for row, record in enumerate(records):
+            metadata, thumbnail = split_enrollment(record, templates[row])
+            metadata['row'] = row
+            metadata['thumbnail'] = [thumbnails.tell(), len(thumbnail)]
+            thumbnails.write(thumbnail)
+            enrollments.append(metadata)
+
+    write_templates(os.path.join(directory, files['templates']), templates)
+    write_json_atomic(metadata_path, dict(files, format=FORMAT_VERSION, enrollments=enrollments))
+    logger.info(f"Migrated {len(enrollments)} enrollments from {json_path} to {directory}")
+    return len(enrollments)
+
+
+class BinaryEnrollmentStore(EnrollmentStore):
+    """
+    Enrollment store backed by an enrollment directory (see above)
+
+    Only the metadata is parsed; the matching templates are memory-mapped
+    and handed to the FaceIndex without copying, and thumbnails stay on
+    disk until thumbnail() asks for one. Records returned by the accessors
+    carry the metadata fields plus their template 'row' and 'thumbnail'
+    location, but no encoding.
+    """
+
+    def __init__(self, directory):
+        super().__init__(os.path.join(directory, METADATA_FILE))
+        self.directory = directory
+        self._files = None
+        self._templates = np.zeros(0, dtype=face_utils.TEMPLATE_DTYPE)
+
+    def _data_path(self, kind):
+        return os.path.join(self.directory, self._files[kind])
+
+    def _read(self):
+        with open(self.path, 'r') as f:
+            metadata = json.load(f)
+        if metadata.get('format') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported enrollment format {metadata.get('format')} in {self.path}")
+
+        self._files = _data_files(metadata['generation'])
+        self._templates = read_templates(self._data_path('templates'))
+        return metadata['enrollments']
+
+    def _write(self, records):
+        write_json_atomic(self.path, dict(self._files, format=FORMAT_VERSION, enrollments=records))
+
+    def _build_face_index(self):
+        rows = np.fromiter((record['row'] for record in self._records), dtype=np.intp, count=len(self._records))
+        if len(rows) == len(self._templates) and np.array_equal(rows, np.arange(len(rows))):
+            # The file holds exactly these rows in order; use the mapping as is
+            templates = self._templates
+        else:
+            templates = self._templates[rows]
+        return face_utils.FaceIndex(self._records, templates)
+
+    def _ensure_files(self):
+        """Create empty data files for a new enrollment directory"""
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._files = _data_files(0)
+        write_templates(self._data_path('templates'), np.zeros(0, dtype=face_utils.TEMPLATE_DTYPE))
+        open(self._data_path('thumbnails'), 'wb').close()
+
+    def _append_templates(self, templates):
+        """Append templates to the template file, setting their rows"""
+        itemsize = face_utils.TEMPLATE_DTYPE.itemsize
+        with open(self._data_path('templates'), 'r+b') as f:
+            row = (os.fstat(f.fileno()).st_size - TEMPLATE_HEADER_SIZE) // itemsize
+            # Drop a partial record left by an interrupted append
+            f.truncate(TEMPLATE_HEADER_SIZE + row * itemsize)
+            f.seek(0, os.SEEK_END)
+            templates['row'] = np.arange(row, row + len(templates))
+            f.write(templates.tobytes())
+        self._templates = read_templates(self._data_path('templates'))
+
+    def _append_thumbnails(self, thumbnails):
+        """Append thumbnails' bytes to the blob file and return their [offset, length] each"""
+        locations = []
+        with open(self._data_path('thumbnails'), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for thumbnail in thumbnails:
+                f.write(thumbnail)
+                locations.append([offset, len(thumbnail)])
+                offset += len(thumbnail)
+        return locations
+
+    # Accessors
+
+    def thumbnail(self, person_id):
+        """Return the base64 thumbnail of an enrollment, or None"""
+        record = self.get(person_id)
+        if record is None or not record.get('thumbnail'):
+            return None
+        offset, length = record['thumbnail']
+        with open(self._data_path('thumbnails'), 'rb') as f:
+            f.seek(offset)
+            return base64.b64encode(f.read(length)).decode('utf-8')
+
+    # Mutators
+
+    def add(self, record):
+        """Append a new enrollment record (with its full encoding) and save it"""
+        self.add_many([record])
+
+    def add_many(self, records):
+        """Append new enrollment records (with their full encodings) and save the metadata once"""
+        records = list(records)
+        templates = face_utils.pack_templates([record.get('encoding') for record in records])
+        split = [split_enrollment(record, template) for record, template in zip(records, templates)]
+        metadata = [fields for fields, _ in split]
+
+        def update_index(index):
+            for fields, template in zip(metadata, templates):
+                index.add(fields, template)
+
+        # The lock file lives in the directory, so it must exist first
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            self._ensure_files()
+            for fields, location in zip(metadata, self._append_thumbnails([thumbnail for _, thumbnail in split])):
+                fields['thumbnail'] = location
+            self._append_templates(templates)
+            for fields, template in zip(metadata, templates):
+                fields['row'] = int(template['row'])
+            self._save(self._records + metadata, update_index, ('add', metadata))
+
+    def remove(self, person_id, expected_version=None):
+        """
+        Remove the enrollment for person_id and save the metadata
+
+        Returns:
+            The removed record or None if no such enrollment exists
+
+        Raises:
+            VersionConflict: If expected_version is no longer current
+        """
+        with self._lock, file_lock(self.path):
+            removed = super().remove(person_id, expected_version)
+            if removed is not None and len(self._templates) - len(self._records) > max(MIN_COMPACT_ROWS, len(self._records)):
+                self._compact()
+            return removed
+
+    def compact(self):
+        """Rewrite the data files without the rows of removed enrollments"""
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            if self._files is not None:
+                self._compact()
+
+    def _compact(self):
+        # Must be called with both locks held and the state refreshed
+        old_files = self._files
+        files = _data_files(old_files['generation'] + 1)
+        self._files = files
+
+        templates = np.array(self._templates[[record['row'] for record in self._records]])
+        templates['row'] = np.arange(len(templates))
+        records = []
+        with open(os.path.join(self.directory, old_files['thumbnails']), 'rb') as source, \
+                open(self._data_path('thumbnails'), 'wb') as target:
+            for row, record in enumerate(self._records):
+                offset, length = record.get('thumbnail') or (0, 0)
+                source.seek(offset)
+                records.append(dict(record, row=row, thumbnail=[target.tell(), length]))
+                target.write(source.read(length))
+        write_templates(self._data_path('templates'), templates)
+
+        self._templates = read_templates(self._data_path('templates'))
+        self._save(records)
+
+        for kind in ('templates', 'thumbnails'):
+            try:
+                os.remove(os.path.join(self.directory, old_files[kind]))
+            except OSError as e:
+                logger.warning(f"Could not remove old enrollment file: {e}")
+        logger.info(f"Compacted enrollment files in {self.directory}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert enrollments.json into an enrollment directory')
+    parser.add_argument('json_path', nargs='?', default='enrollments.json')
+    parser.add_argument('directory', nargs='?', default='enrollments')
+    parser.add_argument('--force', action='store_true', help='overwrite an existing enrollment directory')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        count = migrate_json_enrollments(args.json_path, args.directory, overwrite=args.force)
+    except FileExistsError as e:
+        sys.exit(f"{e}; use --force to overwrite it")
+    print(f"Migrated {count} enrollments to {args.directory}; set ENROLLMENT_FORMAT=binary to use them")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import os
+import csv
+import time
+import uuid
+import logging
+import zipfile
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+import face_utils
+from storage import DEFAULT_CLASS_ID
+
+logger = logging.getLogger(__name__)
+
+# Photos handed to a worker process at a time
+CHUNK_SIZE = 16
+
+# Progress is reported after this many photos
+PROGRESS_INTERVAL = 100
+
+
+def read_roster(path):
+    """
+    Read an import roster
+
+    The roster is a CSV file with a header row and the columns 'image' (the
+    photo's path within the directory or zip, or just its file name if that
+    is unique) and 'name', plus optionally 'class_id' or 'class' (a class
+    name). Rows without an image and name are skipped.
+
+    Returns:
+        List of {'image', 'name', 'class_id', 'class'} dicts, in file order
+
+    Raises:
+        ValueError: If a required column is missing
+    """
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        columns = {(column or '').strip().lower(): column for column in reader.fieldnames or []}
+        missing = [column for column in ('image', 'name') if column not in columns]
+        if missing:
+            raise ValueError(f"The roster has no {' or '.join(repr(column) for column in missing)} column")
+
+        rows = []
+        for row in reader:
+            fields = {key: (row.get(column) or '').strip() for key, column in columns.items()}
+            if fields['image'] and fields['name']:
+                rows.append({
+                    'image': fields['image'],
+                    'name': fields['name'],
+                    'class_id': fields.get('class_id', ''),
+                    'class': fields.get('class', '')
+                })
+        return rows
+
+
+def list_photos(source):
+    """
+    Return the files of a photo directory or zip file
+
+    Returns:
+        List of paths relative to the directory or zip root, with '/'
+        separators, leaving out hidden files and macOS resource forks
+    """
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    else:
+        names = []
+        for root, dirs, files in os.walk(source):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            names.extend(os.path.relpath(os.path.join(root, file), source).replace(os.sep, '/') for file in files)
+    return [name for name in names
+            if not any(part.startswith('.') or part == '__MACOSX' for part in name.split('/'))]
+
+
+def resolve_photos(rows, names):
+    """
+    Find each roster row's photo among names
+
+    Returns:
+        List with the matching name or None for each row
+    """
+    by_path = {name.lower(): name for name in names}
+    by_file = {}
+    for name in names:
+        by_file.setdefault(name.rsplit('/', 1)[-1].lower(), []).append(name)
+
+    photos = []
+    for row in rows:
+        image = row['image'].replace('\\', '/').strip('/').lower()
+        found = by_path.get(image)
+        if found is None:
+            # Accept a bare file name, or a path relative to a single top folder
+            candidates = [name for name in by_file.get(image.rsplit('/', 1)[-1], [])
+                          if name.lower().endswith('/' + image) or '/' not in image]
+            found = candidates[0] if len(candidates) == 1 else None
+        photos.append(found)
+    return photos
+
+
+_archives = {}  # Zip path -> open ZipFile, kept by each worker process
+
+
+def encode_photo(source, name, target_path):
+    """
+    Copy a photo to target_path and extract its face encoding; runs in a worker process
+
+    Returns:
+        Tuple of (encoding or None, error message or None)
+    """
+    try:
+        if source in _archives or zipfile.is_zipfile(source):
+            archive = _archives.get(source)
+            if archive is None:
+                archive = _archives[source] = zipfile.ZipFile(source)
+            data = archive.read(name)
+        else:
+            with open(os.path.join(source, name), 'rb') as f:
+                data = f.read()
+
+        face_encoding = face_utils.extract_face_encoding(data)
+        if face_encoding is None:
+            return None, 'No face detected in the image'
+        with open(target_path, 'wb') as f:
+            f.write(data)
+        return face_encoding, None
+
+    except Exception as e:
+        return None, str(e)
+
+
+def import_enrollments(enrollment_store, classes, source, rows, upload_folder, workers=None, progress=None):
+    """
+    Enroll everyone on a roster from a directory or zip of photos
+
+    The photos are encoded in a pool of worker processes and copied into
+    upload_folder, as /api/enroll does, and all the enrollments are saved
+    with one write at the end, so nothing is enrolled if the import fails.
+
+    Args:
+        enrollment_store: Store to add the enrollments to
+        classes: List of class records, to check class ids and look up class names
+        source: Path of the photo directory or zip file
+        rows: Roster rows, as read_roster returns them
+        upload_folder: Directory the photos are copied into
+        workers: Number of worker processes, defaults to the number of cores
+        progress: Function called as progress(done, total) while photos are encoded
+
+    Returns:
+        Dict with the number of roster rows ('total') and people 'enrolled',
+        the rows that 'failed' with their 'error', the 'seconds' taken and
+        the 'photos_per_second'
+    """
+    started = time.perf_counter()
+    class_ids = {cls['id'] for cls in classes}
+    class_by_name = {cls['name'].lower(): cls['id'] for cls in classes}
+    photos = resolve_photos(rows, list_photos(source))
+    os.makedirs(upload_folder, exist_ok=True)
+
+    failed = []
+    tasks = []  # (row, photo, person id, target path)
+    # Unlike single enrollments, imports create many ids per second, and
+    # imports started in the same second must not collide
+    prefix = f"person_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+    for number, (row, photo) in enumerate(zip(rows, photos), start=1):
+        if photo is None:
+            failed.append({'image': row['image'], 'name': row['name'], 'error': 'Image not found'})
+            continue
+        person_id = f"{prefix}_{number}"
+        extension = os.path.splitext(photo)[1].lower() or '.jpg'
+        tasks.append((row, photo, person_id, os.path.join(upload_folder, secure_filename(person_id + extension))))
+
+    records = []
+    total = len(tasks)
+    workers = workers or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, max(total, 1)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = pool.map(encode_photo, [source] * total, [task[1] for task in tasks],
+                               [task[3] for task in tasks], chunksize=CHUNK_SIZE)
+            for done, (task, (face_encoding, error)) in enumerate(zip(tasks, results), start=1):
+                row, photo, person_id, target_path = task
+                if error is not None:
+                    failed.append({'image': row['image'], 'name': row['name'], 'error': error})
+                else:
+                    class_id = row['class_id'] or class_by_name.get(row['class'].lower(), DEFAULT_CLASS_ID)
+                    if class_id not in class_ids:
+                        class_id = DEFAULT_CLASS_ID  # Fall back to the default class, as /api/enroll does
+                    records.append({
+                        'id': person_id,
+                        'name': row['name'],
+                        'class_id': class_id,
+                        'encoding': face_encoding,
+                        'image_path': target_path,
+                        'enrolled_at': datetime.now().isoformat()
+                    })
+                if progress is not None and (done % PROGRESS_INTERVAL == 0 or done == total):
+                    progress(done, total)
+
+        enrollment_store.add_many(records)
+    except BaseException:
+        # Nothing was enrolled; drop the photos copied so far
+        for task in tasks:
+            try:
+                os.remove(task[3])
+            except OSError:
+                pass
+        raise
+
+    seconds = time.perf_counter() - started
+    logger.info(f"Imported {len(records)} of {len(rows)} enrollments from {source} in {seconds:.1f}s")
+    return {
+        'total': len(rows),
+        'enrolled': len(records),
+        'failed': failed,
+        'seconds': seconds,
+        'photos_per_second': total / seconds if seconds else 0.0
+    }
+
+
+class ImportJob:
+    """
+    An import_enrollments run on a background thread
+
+    Each job has a random id; its progress and result are only known to the
+    process that started it.
+    """
+
+    def __init__(self, *args, cleanup=None, **kwargs):
+        self.id = uuid.uuid4().hex
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.finished_at = None  # time.monotonic() once the job is over
+        self._started = time.perf_counter()
+        self._cleanup = cleanup
+        kwargs['progress'] = self._progress
+        self._thread = threading.Thread(target=self._run, args=args, kwargs=kwargs, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _progress(self, done, total):
+        self.done, self.total = done, total
+
+    def _run(self, *args, **kwargs):
+        try:
+            self.result = import_enrollments(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Bulk enrollment import failed")
+            self.error = str(e)
+        finally:
+            if self._cleanup is not None:
+                self._cleanup()
+            self.finished_at = time.monotonic()
+
+    def status(self):
+        """Return the job's status and progress as a dict"""
+        if self.error is not None:
+            return {'status': 'failed', 'error': self.error}
+        if self.result is not None:
+            return dict(self.result, status='done')
+        seconds = time.perf_counter() - self._started
+        return {
+            'status': 'running',
+            'done': self.done,
+            'total': self.total,
+            'photos_per_second': self.done / seconds if seconds else 0.0
+        }
+
+
+class ImportJobs:
+    """
+    The ImportJobs started by this process, by id
+
+    Running jobs are always kept. Finished ones, whose results can hold a
+    failure per roster row, are dropped after ttl seconds, and beyond the
+    max_finished most recent.
+    """
+
+    def __init__(self, ttl=3600, max_finished=20):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def start(self, job):
+        """Start a job and keep it for get()"""
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job.start()
+
+    def get(self, job_id):
+        """Return a job by id, or None if unknown or dropped"""
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        # Must be called with the lock held
+        now = time.monotonic()
+        finished = sorted((job.finished_at, job_id) for job_id, job in self._jobs.items()
+                          if job.finished_at is not None)
+        for position, (finished_at, job_id) in enumerate(finished):
+            if now - finished_at > self.ttl or position < len(finished) - self.max_finished:
+                del self._jobs[job_id]
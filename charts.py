@@ -0,0 +1,205 @@
+import io
+import os
+import glob
+import json
+import hashlib
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Bump when the chart styling changes so cached images are not reused
+CHART_FORMAT_VERSION = 1
+
+# Seconds to wait after a data change before re-rendering, so a burst of
+# changes (a class taking attendance) renders once
+RENDER_DELAY = 5.0
+
+
+def _new_figure():
+    # matplotlib is imported on first use; it is a large part of the app's
+    # start-up time and most processes never draw a chart
+    from matplotlib.figure import Figure
+    return Figure(figsize=(10, 5))
+
+
+def _png(fig):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    output = io.BytesIO()
+    FigureCanvas(fig).print_png(output)
+    return output.getvalue()
+
+
+def attendance_by_date_png(data):
+    """Render daily attendance counts, given [[date, count], ...]"""
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.bar([date for date, _ in data], [count for _, count in data], color='skyblue')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Attendance Count')
+    ax.set_title('Daily Attendance')
+
+    # Rotate date labels for better readability
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    return _png(fig)
+
+
+def enrollment_by_class_png(data):
+    """Render enrollment counts, given [[class name, count], ...]"""
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.bar([label for label, _ in data], [count for _, count in data], color='lightgreen')
+    ax.set_xlabel('Class')
+    ax.set_ylabel('Number of Students')
+    ax.set_title('Enrollments by Class')
+
+    # Rotate labels if there are many classes
+    if len(data) > 3:
+        ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    return _png(fig)
+
+
+def error_png():
+    """Render the placeholder shown when a chart can't be generated"""
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.text(0.5, 0.5, 'Error generating chart', ha='center', va='center')
+    ax.set_axis_off()
+    return _png(fig)
+
+
+class ChartCache:
+    """
+    PNG charts rendered in the background and kept as files
+
+    Each chart is registered with a function returning its data and one
+    rendering that data. Images are stored in `directory` as
+    <name>-<key>.png, where the key hashes the data, so every process
+    serving the app shares them and a chart is only rendered again when
+    what it shows changes. invalidate() (hooked up to the stores' change
+    events) queues a re-render of the charts this process has served on a
+    background thread; a request that finds the data changed before that
+    is done gets the previous image and queues the render itself, and
+    later requests for the same data version just check whether the new
+    image exists yet. Only the very first image of a chart is rendered
+    during a request. A render keeps the image it replaces, which may be
+    being served, and removes the older ones.
+    """
+
+    def __init__(self, directory, charts):
+        """
+        Args:
+            directory: Directory for the images
+            charts: Dict of chart name -> (data function, render function);
+                the data must be JSON-serializable and the render function
+                returns PNG bytes for it
+        """
+        self.directory = directory
+        self.charts = charts
+        self._lock = threading.Lock()
+        self._current = {}  # Name -> (version, key of the image served, key of that version's data)
+        self._pending = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, key):
+        return os.path.join(self.directory, f"{name}-{key}.png")
+
+    def _key(self, data):
+        material = json.dumps([CHART_FORMAT_VERSION, data], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]
+
+    def _render(self, name, data, key):
+        """Write the image for data and remove the chart's images older than the one it replaces"""
+        path = self.path(name, key)
+        previous_key = self._latest(name)
+        previous_path = self.path(name, previous_key) if previous_key is not None else None
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.charts[name][1](data))
+        os.replace(tmp_path, path)
+
+        for old_path in glob.glob(self.path(name, '*')):
+            if old_path not in (path, previous_path):
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def _latest(self, name):
+        """Return the key of the chart's newest image on disk, or None"""
+        paths = glob.glob(self.path(name, '*'))
+        if not paths:
+            return None
+        path = max(paths, key=os.path.getmtime)
+        return os.path.basename(path)[len(name) + 1:-len('.png')]
+
+    def lookup(self, name, version):
+        """
+        Return (path, key) of the image to serve for a chart
+
+        Args:
+            name: Chart name
+            version: Cheap token that changes whenever the chart's data may
+                have; the data is only gathered and hashed when it does
+
+        Returns:
+            The image for the current data if it exists, otherwise the
+            previous image (with a re-render queued), otherwise one
+            rendered now
+        """
+        with self._lock:
+            current = self._current.get(name)
+        if current is not None and current[0] == version:
+            served_key, key = current[1:]
+            if key != served_key and os.path.exists(self.path(name, key)):
+                # The image for this version has been rendered since
+                served_key = key
+                with self._lock:
+                    self._current[name] = (version, key, key)
+            if os.path.exists(self.path(name, served_key)):
+                return self.path(name, served_key), served_key
+
+        data = self.charts[name][0]()
+        key = self._key(data)
+        if not os.path.exists(self.path(name, key)):
+            stale_key = self._latest(name)
+            if stale_key is not None:
+                with self._lock:
+                    self._current[name] = (version, stale_key, key)
+                self.invalidate()
+                return self.path(name, stale_key), stale_key
+            self._render(name, data, key)
+
+        with self._lock:
+            self._current[name] = (version, key, key)
+        return self.path(name, key), key
+
+    def invalidate(self, *args):
+        """Queue a background re-render of the charts served so far; usable as a store listener"""
+        with self._lock:
+            if not self._current:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chart-renderer', daemon=True)
+                self._thread.start()
+        self._pending.set()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            time.sleep(RENDER_DELAY)
+            self._pending.clear()
+            with self._lock:
+                names = list(self._current)
+            for name in names:
+                try:
+                    data = self.charts[name][0]()
+                    key = self._key(data)
+                    if not os.path.exists(self.path(name, key)):
+                        self._render(name, data, key)
+                except Exception:
+                    logger.exception(f"Error rendering chart {name}")
@@ -0,0 +1,86 @@
+import re
+from datetime import datetime, timedelta
+
+# Periods a question can name, matched as whole phrases
+PERIOD_PATTERN = re.compile(r'\b(today|yesterday|this week|last week|this month|last month)\b')
+
+# Intents in the order they are tried, with the pattern recognizing them and
+# the period assumed when the question names none (None for questions that
+# aren't about dates). A group in the pattern captures a day count.
+INTENTS = [
+    ('list_classes', re.compile(r'which classes|list classes'), None),
+    ('attendance_rate', re.compile(r'attendance rate'), 'this month'),
+    ('absent_days', re.compile(r'absent (?:for )?(?:at least )?(\d+) (?:or more )?days?'), 'this week'),
+    ('present', re.compile(r'who (?:was|is|were) present|who attended'), 'today'),
+    ('absent', re.compile(r'who (?:was|is|were) absent|who missed'), 'today'),
+    ('total_students', re.compile(r'total student|how many student'), None),
+    ('list_students', re.compile(r'student names|list students'), None),
+]
+
+# Intents that don't depend on the selected class
+UNSCOPED_INTENTS = {'list_classes', 'help'}
+
+
+def period_dates(period, today):
+    """
+    Return the first and last date of a named period
+
+    Periods that include today end today rather than at their calendar end,
+    and 'last week' is the Monday to Sunday before the current week.
+    """
+    if period == 'today':
+        return today, today
+    if period == 'yesterday':
+        yesterday = today - timedelta(days=1)
+        return yesterday, yesterday
+    if period == 'this week':
+        return today - timedelta(days=today.weekday()), today
+    if period == 'last week':
+        start = today - timedelta(days=today.weekday() + 7)
+        return start, start + timedelta(days=6)
+    if period == 'this month':
+        return today.replace(day=1), today
+    if period == 'last month':
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    raise ValueError(f"Unknown period {period!r}")
+
+
+def parse_query(query, class_id=None, today=None):
+    """
+    Normalize a chatbot question into the key of what it asks
+
+    Different wordings of the same question give the same key, so keys can
+    be used to cache answers.
+
+    Args:
+        query: The question as typed
+        class_id: Class selected alongside the question, if any
+        today: Date the question is asked on, defaults to the current date
+
+    Returns:
+        Tuple of (intent, class id, period, first date, last date, days):
+        the period and ISO dates are None for questions not about dates and
+        days is the count of 'absent N days' questions. Unrecognized
+        questions give the 'help' intent.
+    """
+    query = ' '.join(query.lower().split())
+    for intent, pattern, default_period in INTENTS:
+        match = pattern.search(query)
+        if match:
+            break
+    else:
+        intent, match, default_period = 'help', None, None
+
+    if intent in UNSCOPED_INTENTS:
+        class_id = None
+    days = int(match.group(1)) if match and match.groups() else None
+
+    period = date_from = date_to = None
+    if default_period is not None:
+        named = PERIOD_PATTERN.search(query)
+        period = named.group(1) if named else default_period
+        first, last = period_dates(period, today or datetime.now().date())
+        date_from, date_to = first.isoformat(), last.isoformat()
+
+    return intent, class_id or None, period, date_from, date_to, days
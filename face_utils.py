@@ -2,80 +2,171 @@ import logging
 import os
 import hashlib
 import base64
+import io
 import math
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
-def extract_face_encoding(image_path):
+# Feature layout and score weights used for matching
+PHASH_BITS = 64
+REGION_COUNT = 16
+PHASH_WEIGHT = 0.8
+REGION_WEIGHT = 0.2
+HASH_BOOST = 0.2
+
+# Number of leading image bytes kept as the enrollment thumbnail
+THUMBNAIL_BYTES = 4096
+
+# Number of most promising rows FaceIndex scores before pruning the rest
+PRUNE_BATCH = 64
+
+# Multi-index hashing over the pHash: the 64 bits are split into bands and
+# any hash within distance r of the query matches at least one band within
+# r // PHASH_BANDS bits (pigeonhole). The band tables are only used when the
+# number of probes per band stays small enough to beat a linear scan.
+PHASH_BANDS = 4
+BAND_BITS = PHASH_BITS // PHASH_BANDS
+MAX_BAND_PROBES = 256
+MIN_BAND_ROWS = 2048
+
+# Fixed-width matching template of one enrollment: the packed pHash, the
+# region values and their count, and the MD5 digest of the image. 'row'
+# links a template to its enrollment where the two are stored apart.
+TEMPLATE_DTYPE = np.dtype([
+    ('phash', '<u8'),
+    ('regions', '<f4', (REGION_COUNT,)),
+    ('digest', '<u8', (2,)),
+    ('row', '<u4'),
+    ('region_count', 'u1'),
+    ('flags', 'u1'),
+    ('reserved', 'V2'),
+])
+
+# Template flags: PACKED templates are scored from the template alone,
+# IRREGULAR ones don't fit the layout and need the full encoding
+TEMPLATE_PACKED = 1
+TEMPLATE_IRREGULAR = 2
+
+def _read_exact(stream, size):
+    """Read up to size bytes, looping over short reads until EOF"""
+    data = stream.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+def _encode_chunks(chunks, chunk_size):
+    """
+    Build the face encoding from consecutive chunk_size pieces of an image
+
+    The whole-image hash, the chunk hashes for the perceptual hash, the
+    region averages and the thumbnail are all computed in one pass.
+    """
+    hash_obj = hashlib.md5()
+    perceptual_hash = ""
+    region_values = []
+    thumbnail_parts = []
+    thumbnail_remaining = THUMBNAIL_BYTES
+
+    for index, chunk in enumerate(chunks):
+        hash_obj.update(chunk)
+
+        # Take the first 8 bits of the hash of each of the first 8 chunks
+        if index < 8:
+            perceptual_hash += format(hashlib.md5(chunk).digest()[0], '08b')
+
+        # For region values, use the average byte value
+        if index < REGION_COUNT:
+            region_sum = int(np.frombuffer(chunk, dtype=np.uint8).sum(dtype=np.uint64))
+            region_values.append(region_sum / len(chunk))
+
+        # Keep the first part of the image as a small thumbnail for reference
+        if thumbnail_remaining:
+            thumbnail_parts.append(bytes(chunk[:thumbnail_remaining]))
+            thumbnail_remaining -= len(thumbnail_parts[-1])
+
+    # Ensure we have a 64-bit hash (if fewer chunks, pad with zeros)
+    perceptual_hash = perceptual_hash[:PHASH_BITS].ljust(PHASH_BITS, '0')
+    thumbnail = base64.b64encode(b''.join(thumbnail_parts)).decode('utf-8')
+
+    return {
+        'hash': hash_obj.hexdigest(),
+        'thumbnail': thumbnail,
+        'features': {
+            'phash': perceptual_hash,
+            'regions': region_values
+        }
+    }
+
+def extract_face_encoding(image_source):
     """
     Generate a simple image hash for comparison
     
+    The image is split into 16 chunks (simulating regions) which are hashed
+    and averaged as they are read, so files and upload streams are never
+    held in memory as a whole.
+    
     Args:
-        image_path: Path to image file
+        image_source: Path to an image file, the image bytes, or a binary
+            file-like object such as an upload stream
         
     Returns:
         Image hash for comparison
     """
     try:
-        # Load the image data
-        with open(image_path, 'rb') as f:
-            img_data = f.read()
-        
-        # Calculate a hash of chunks of the image data (simulating regions)
-        # This is a very simplistic approach but doesn't require external libraries
-        chunk_size = len(img_data) // 16  # Divide into 16 chunks
-        if chunk_size < 1:
-            chunk_size = 1
-            
-        chunks = []
-        region_values = []
+        if isinstance(image_source, (bytes, bytearray, memoryview)):
+            data = memoryview(image_source)
+            chunk_size = max(len(data) // 16, 1)
+            chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+            return _encode_chunks(chunks, chunk_size)
         
-        # Calculate hash for each chunk
-        for i in range(0, len(img_data), chunk_size):
-            chunk = img_data[i:i+chunk_size]
-            chunk_hash = hashlib.md5(chunk).hexdigest()
-            chunks.append(chunk_hash)
-            
-            # For region values, use the average byte value
-            avg_val = sum(byte for byte in chunk) / len(chunk) if chunk else 0
-            region_values.append(avg_val)
-        
-        # Create a simulated perceptual hash from these chunks
-        perceptual_hash = ""
-        for chunk_hash in chunks[:8]:  # Use first 8 chunks
-            # Take first 8 bits of each chunk hash
-            for c in chunk_hash[:2]:  # First 2 hex chars = 8 bits
-                # Convert hex char to binary representation
-                bin_val = bin(int(c, 16))[2:].zfill(4)  # Get 4 bits
-                perceptual_hash += bin_val
-        
-        # Ensure we have a 64-bit hash (if fewer chunks, repeat)
-        perceptual_hash = perceptual_hash[:64].ljust(64, '0')
+        if isinstance(image_source, (str, os.PathLike)):
+            with open(image_source, 'rb') as f:
+                return _encode_stream(f, os.fstat(f.fileno()).st_size)
         
-        # Create a traditional hash
-        hash_obj = hashlib.md5(img_data)
-        image_hash = hash_obj.hexdigest()
-        
-        # Create a small thumbnail for reference (use base64 of first part of image)
-        thumbnail_data = img_data[:4096] if len(img_data) > 4096 else img_data
-        thumbnail = base64.b64encode(thumbnail_data).decode('utf-8')
-        
-        # Create features for comparison
-        features = {
-            'phash': perceptual_hash,
-            'regions': region_values[:16]  # Limit to 16 regions
-        }
-            
-        return {
-            'hash': image_hash,
-            'thumbnail': thumbnail,
-            'features': features
-        }
+        # A file-like object; its length is needed up front for the chunk size
+        if not image_source.seekable():
+            return extract_face_encoding(image_source.read())
+        start = image_source.tell()
+        size = image_source.seek(0, io.SEEK_END) - start
+        image_source.seek(start)
+        return _encode_stream(image_source, size)
     
     except Exception as e:
-        logger.exception(f"Error processing image from {image_path}")
+        logger.exception(f"Error processing image from {image_source!r}")
         return None
 
+def hash_image(image_source):
+    """
+    Return the MD5 hex digest of an image, the same value as the 'hash' of its encoding
+    
+    Args:
+        image_source: The image bytes or a seekable binary file-like object,
+            which is rewound to its starting position afterwards
+    """
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        return hashlib.md5(image_source).hexdigest()
+    
+    start = image_source.tell()
+    hash_obj = hashlib.md5()
+    for block in iter(lambda: image_source.read(1024 * 1024), b''):
+        hash_obj.update(block)
+    image_source.seek(start)
+    return hash_obj.hexdigest()
+
+def _encode_stream(stream, size):
+    chunk_size = max(size // 16, 1)
+    chunks = iter(lambda: _read_exact(stream, chunk_size), b'')
+    return _encode_chunks(chunks, chunk_size)
+
 def calculate_hamming_distance(hash1, hash2):
     """Calculate Hamming distance between two binary strings"""
     if len(hash1) != len(hash2):
@@ -83,6 +174,56 @@ def calculate_hamming_distance(hash1, hash2):
     
     return sum(c1 != c2 for c1, c2 in zip(hash1, hash2))
 
+def pack_phash(phash):
+    """Pack a 64-character '0'/'1' perceptual hash into an int, or None if malformed"""
+    if not isinstance(phash, str) or len(phash) != PHASH_BITS or phash.strip('01'):
+        return None
+    return int(phash, 2)
+
+def pack_digest(image_hash):
+    """Pack a 32-character lowercase hex MD5 digest into two uint64 words, or None if malformed"""
+    if not isinstance(image_hash, str) or len(image_hash) != 32 or image_hash.strip('0123456789abcdef'):
+        return None
+    return np.frombuffer(bytes.fromhex(image_hash), dtype='<u8')
+
+def pack_templates(encodings):
+    """
+    Pack face encodings into an array of TEMPLATE_DTYPE records
+    
+    Encodings without a perceptual hash get no flags. Those that don't fit
+    the fixed-width layout (a malformed pHash or image hash, or more than
+    REGION_COUNT regions) are flagged TEMPLATE_IRREGULAR.
+    """
+    templates = np.zeros(len(encodings), dtype=TEMPLATE_DTYPE)
+    templates['row'] = np.arange(len(encodings))
+    phashes, regions, digests = templates['phash'], templates['regions'], templates['digest']
+    region_counts, flags = templates['region_count'], templates['flags']
+    
+    for i, encoding in enumerate(encodings):
+        if not encoding or 'features' not in encoding or 'phash' not in encoding['features']:
+            continue
+        
+        features = encoding['features']
+        phash = pack_phash(features['phash'])
+        digest = pack_digest(encoding.get('hash'))
+        values = features.get('regions', [])
+        if phash is None or digest is None or len(values) > REGION_COUNT:
+            flags[i] = TEMPLATE_IRREGULAR
+            continue
+        try:
+            regions[i, :len(values)] = values
+        except (TypeError, ValueError):
+            regions[i] = 0
+            flags[i] = TEMPLATE_IRREGULAR
+            continue
+        
+        phashes[i] = phash
+        digests[i] = digest
+        region_counts[i] = len(values)
+        flags[i] = TEMPLATE_PACKED
+    
+    return templates
+
 def calculate_region_similarity(regions1, regions2):
     """Calculate similarity between region features using Euclidean distance"""
     if len(regions1) != len(regions2):
@@ -99,14 +240,517 @@ def calculate_region_similarity(regions1, regions2):
     
     return similarity
 
-def find_matching_face(face_encoding, enrollments, tolerance=0.60):
+def score_enrollment(face_encoding, enrollment):
+    """
+    Score a face encoding against a single enrollment
+    
+    Returns:
+        Combined similarity score, or None if the two can't be compared
+    """
+    if 'encoding' not in enrollment or 'features' not in enrollment['encoding']:
+        return None
+        
+    enrollment_features = enrollment['encoding']['features']
+    
+    # Check for required features
+    if 'phash' not in enrollment_features:
+        return None
+        
+    query_features = face_encoding['features']
+    query_phash = query_features.get('phash')
+    query_regions = query_features.get('regions', [])
+    enroll_phash = enrollment_features['phash']
+    enroll_regions = enrollment_features.get('regions', [])
+    
+    # Calculate hamming distance for perceptual hash (smaller is better)
+    hamming_dist = calculate_hamming_distance(query_phash, enroll_phash)
+    if hamming_dist < 0:  # invalid comparison
+        return None
+        
+    # Convert to similarity score (0-1 range, where 1 is identical)
+    # For 64-bit hash, max distance is 64
+    phash_similarity = 1 - (hamming_dist / PHASH_BITS)
+    
+    # Calculate region similarity (if available)
+    region_similarity = 0
+    if query_regions and enroll_regions:
+        region_similarity = calculate_region_similarity(query_regions, enroll_regions)
+    
+    # Check if traditional hash matches exactly - if so, boost the score
+    hash_boost = 0.0
+    if face_encoding.get('hash') == enrollment['encoding'].get('hash'):
+        hash_boost = HASH_BOOST  # Big boost for exact match
+        
+    # Combine scores (weighted average), giving most importance to the
+    # perceptual hash, plus the potential boost
+    return (PHASH_WEIGHT * phash_similarity) + (REGION_WEIGHT * region_similarity) + hash_boost
+
+class FaceIndex:
+    """
+    Matcher index over a list of enrollment records
+
+    Each enrollment's features are packed into a fixed-width template (see
+    TEMPLATE_DTYPE): the perceptual hashes go into a uint64 array and the
+    region values into a float32 matrix so that a query can be scored
+    against every enrollment in a single NumPy pass. Scores are the same as
+    the per-enrollment comparison in score_enrollment (up to the float32
+    rounding of the stored region values). Enrollments whose features can't
+    be packed are kept aside and scored with score_enrollment directly.
+
+    Rows are also partitioned by class so that a class-filtered search only
+    touches that class's rows. The index can be updated in place as
+    enrollments are added, removed or moved between classes; rows keep the
+    order of the enrollment list, which decides ties.
+    """
+
+    def __init__(self, enrollments=(), templates=None):
+        """
+        Args:
+            enrollments: Enrollment records, in match priority order
+            templates: TEMPLATE_DTYPE array aligned with enrollments, e.g.
+                read from a template file; packed from each record's
+                'encoding' if not given
+        """
+        self.enrollments = list(enrollments)
+        if templates is None:
+            templates = pack_templates([enrollment.get('encoding') for enrollment in self.enrollments])
+        self._load(templates)
+        self.row_of = {enrollment['id']: row for row, enrollment in enumerate(self.enrollments)}
+        self.partitions = {}   # Class id -> ascending array of rows
+        self._removed = 0
+        self._bands = None     # Multi-index band tables, built on first use
+        self._digest_table = None  # Rows sorted by image digest, built on first use
+
+        partitions = {}
+        for row, enrollment in enumerate(self.enrollments):
+            partitions.setdefault(_class_of(enrollment), []).append(row)
+        for class_id, rows in partitions.items():
+            self._set_partition(class_id, rows)
+
+    def _load(self, templates):
+        self.phashes = np.ascontiguousarray(templates['phash'])
+        self.regions = templates['regions']  # Left as a view, e.g. of a memory-mapped file
+        self.region_counts = templates['region_count'].astype(np.int8)
+        self.digests = np.ascontiguousarray(templates['digest'])
+        self.packed = (templates['flags'] & TEMPLATE_PACKED).astype(bool)
+        self.irregular = (templates['flags'] & TEMPLATE_IRREGULAR).astype(bool)  # Rows that need the scalar scoring path
+
+    def _allocate(self, capacity):
+        self.phashes = np.zeros(capacity, dtype=np.uint64)
+        self.regions = np.zeros((capacity, REGION_COUNT), dtype=np.float32)
+        self.region_counts = np.zeros(capacity, dtype=np.int8)
+        self.digests = np.zeros((capacity, 2), dtype=np.uint64)
+        self.packed = np.zeros(capacity, dtype=bool)
+        self.irregular = np.zeros(capacity, dtype=bool)
+
+    def _columns(self):
+        return (self.phashes, self.regions, self.region_counts, self.digests, self.packed, self.irregular)
+
+    def _grow(self):
+        size = len(self.enrollments)
+        old_arrays = self._columns()
+        self._allocate(max(2 * size, 16))
+        for new_array, old_array in zip(self._columns(), old_arrays):
+            new_array[:size] = old_array[:size]
+
+    def _append(self, enrollment, template):
+        """Add a row for enrollment, without touching the partitions"""
+        row = len(self.enrollments)
+        if row == len(self.phashes):
+            self._grow()
+        self.enrollments.append(enrollment)
+        self.row_of[enrollment['id']] = row
+        self._pack(row, template)
+        return row
+
+    def _pack(self, row, template):
+        """Store a TEMPLATE_DTYPE record in row"""
+        self.phashes[row] = template['phash']
+        self.regions[row] = template['regions']
+        self.region_counts[row] = template['region_count']
+        self.digests[row] = template['digest']
+        self.packed[row] = bool(template['flags'] & TEMPLATE_PACKED)
+        self.irregular[row] = bool(template['flags'] & TEMPLATE_IRREGULAR)
+
+    def templates(self, rows):
+        """Return the TEMPLATE_DTYPE records of rows, numbered from 0"""
+        rows = np.asarray(rows, dtype=np.intp)
+        templates = np.zeros(len(rows), dtype=TEMPLATE_DTYPE)
+        templates['phash'] = self.phashes[rows]
+        templates['regions'] = self.regions[rows]
+        templates['digest'] = self.digests[rows]
+        templates['row'] = np.arange(len(rows))
+        templates['region_count'] = self.region_counts[rows]
+        templates['flags'] = (self.packed[rows] * TEMPLATE_PACKED) | (self.irregular[rows] * TEMPLATE_IRREGULAR)
+        return templates
+
+    def _set_partition(self, class_id, rows):
+        if len(rows):
+            self.partitions[class_id] = np.asarray(rows, dtype=np.intp)
+        else:
+            self.partitions.pop(class_id, None)
+
+    def __len__(self):
+        return len(self.row_of)
+
+    # Updates
+
+    def add(self, enrollment, template=None):
+        """
+        Add a new enrollment after all existing ones
+
+        Args:
+            template: TEMPLATE_DTYPE record with the enrollment's features;
+                packed from its 'encoding' if not given
+        """
+        if template is None:
+            template = pack_templates([enrollment.get('encoding')])[0]
+        row = self._append(enrollment, template)
+        class_id = _class_of(enrollment)
+        self._set_partition(class_id, np.append(self.partitions.get(class_id, []), row))
+
+    def remove(self, person_id):
+        """Remove the enrollment for person_id, if present"""
+        row = self.row_of.pop(person_id, None)
+        if row is None:
+            return
+        class_id = _class_of(self.enrollments[row])
+        partition = self.partitions[class_id]
+        self._set_partition(class_id, partition[partition != row])
+        self.packed[row] = False
+        self.irregular[row] = False
+        self.enrollments[row] = None
+        self._removed += 1
+
+        # Reclaim the space once most rows have been removed
+        if self._removed > len(self.row_of):
+            live = [row for row, enrollment in enumerate(self.enrollments) if enrollment is not None]
+            self.__init__([self.enrollments[row] for row in live], self.templates(live))
+
+    def update(self, enrollments, repack=True):
+        """
+        Replace existing enrollments (matched by id), e.g. after a class change
+
+        Args:
+            repack: Re-read the features from each record's 'encoding';
+                pass False to keep the stored features, e.g. for records
+                that don't carry their encoding
+        """
+        moved_out = {}
+        moved_in = {}
+        for enrollment in enrollments:
+            row = self.row_of.get(enrollment['id'])
+            if row is None:
+                continue
+            old_class, new_class = _class_of(self.enrollments[row]), _class_of(enrollment)
+            if old_class != new_class:
+                moved_out.setdefault(old_class, []).append(row)
+                moved_in.setdefault(new_class, []).append(row)
+            self.enrollments[row] = enrollment
+            if repack:
+                self._pack(row, pack_templates([enrollment.get('encoding')])[0])
+                self._bands = None
+                self._digest_table = None
+
+        for class_id, rows in moved_out.items():
+            partition = self.partitions[class_id]
+            self._set_partition(class_id, partition[~np.isin(partition, rows)])
+        for class_id, rows in moved_in.items():
+            self._set_partition(class_id, np.sort(np.append(self.partitions.get(class_id, []), rows)))
+
+    def _hash_rows(self, image_hash):
+        """Return the ascending packed rows whose image hash is image_hash"""
+        digest = pack_digest(image_hash)
+        if digest is None:
+            return np.zeros(0, dtype=np.intp)
+
+        # Rows added since the table was built are checked directly
+        size = len(self.enrollments)
+        if self._digest_table is None or size - len(self._digest_table[1]) > len(self._digest_table[1]) // 8:
+            order = np.argsort(self.digests[:size, 0], kind='stable')
+            self._digest_table = (self.digests[order, 0], order)
+        keys, order = self._digest_table
+        start, end = np.searchsorted(keys, digest[0], side='left'), np.searchsorted(keys, digest[0], side='right')
+        rows = np.concatenate([order[start:end], np.arange(len(order), size)])
+        rows = rows[self.packed[rows] & (self.digests[rows, 0] == digest[0]) & (self.digests[rows, 1] == digest[1])]
+        return np.sort(rows)
+
+    # Multi-index pHash search
+
+    def _band_radius(self, threshold):
+        """
+        Return the per-band search radius implied by threshold, or None if
+        a linear scan is cheaper
+        """
+        if len(self.enrollments) < MIN_BAND_ROWS:
+            return None
+
+        # Largest Hamming distance at which a row could still beat the
+        # threshold with a perfect region score (exact-hash rows are added
+        # separately)
+        radius = -1
+        for distance in range(PHASH_BITS + 1):
+            if (PHASH_WEIGHT * (1 - (distance / PHASH_BITS))) + REGION_WEIGHT > threshold:
+                radius = distance
+        band_radius = max(radius, 0) // PHASH_BANDS
+        if len(_band_masks(band_radius)) > MAX_BAND_PROBES:
+            return None
+        return band_radius
+
+    def _build_bands(self):
+        """Sort the band values of all packed rows for range lookups"""
+        size = len(self.enrollments)
+        rows = np.flatnonzero(self.packed[:size])
+        tables = []
+        for band in range(PHASH_BANDS):
+            keys = (self.phashes[rows] >> np.uint64(band * BAND_BITS)) & np.uint64((1 << BAND_BITS) - 1)
+            order = np.argsort(keys, kind='stable')
+            tables.append((keys[order], rows[order]))
+        self._bands = {
+            'size': size,
+            'tables': tables,
+            'irregular': np.flatnonzero(self.irregular[:size])
+        }
+
+    def _band_candidates(self, face_encoding, query_phash, band_radius):
+        """
+        Return the ascending rows that could be within the search radius of
+        query_phash, plus the rows that always have to be scored
+        """
+        # Rows added since the tables were built are scanned directly;
+        # rebuild once they are a sizeable share of the index
+        if self._bands is None or len(self.enrollments) - self._bands['size'] > self._bands['size'] // 8:
+            self._build_bands()
+
+        masks = _band_masks(band_radius)
+        found = [
+            self._bands['irregular'],
+            np.arange(self._bands['size'], len(self.enrollments)),
+            self._hash_rows(face_encoding.get('hash'))
+        ]
+        for band, (keys, rows) in enumerate(self._bands['tables']):
+            query_key = (query_phash >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1)
+            probes = np.uint64(query_key) ^ masks
+            starts = np.searchsorted(keys, probes, side='left')
+            lengths = np.searchsorted(keys, probes, side='right') - starts
+            total = int(lengths.sum())
+            if total:
+                # Concatenate the ranges keys[start:start + length]
+                offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+                found.append(rows[offsets])
+        return np.unique(np.concatenate(found).astype(np.intp))
+
+    # Searching
+
+    def _select(self, class_id):
+        """Return the rows to search for a class filter, or None for all rows (no class_id)"""
+        if not class_id:
+            return None
+        return self.partitions.get(class_id, np.zeros(0, dtype=np.intp))
+
+    def _phash_similarity(self, query_phashes, rows=None):
+        """Return the pHash similarity of each query (rows) to each selected enrollment (columns)"""
+        phashes = self.phashes[:len(self.enrollments)] if rows is None else self.phashes[rows]
+        query_phashes = np.asarray(query_phashes, dtype=np.uint64)
+        return 1 - (np.bitwise_count(phashes[np.newaxis, :] ^ query_phashes[:, np.newaxis]) / PHASH_BITS)
+
+    def _score_packed(self, face_encoding, phash_similarity, query_regions, threshold, rows):
+        """
+        Score the packed rows that could be the best match or the runner-up
+
+        Args:
+            rows: Ascending array of rows to consider, or None for all rows
+
+        Returns:
+            Tuple of (rows, scores) as NumPy arrays, rows in ascending order
+        """
+        selection = slice(0, len(self.enrollments)) if rows is None else rows
+        count = len(phash_similarity)
+
+        hash_boost = np.zeros(count)
+        boosted_rows = self._hash_rows(face_encoding.get('hash'))
+        if len(boosted_rows):
+            if rows is None:
+                hash_boost[boosted_rows] = HASH_BOOST
+            else:
+                hash_boost[np.isin(rows, boosted_rows)] = HASH_BOOST
+
+        # Region similarity is only defined when both sides have the same
+        # number of regions, and it is at most 1, which bounds the score
+        query_count = len(query_regions)
+        if query_count:
+            comparable = self.region_counts[selection] == query_count
+        else:
+            comparable = np.zeros(count, dtype=bool)
+        upper_bound = (PHASH_WEIGHT * phash_similarity) + (REGION_WEIGHT * comparable) + hash_boost
+        local = np.flatnonzero(self.packed[selection] & (upper_bound > threshold))
+
+        def score_rows(local):
+            region_similarity = np.zeros(len(local))
+            if query_count:
+                region_rows = comparable[local]
+                region_local = local[region_rows]
+                region_global = region_local if rows is None else rows[region_local]
+                diff = self.regions[region_global, :query_count].astype(np.float64) - np.asarray(query_regions, dtype=np.float64)
+                euclidean_dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+                max_possible_dist = math.sqrt(query_count * (255 ** 2))
+                region_similarity[region_rows] = 1 - (euclidean_dist / max_possible_dist)
+            return (PHASH_WEIGHT * phash_similarity[local]) + (REGION_WEIGHT * region_similarity) + hash_boost[local]
+
+        if len(local) > PRUNE_BATCH:
+            # Score the most promising rows first; rows whose upper bound
+            # can't reach the runner-up found there can't be best or runner-up
+            top = local[np.argpartition(-upper_bound[local], PRUNE_BATCH)[:PRUNE_BATCH]]
+            cutoff = np.partition(score_rows(top), -2)[-2]
+            local = local[upper_bound[local] >= cutoff]
+
+        scores = score_rows(local)
+        return (local if rows is None else rows[local]), scores
+
+    def search(self, face_encoding, tolerance=0.60, class_id=None, phash_similarity=None):
+        """
+        Score a face encoding against the enrollments in the index
+
+        Args:
+            face_encoding: Face encoding with 'features' (and usually 'hash')
+            tolerance: Similarity threshold (0-1), higher means more lenient
+            class_id: Only consider enrollments in this class
+            phash_similarity: Precomputed pHash similarities to the selected
+                rows, as computed by search_batch
+
+        Returns:
+            Dict with the best 'match' (or None) and its 'score', plus the
+            'runner_up' and its 'runner_up_score' among the enrollments
+            that could pass the threshold
+        """
+        result = {'match': None, 'score': 0.0, 'runner_up': None, 'runner_up_score': 0.0, 'closest': None}
+
+        features = face_encoding.get('features', {})
+        query_phash = features.get('phash')
+        query_regions = features.get('regions', [])
+
+        # A match has to beat both the tolerance and a zero score
+        threshold = max(tolerance, 0)
+
+        rows = self._select(class_id)
+        packed_phash = pack_phash(query_phash)
+        if rows is None and phash_similarity is None and packed_phash is not None and len(query_regions) <= REGION_COUNT:
+            band_radius = self._band_radius(threshold)
+            if band_radius is not None:
+                rows = self._band_candidates(face_encoding, packed_phash, band_radius)
+
+        def rows_where(flags):
+            flags = flags[:len(self.enrollments)] if rows is None else flags[rows]
+            return np.flatnonzero(flags) if rows is None else rows[flags]
+
+        if packed_phash is not None and len(query_regions) <= REGION_COUNT:
+            if phash_similarity is None:
+                phash_similarity = self._phash_similarity([packed_phash], rows)[0]
+            matched_rows, scores = self._score_packed(face_encoding, phash_similarity, query_regions, threshold, rows)
+            scalar_rows = rows_where(self.irregular)
+        else:
+            matched_rows, scores = np.zeros(0, dtype=np.intp), np.zeros(0)
+            scalar_rows = rows_where(self.packed | self.irregular)
+
+        if len(scalar_rows):
+            extra_rows = []
+            extra_scores = []
+            for row in scalar_rows:
+                score = score_enrollment(face_encoding, self.enrollments[row])
+                if score is not None:
+                    extra_rows.append(row)
+                    extra_scores.append(score)
+            matched_rows = np.concatenate([matched_rows, np.asarray(extra_rows, dtype=np.intp)])
+            scores = np.concatenate([scores, np.asarray(extra_scores, dtype=np.float64)])
+            order = np.argsort(matched_rows, kind='stable')
+            matched_rows, scores = matched_rows[order], scores[order]
+
+        if len(matched_rows) == 0:
+            return result
+
+        # Rows are in enrollment order, so argmax gives ties to the earliest
+        best = np.argmax(scores)
+        result['closest'] = self.enrollments[matched_rows[best]]
+        result['score'] = float(scores[best])
+        if scores[best] > threshold:
+            result['match'] = self.enrollments[matched_rows[best]]
+        if len(matched_rows) > 1:
+            scores[best] = -np.inf
+            runner_up = np.argmax(scores)
+            result['runner_up'] = self.enrollments[matched_rows[runner_up]]
+            result['runner_up_score'] = float(scores[runner_up])
+
+        return result
+
+    def search_batch(self, face_encodings, tolerance=0.60, class_id=None):
+        """
+        Score several face encodings against the index
+
+        The pHash distances of all queries to all selected enrollments are
+        computed in one pass; the rest works as in search().
+
+        Returns:
+            List of search() results, one per encoding
+        """
+        # Searches that can use the band tables are done one by one
+        if not class_id and self._band_radius(max(tolerance, 0)) is not None:
+            return [self.search(encoding, tolerance) for encoding in face_encodings]
+
+        packed = [pack_phash(encoding.get('features', {}).get('phash')) for encoding in face_encodings]
+        batch_rows = [i for i, phash in enumerate(packed) if phash is not None]
+        similarity = None
+        if batch_rows:
+            similarity = self._phash_similarity([packed[i] for i in batch_rows], self._select(class_id))
+
+        results = [None] * len(face_encodings)
+        for position, i in enumerate(batch_rows):
+            results[i] = self.search(face_encodings[i], tolerance, class_id, phash_similarity=similarity[position])
+        for i, encoding in enumerate(face_encodings):
+            if results[i] is None:
+                results[i] = self.search(encoding, tolerance, class_id)
+        return results
+
+
+def _class_of(enrollment):
+    return enrollment.get('class_id', 'default')
+
+_band_mask_cache = {}
+
+def _band_masks(radius):
+    """Return all BAND_BITS-bit XOR masks with at most radius bits set"""
+    if radius not in _band_mask_cache:
+        values = np.arange(1 << BAND_BITS, dtype=np.uint64)
+        _band_mask_cache[radius] = values[np.bitwise_count(values) <= radius]
+    return _band_mask_cache[radius]
+
+
+def _log_search_result(result):
+    if result['match']:
+        logger.info(f"Found match: {result['match']['name']} with score {result['score']:.4f}")
+    else:
+        # Report the closest candidate for debugging purposes
+        closest_name = result['closest'].get('name', 'unknown') if result['closest'] else "none"
+        logger.info(f"No match found. Closest was {closest_name} with score {result['score']:.4f}")
+
+def _is_searchable(face_encoding):
+    if 'features' not in face_encoding:
+        logger.warning("No features found in face encoding")
+        return False
+    if not face_encoding['features'].get('phash'):
+        logger.warning("No perceptual hash found in encoding")
+        return False
+    return True
+
+
+def find_matching_face(face_encoding, enrollments, tolerance=0.60, class_id=None):
     """
     Find a matching face in the enrollments using image features
     
     Args:
         face_encoding: Face encoding to match
-        enrollments: List of enrollment records
+        enrollments: List of enrollment records or a FaceIndex built from them
         tolerance: Similarity threshold (0-1), higher means more lenient
+        class_id: Only match enrollments in this class
         
     Returns:
         Matching enrollment record or None if no match found
@@ -115,97 +759,48 @@ def find_matching_face(face_encoding, enrollments, tolerance=0.60):
         if not enrollments or not face_encoding:
             return None
         
-        # Get the features from the encoding
-        if 'features' not in face_encoding:
-            logger.warning("No features found in face encoding")
-            return None
-            
-        query_features = face_encoding['features']
-        query_phash = query_features.get('phash')
-        query_regions = query_features.get('regions', [])
-        
-        if not query_phash:
-            logger.warning("No perceptual hash found in encoding")
+        if not _is_searchable(face_encoding):
             return None
         
-        best_match = None
-        best_score = 0
-        
-        # Compare with all enrollments
-        for enrollment in enrollments:
-            if 'encoding' not in enrollment or 'features' not in enrollment['encoding']:
-                continue
-                
-            enrollment_features = enrollment['encoding']['features']
-            
-            # Check for required features
-            if 'phash' not in enrollment_features:
-                continue
-                
-            enroll_phash = enrollment_features['phash']
-            enroll_regions = enrollment_features.get('regions', [])
-            
-            # Calculate hamming distance for perceptual hash (smaller is better)
-            hamming_dist = calculate_hamming_distance(query_phash, enroll_phash)
-            if hamming_dist < 0:  # invalid comparison
-                continue
-                
-            # Convert to similarity score (0-1 range, where 1 is identical)
-            # For 64-bit hash, max distance is 64
-            phash_similarity = 1 - (hamming_dist / 64)
-            
-            # Calculate region similarity (if available)
-            region_similarity = 0
-            if query_regions and enroll_regions:
-                region_similarity = calculate_region_similarity(query_regions, enroll_regions)
-            
-            # Combine scores (weighted average)
-            # Adjust weights to give even more importance to perceptual hash
-            # and also use the traditional hash as a fallback
-            
-            # Check if traditional hash matches exactly - if so, boost the score
-            hash_boost = 0.0
-            if face_encoding.get('hash') == enrollment['encoding'].get('hash'):
-                hash_boost = 0.2  # Big boost for exact match
-                
-            # Calculate combined score with adjusted weights and potential boost
-            combined_score = (0.8 * phash_similarity) + (0.2 * region_similarity) + hash_boost
-            
-            logger.debug(f"Comparing with {enrollment['name']}: score {combined_score:.4f}")
-            
-            # If this is the best match so far and it meets our threshold
-            if combined_score > best_score and combined_score > tolerance:
-                best_score = combined_score
-                best_match = enrollment
-        
-        if best_match:
-            logger.info(f"Found match: {best_match['name']} with score {best_score:.4f}")
-        else:
-            # Find the closest match for debugging purposes
-            closest_name = "none"
-            closest_score = 0
-            
-            for enrollment in enrollments:
-                if 'encoding' not in enrollment:
-                    continue
-                    
-                name = enrollment.get('name', 'unknown')
-                query_phash = face_encoding['features'].get('phash', '')
-                
-                if 'features' in enrollment['encoding'] and 'phash' in enrollment['encoding']['features']:
-                    enroll_phash = enrollment['encoding']['features']['phash']
-                    # Quick hamming distance check
-                    hamming_dist = calculate_hamming_distance(query_phash, enroll_phash)
-                    if hamming_dist >= 0:
-                        score = 1 - (hamming_dist / 64)
-                        if score > closest_score:
-                            closest_score = score
-                            closest_name = name
-            
-            logger.info(f"No match found. Best score was {best_score:.4f}, closest was {closest_name} with raw pHash score {closest_score:.4f}")
+        index = enrollments if isinstance(enrollments, FaceIndex) else FaceIndex(enrollments)
+        result = index.search(face_encoding, tolerance, class_id)
+        _log_search_result(result)
             
-        return best_match
+        return result['match']
     
     except Exception as e:
         logger.exception("Error finding matching face")
         return None
+
+def find_matching_faces(face_encodings, enrollments, tolerance=0.60, class_id=None):
+    """
+    Find matching faces for several encodings in one pass over the enrollments
+    
+    Args:
+        face_encodings: List of face encodings to match (None entries are skipped)
+        enrollments: List of enrollment records or a FaceIndex built from them
+        tolerance: Similarity threshold (0-1), higher means more lenient
+        class_id: Only match enrollments in this class
+        
+    Returns:
+        List with the matching enrollment record or None for each encoding
+    """
+    matches = [None] * len(face_encodings)
+    try:
+        if not enrollments:
+            return matches
+        
+        positions = [i for i, encoding in enumerate(face_encodings) if encoding and _is_searchable(encoding)]
+        if not positions:
+            return matches
+        
+        index = enrollments if isinstance(enrollments, FaceIndex) else FaceIndex(enrollments)
+        results = index.search_batch([face_encodings[i] for i in positions], tolerance, class_id)
+        for i, result in zip(positions, results):
+            _log_search_result(result)
+            matches[i] = result['match']
+        return matches
+    
+    except Exception as e:
+        logger.exception("Error finding matching faces")
+        return [None] * len(face_encodings)
@@ -0,0 +1,255 @@
+import threading
+
+import numpy as np
+
+from storage import DEFAULT_CLASS_ID
+
+
+def _rows(bits):
+    """Return the positions of the set bits of an int, ascending"""
+    if not bits:
+        return np.zeros(0, dtype=np.intp)
+    data = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder='little'))
+
+
+def _add_bit_sliced(counter, bits):
+    """Add one to the counts of the rows in bits; counter holds the counts' binary digits, lowest first"""
+    for i, digit in enumerate(counter):
+        counter[i] = digit ^ bits
+        bits &= digit
+        if not bits:
+            return
+    counter.append(bits)
+
+
+def _at_least(counter, threshold):
+    """Return the rows whose count in a bit-sliced counter is at least threshold"""
+    if threshold <= 0:
+        raise ValueError('threshold must be positive')
+    if threshold.bit_length() > len(counter):
+        return 0
+    greater = 0
+    equal = -1  # All rows, as an infinite run of ones
+    for i in range(len(counter) - 1, -1, -1):
+        if threshold >> i & 1:
+            equal &= counter[i]
+        else:
+            greater |= equal & counter[i]
+            equal &= ~counter[i]
+    # threshold has a set bit, so equal is finite by now
+    return greater | equal
+
+
+class PresenceIndex:
+    """
+    Daily presence bitsets for the attendance chatbot
+
+    Every person gets a row number when first seen, and a set of people is
+    a Python int with their rows' bits set. The index keeps the rows of
+    each class's current members, and for each date and class the rows of
+    the people marked present that day with that class on their record,
+    both kept up to date from the stores' change events. Who was present
+    in a class is then presence & members, who was absent members &
+    ~presence, and counts are popcounts, so a question costs a few
+    operations on roster-sized ints whatever the length of the history;
+    questions over several days add the days up in bit-sliced counters.
+
+    A reload of the attendance without a payload (as the SQLite log sends)
+    is rebuilt from attendance_log.marks() on next use.
+    """
+
+    def __init__(self, enrollment_store, attendance_log):
+        self.enrollment_store = enrollment_store
+        self.attendance_log = attendance_log
+        self._lock = threading.RLock()
+
+        self._row_of = {}     # Person id -> row
+        self._ids = []        # Row -> person id
+        self._members = {}    # Class id -> rows of its current members
+        self._class_of = {}   # Person id -> class id, for enrolled people
+        self._presence = {}   # Date -> {record class id: rows marked present}
+        self._stale = False   # The attendance must be rebuilt from marks()
+        self._reloads = 0
+        self._pending = []    # Marks received while stale
+
+        enrollment_store.subscribe(self._on_enrollments)
+        attendance_log.subscribe(self._on_attendance)
+
+    def _bit(self, person_id):
+        row = self._row_of.get(person_id)
+        if row is None:
+            row = self._row_of[person_id] = len(self._ids)
+            self._ids.append(person_id)
+        return 1 << row
+
+    # Store listeners
+
+    def _enroll(self, record):
+        person_id, class_id = record['id'], record.get('class_id', DEFAULT_CLASS_ID)
+        self._unenroll(person_id)
+        self._class_of[person_id] = class_id
+        self._members[class_id] = self._members.get(class_id, 0) | self._bit(person_id)
+
+    def _unenroll(self, person_id):
+        class_id = self._class_of.pop(person_id, None)
+        if class_id is None:
+            return
+        members = self._members[class_id] & ~self._bit(person_id)
+        if members:
+            self._members[class_id] = members
+        else:
+            del self._members[class_id]
+
+    def _mark(self, date, person_id, class_id):
+        classes = self._presence.setdefault(date, {})
+        classes[class_id] = classes.get(class_id, 0) | self._bit(person_id)
+
+    def _on_enrollments(self, event, payload):
+        with self._lock:
+            if event == 'reload':
+                self._members = {}
+                self._class_of = {}
+                for record in payload:
+                    self._enroll(record)
+            elif event == 'add':
+                for record in payload:
+                    self._enroll(record)
+            elif event == 'remove':
+                for record in payload:
+                    self._unenroll(record['id'])
+            elif event == 'update':
+                for old, new in payload:
+                    self._enroll(new)
+
+    def _on_attendance(self, event, payload):
+        with self._lock:
+            if event == 'reload':
+                self._presence = {}
+                self._reloads += 1
+                self._pending = []
+                self._stale = payload is None
+                for date, records in (payload or {}).items():
+                    for record in records:
+                        self._mark(date, record['id'], record.get('class_id'))
+            elif event == 'mark':
+                for date, record in payload:
+                    if self._stale:
+                        self._pending.append((date, record['id'], record.get('class_id')))
+                    else:
+                        self._mark(date, record['id'], record.get('class_id'))
+
+    def _sync(self):
+        """Pick up changes by other processes and rebuild the attendance if needed"""
+        self.enrollment_store.refresh()
+        self.attendance_log.refresh()
+        with self._lock:
+            if not self._stale:
+                return
+            reloads = self._reloads
+
+        # Read outside the index's lock, which marks arriving meanwhile take
+        # after the log's; they are kept as pending and applied on top
+        marks = self.attendance_log.marks()
+        with self._lock:
+            if not self._stale or reloads != self._reloads:
+                return
+            self._presence = {}
+            for date, person_id, class_id in marks + self._pending:
+                self._mark(date, person_id, class_id)
+            self._pending = []
+            self._stale = False
+
+    # Set helpers; call with the lock held
+
+    def _class_members(self, class_id):
+        if class_id is not None:
+            return self._members.get(class_id, 0)
+        members = 0
+        for bits in self._members.values():
+            members |= bits
+        return members
+
+    def _present(self, date, class_id):
+        """Rows of current members of class_id (any class if None) marked present with it on date"""
+        classes = self._presence.get(date, {})
+        if class_id is not None:
+            return classes.get(class_id, 0) & self._members.get(class_id, 0)
+        present = 0
+        for record_class, bits in classes.items():
+            present |= bits & self._members.get(record_class, 0)
+        return present
+
+    def _ids_of(self, bits):
+        return {self._ids[row] for row in _rows(bits)}
+
+    # Queries
+
+    def has_date(self, date):
+        """Return whether anyone was marked present on date"""
+        self._sync()
+        with self._lock:
+            return date in self._presence
+
+    def dates(self, date_from=None, date_to=None):
+        """Return the dates with any attendance, between the given bounds inclusive, in order"""
+        self._sync()
+        with self._lock:
+            return sorted(date for date in self._presence
+                          if (date_from is None or date >= date_from) and (date_to is None or date <= date_to))
+
+    def class_size(self, class_id=None):
+        """Return the number of people enrolled in class_id, or in any class if None"""
+        self._sync()
+        with self._lock:
+            return self._class_members(class_id).bit_count()
+
+    def present(self, date, class_id=None):
+        """Return the ids of the members of class_id (any class if None) present on date"""
+        self._sync()
+        with self._lock:
+            return self._ids_of(self._present(date, class_id))
+
+    def absent(self, date, class_id=None):
+        """Return the ids of the members of class_id (any class if None) not present on date"""
+        self._sync()
+        with self._lock:
+            return self._ids_of(self._class_members(class_id) & ~self._present(date, class_id))
+
+    def attendance_rate(self, dates, class_id=None):
+        """
+        Return how much of class_id (any class if None) was present over dates
+
+        Returns:
+            Tuple of (presences, possible): the number of (person, date)
+            presences of current members and members x dates
+        """
+        self._sync()
+        with self._lock:
+            presences = sum(self._present(date, class_id).bit_count() for date in dates)
+            return presences, self._class_members(class_id).bit_count() * len(dates)
+
+    def present_at_least(self, dates, days, class_id=None):
+        """
+        Return the ids of the members of class_id (any class if None) who
+        were present on at least `days` of the given dates
+        """
+        self._sync()
+        with self._lock:
+            counter = []
+            for date in dates:
+                _add_bit_sliced(counter, self._present(date, class_id))
+            return self._ids_of(_at_least(counter, days))
+
+    def absent_at_least(self, dates, days, class_id=None):
+        """
+        Return the ids of the members of class_id (any class if None) who
+        were absent on at least `days` of the given dates
+        """
+        self._sync()
+        with self._lock:
+            members = self._class_members(class_id)
+            counter = []
+            for date in dates:
+                _add_bit_sliced(counter, members & ~self._present(date, class_id))
+            return self._ids_of(_at_least(counter, days) & members)
@@ -0,0 +1,216 @@
+import os
+import json
+import glob
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Bump when the report layout changes so cached reports are not reused
+REPORT_FORMAT_VERSION = 2
+
+
+def _table_header(pdf):
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(60, 10, "Name", 1, 0)
+    pdf.cell(40, 10, "Class", 1, 0)
+    pdf.cell(30, 10, "Date", 1, 0)
+    pdf.cell(30, 10, "Time", 1, 1)
+    pdf.set_font("Arial", '', 10)
+
+
+def render_attendance_pdf(rows, class_name=None):
+    """
+    Lay out an attendance report
+
+    Args:
+        rows: (name, class name, date, time) tuples in report order
+        class_name: Name of the class the report is filtered to, if any
+
+    Returns:
+        The PDF document as bytes
+    """
+    # Only the worker processes render, so only they need fpdf
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.add_page()
+
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(0, 10, "Attendance Report", 0, 1, 'C')
+    # Reports are cached, so date them by their data rather than the render time
+    pdf.set_font("Arial", 'I', 10)
+    if rows:
+        _, _, date, time = max(rows, key=lambda row: (row[2], row[3]))
+        pdf.cell(0, 10, f"Records up to {date} at {time}", 0, 1, 'C')
+    else:
+        pdf.cell(0, 10, "No records", 0, 1, 'C')
+    pdf.ln(10)
+
+    if class_name:
+        pdf.set_font("Arial", 'B', 12)
+        pdf.cell(0, 10, f"Class: {class_name}", 0, 1)
+
+    _table_header(pdf)
+    for name, row_class_name, date, time in rows:
+        # Start a new page, with the headers again, near the bottom
+        if pdf.get_y() > 250:
+            pdf.add_page()
+            _table_header(pdf)
+
+        pdf.cell(60, 10, name, 1, 0)
+        pdf.cell(40, 10, row_class_name, 1, 0)
+        pdf.cell(30, 10, date, 1, 0)
+        pdf.cell(30, 10, time, 1, 1)
+
+    return pdf.output(dest='S').encode('latin-1')
+
+
+def write_attendance_pdf(path, rows, class_name=None):
+    """Render a report into path; runs in a worker process"""
+    data = render_attendance_pdf(rows, class_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def report_key(kind, filters, data_version):
+    """
+    Return the cache key of a report
+
+    Args:
+        kind: Report type, e.g. 'attendance_pdf'
+        filters: Dict of the filters the report was requested with
+        data_version: JSON-serializable token that changes whenever the
+            data the report is built from does
+
+    Returns:
+        Hex digest naming the report's file in the cache
+    """
+    material = json.dumps([REPORT_FORMAT_VERSION, kind, filters, data_version], sort_keys=True, default=list)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ReportJobs:
+    """
+    Background report rendering with a content-addressed file cache
+
+    Reports are rendered in a pool of worker processes and kept in
+    `directory` as <key>.pdf, where the key (see report_key) covers the
+    filters and the version of the data. A job's id is its key, so asking
+    for the same report twice while the data is unchanged gives the same
+    job, and once it is rendered any process serving the app finds it on
+    disk. The pool uses spawned processes, which start without the web
+    process's state, and is only started on the first job. Of failed jobs
+    only the error message is kept, for the last max_files of them.
+    """
+
+    def __init__(self, directory, workers=2, max_files=100):
+        self.directory = directory
+        self.workers = workers
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._pool = None
+        self._jobs = {}  # Key -> Future of running jobs started by this process
+        self._failures = OrderedDict()  # Key -> error message of failed jobs, oldest first
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def submit(self, key, fn, *args):
+        """
+        Start rendering a report unless it is cached or already underway
+
+        Args:
+            key: Cache key of the report
+            fn: Picklable function called as fn(path, *args) in a worker
+                process to write the report to path
+
+        Returns:
+            The job's status, as status()
+        """
+        started = None
+        with self._lock:
+            if not os.path.exists(self.path(key)):
+                future = self._jobs.get(key)
+                if future is None or (future.done() and future.exception() is not None):
+                    # A failed job is retried
+                    self._failures.pop(key, None)
+                    started = self._jobs[key] = self._executor().submit(fn, self.path(key), *args)
+        if started is not None:
+            # Outside the lock: the callback runs right here if the job is already done
+            started.add_done_callback(lambda done: self._finished(key, done))
+        return self.status(key)
+
+    def _finished(self, key, future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Report {key} failed: {error}")
+        with self._lock:
+            if self._jobs.get(key) is not future:
+                return
+            del self._jobs[key]
+            if error is not None:
+                self._failures[key] = str(error)
+                while len(self._failures) > self.max_files:
+                    self._failures.popitem(last=False)
+        if error is None:
+            self._prune()
+
+    def _prune(self):
+        """Remove the least recently written reports beyond max_files"""
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.pdf')), key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove cached report: {e}")
+
+    def status(self, key):
+        """
+        Return a job's status
+
+        Returns:
+            'done', 'failed', 'running', 'queued', or None for a job this
+            process doesn't know of and that isn't in the cache
+        """
+        if os.path.exists(self.path(key)):
+            return 'done'
+        with self._lock:
+            if key in self._failures:
+                return 'failed'
+            future = self._jobs.get(key)
+        if future is None:
+            return None
+        if future.done():
+            return 'failed' if future.exception() is not None else 'done'
+        return 'running' if future.running() else 'queued'
+
+    def error(self, key):
+        """Return the error message of a failed job, or None"""
+        with self._lock:
+            if key in self._failures:
+                return self._failures[key]
+            future = self._jobs.get(key)
+        if future is None or not future.done() or future.exception() is None:
+            return None
+        return str(future.exception())
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -0,0 +1,953 @@
+import os
+import sys
+import json
+import base64
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import face_utils
+import storage
+from storage import DEFAULT_CLASS_ID, EnrollmentStore, ClassStore
+from binary_store import split_enrollment
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+# Seconds a writer waits for another process's write transaction to finish
+BUSY_TIMEOUT = 30
+
+# Rows are kept in insertion order by seq, which decides match priority for
+# enrollments and the walking order of the attendance, as in the JSON files.
+# The revisions table counts the changes to each of the other tables, so a
+# process notices another's writes with a single primary key lookup.
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS classes (
+        seq INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS enrollments (
+        seq INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        class_id TEXT NOT NULL DEFAULT 'default',
+        enrolled_at TEXT,
+        template BLOB NOT NULL,
+        thumbnail BLOB,
+        data TEXT NOT NULL DEFAULT '{}'
+    )""",
+    "CREATE INDEX IF NOT EXISTS enrollments_class ON enrollments (class_id)",
+    """CREATE TABLE IF NOT EXISTS attendance (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        person_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        class_id TEXT,
+        UNIQUE (person_id, date)
+    )""",
+    "CREATE INDEX IF NOT EXISTS attendance_date ON attendance (date, time, person_id)",
+    "CREATE INDEX IF NOT EXISTS attendance_class_date ON attendance (class_id, date)",
+    """CREATE TABLE IF NOT EXISTS revisions (
+        name TEXT PRIMARY KEY,
+        revision INTEGER NOT NULL
+    )""",
+    "INSERT OR IGNORE INTO revisions VALUES ('classes', 0), ('enrollments', 0), ('attendance', 0)",
+]
+
+# Columns of an enrollment record that have their own table column; the
+# other metadata fields are kept as JSON in 'data'
+ENROLLMENT_COLUMNS = ('id', 'name', 'class_id', 'enrolled_at')
+
+# Attendance joined with the enrollments, as AttendanceTable returns it:
+# people no longer enrolled are 'Unknown (id)' in the default class
+RECORD_COLUMNS = ("a.person_id, COALESCE(e.name, 'Unknown (' || a.person_id || ')'), "
+                  "COALESCE(a.class_id, e.class_id, 'default'), a.date, a.time")
+RECORD_TABLES = "attendance a LEFT JOIN enrollments e ON e.id = a.person_id"
+
+
+class Database:
+    """
+    SQLite database holding the classes, enrollments and attendance
+
+    Each thread (and each process, after a fork) gets its own connection.
+    The database is in WAL mode, so readers never wait for a writer and
+    see the last committed state; writes go through transaction(), which
+    takes the database's write lock up front, so the mutators of several
+    worker processes are serialized rather than failing on a busy database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_schema()
+
+    def connect(self):
+        """Open a new connection, in autocommit mode"""
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def connection(self):
+        """Return this thread's connection"""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            # Connections must not be shared with a forked child
+            self._local.conn = self.connect()
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _create_schema(self):
+        conn = self.connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{self.path} has schema version {version}, newer than supported ({SCHEMA_VERSION})")
+
+        with self.transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            # A new database starts with the default class, as classes.json does
+            if conn.execute('SELECT 1 FROM classes LIMIT 1').fetchone() is None:
+                default = storage.default_class()
+                conn.execute('INSERT INTO classes (id, name, created_at) VALUES (?, ?, ?)',
+                             (default['id'], default['name'], default['created_at']))
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a write transaction on this thread's connection
+
+        The write lock is taken when the transaction starts, so what is read
+        inside it stays current until the commit. A transaction started
+        inside another one joins it.
+        """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @contextmanager
+    def snapshot(self):
+        """Run several reads on this thread's connection against one committed state"""
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('COMMIT')
+
+    def revision(self, name):
+        """Return the change count of a table"""
+        return self.connection().execute('SELECT revision FROM revisions WHERE name = ?', (name,)).fetchone()[0]
+
+    def touch(self, conn, name):
+        """Count a change to a table within a write transaction and return its new revision"""
+        conn.execute('UPDATE revisions SET revision = revision + 1 WHERE name = ?', (name,))
+        return conn.execute('SELECT revision FROM revisions WHERE name = ?', (name,)).fetchone()[0]
+
+
+def _enrollment_row(metadata, template, thumbnail):
+    """Return the enrollments table values of a record split by split_enrollment"""
+    data = {key: value for key, value in metadata.items() if key not in ENROLLMENT_COLUMNS}
+    return (metadata['id'], metadata['name'], metadata.get('class_id', DEFAULT_CLASS_ID),
+            metadata.get('enrolled_at'), template.tobytes(), thumbnail, json.dumps(data))
+
+
+def _attendance_record(person_id, time, class_id):
+    record = {'id': person_id, 'time': time}
+    if class_id is not None:
+        record['class_id'] = class_id
+    return record
+
+
+class SQLiteEnrollmentStore(EnrollmentStore):
+    """
+    Enrollment store backed by the enrollments table
+
+    Like BinaryEnrollmentStore, records carry the metadata fields but no
+    encoding: the matching templates are kept as BLOBs and handed to the
+    FaceIndex, and thumbnails stay in the table until thumbnail() asks for
+    one. The cache is reloaded when the table's revision changes; mutators
+    change only the affected rows, in a write transaction.
+    """
+
+    def __init__(self, database):
+        super().__init__(database.path)
+        self.database = database
+        self._templates = {}  # Person id -> template bytes
+        self._held = None     # Change events held back until the transaction commits
+
+    def _file_stamp(self):
+        return (self.database.revision('enrollments'),)
+
+    def _read(self):
+        records = []
+        templates = {}
+        rows = self.database.connection().execute(
+            'SELECT id, name, class_id, enrolled_at, template, data FROM enrollments ORDER BY seq')
+        for person_id, name, class_id, enrolled_at, template, data in rows:
+            record = json.loads(data)
+            record.update(id=person_id, name=name, class_id=class_id, enrolled_at=enrolled_at)
+            records.append(record)
+            templates[person_id] = template
+        self._templates = templates
+        return records
+
+    def _build_face_index(self):
+        blobs = b''.join(self._templates[record['id']] for record in self._records)
+        # Copied, as the index updates its arrays in place
+        templates = np.frombuffer(blobs, dtype=face_utils.TEMPLATE_DTYPE).copy()
+        return face_utils.FaceIndex(self._records, templates)
+
+    def _notify(self, event, payload):
+        if self._held is not None:
+            self._held.append((event, payload))
+        else:
+            super()._notify(event, payload)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Hold the store's lock and a write transaction, with the cache
+        refreshed; listeners hear of the changes once they are committed
+        """
+        with self._lock:
+            self._held = []
+            try:
+                with self.database.transaction() as conn:
+                    self.refresh()
+                    yield conn
+            except BaseException:
+                # The cache may hold a change that was rolled back
+                self._loaded = False
+                raise
+            finally:
+                held, self._held = self._held, None
+            for event, payload in held:
+                super()._notify(event, payload)
+
+    # Accessors
+
+    def thumbnail(self, person_id):
+        """Return the base64 thumbnail of an enrollment, or None"""
+        row = self.database.connection().execute(
+            'SELECT thumbnail FROM enrollments WHERE id = ?', (person_id,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        return base64.b64encode(row[0]).decode('utf-8')
+
+    # Mutators
+
+    def add(self, record):
+        """Insert a new enrollment record (with its full encoding)"""
+        self.add_many([record])
+
+    def add_many(self, records):
+        """Insert new enrollment records (with their full encodings) in one transaction"""
+        records = list(records)
+        templates = face_utils.pack_templates([record.get('encoding') for record in records])
+        metadata = []
+        rows = []
+        for record, template in zip(records, templates):
+            fields, thumbnail = split_enrollment(record, template)
+            fields.setdefault('class_id', DEFAULT_CLASS_ID)
+            metadata.append(fields)
+            rows.append(_enrollment_row(fields, template, thumbnail))
+
+        def update_index(index):
+            for fields, template in zip(metadata, templates):
+                index.add(fields, template)
+
+        with self._writing() as conn:
+            conn.executemany('INSERT INTO enrollments (id, name, class_id, enrolled_at, template, thumbnail, data) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.database.touch(conn, 'enrollments')
+            for fields, template in zip(metadata, templates):
+                self._templates[fields['id']] = template.tobytes()
+            self._cache(self._records + metadata, update_index, ('add', metadata))
+
+    def remove(self, person_id, expected_version=None):
+        """
+        Delete the enrollment for person_id
+
+        Returns:
+            The removed record or None if no such enrollment exists
+
+        Raises:
+            VersionConflict: If expected_version is no longer current
+        """
+        with self._writing() as conn:
+            self._check_version(expected_version)
+            removed = self._by_id.get(person_id)
+            if removed is None:
+                return None
+            conn.execute('DELETE FROM enrollments WHERE id = ?', (person_id,))
+            self.database.touch(conn, 'enrollments')
+            self._templates.pop(person_id, None)
+            self._cache([r for r in self._records if r['id'] != person_id],
+                        lambda index: index.remove(person_id), ('remove', [removed]))
+            return removed
+
+    def reassign_class(self, old_class_id, new_class_id):
+        """
+        Move every enrollment in old_class_id to new_class_id
+
+        Returns:
+            Number of enrollments that were moved
+        """
+        with self._writing() as conn:
+            moved = [(record, dict(record, class_id=new_class_id)) for record in self.for_class(old_class_id)]
+            if not moved:
+                return 0
+            conn.execute('UPDATE enrollments SET class_id = ? WHERE class_id = ?', (new_class_id, old_class_id))
+            self.database.touch(conn, 'enrollments')
+            new_records = {old['id']: new for old, new in moved}
+            self._cache([new_records.get(record['id'], record) for record in self._records],
+                        lambda index: index.update([new for old, new in moved], repack=False),
+                        ('update', moved))
+            return len(moved)
+
+    def update_encodings(self, encodings):
+        """
+        Replace the encodings of enrollments
+
+        Args:
+            encodings: Dict of person id -> new encoding
+
+        Returns:
+            Number of enrollments that were updated
+        """
+        with self._writing() as conn:
+            records = []
+            updated = []
+            for record in self._records:
+                if record['id'] in encodings:
+                    template = face_utils.pack_templates([encodings[record['id']]])[0]
+                    metadata, thumbnail = split_enrollment(dict(record, encoding=encodings[record['id']]), template)
+                    row = _enrollment_row(metadata, template, thumbnail)
+                    conn.execute('UPDATE enrollments SET template = ?, thumbnail = ?, data = ? WHERE id = ?',
+                                 row[4:] + row[:1])
+                    self._templates[record['id']] = row[4]
+                    updated.append((record, metadata))
+                    record = metadata
+                records.append(record)
+
+            if updated:
+                self.database.touch(conn, 'enrollments')
+                # The face index is rebuilt on next use
+                self._cache(records, change=('update', updated))
+            return len(updated)
+
+
+class SQLiteClassStore(ClassStore):
+    """Class store backed by the classes table, reloaded when its revision changes"""
+
+    def __init__(self, database):
+        super().__init__(database.path)
+        self.database = database
+
+    def refresh(self):
+        """Reload the classes if they changed since they were last loaded"""
+        stamp = (self.database.revision('classes'),)
+        if self._loaded and stamp == self._stamp:
+            return
+
+        with self._lock:
+            rows = self.database.connection().execute('SELECT id, name, created_at FROM classes ORDER BY seq')
+            classes = [{'id': class_id, 'name': name, 'created_at': created_at} for class_id, name, created_at in rows]
+            self._set_classes(classes or [storage.default_class()], stamp)
+
+    def _update(self, change, expected_version):
+        """
+        Apply change(classes) -> (new classes, result) to the latest classes
+        and save the difference, in a write transaction
+        """
+        with self._lock, self.database.transaction() as conn:
+            self.refresh()
+            if expected_version is not None and expected_version != storage.version_tag(self._stamp):
+                raise storage.VersionConflict(f"The classes have changed since version {expected_version}")
+            classes, result = change(list(self._classes))
+            if classes is not None:
+                new_ids = {cls['id'] for cls in classes}
+                old_ids = {cls['id'] for cls in self._classes}
+                conn.executemany('DELETE FROM classes WHERE id = ?', [(class_id,) for class_id in old_ids - new_ids])
+                conn.executemany('INSERT INTO classes (id, name, created_at) VALUES (?, ?, ?)',
+                                 [(cls['id'], cls['name'], cls.get('created_at'))
+                                  for cls in classes if cls['id'] not in old_ids])
+                self._set_classes(classes, (self.database.touch(conn, 'classes'),))
+            return result
+
+
+class SQLiteAttendanceLog:
+    """
+    Attendance records in the attendance table
+
+    The (person_id, date) unique constraint does the duplicate checks, so
+    marking doesn't need the history in memory. Rows are only ever
+    appended: other processes' marks are noticed through the table's
+    revision and read by sequence number from the last one seen. as_dict()
+    builds the {date: [records]} layout on first use and keeps it up to
+    date the same way.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.path = database.path
+        self.version = 0
+        self._lock = threading.RLock()
+        self._revision = None
+        self._last_seq = 0
+        self._data = None
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """
+        Call listener(event, payload) after every change to the attendance
+
+        Events are those of AttendanceLog, except that 'reload' carries no
+        payload; a listener that needs the full history reads as_dict().
+        Listeners run with the log's lock held.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            if self._revision is not None:
+                listener('reload', None)
+
+    def _notify(self, event, payload):
+        for listener in self._listeners:
+            listener(event, payload)
+
+    def _add_to_data(self, applied):
+        if self._data is not None:
+            for date, record in applied:
+                self._data.setdefault(date, []).append(record)
+
+    def refresh(self):
+        """Pick up marks made by other processes"""
+        with self._lock:
+            revision = self.database.revision('attendance')
+            if revision == self._revision:
+                return
+
+            conn = self.database.connection()
+            if self._revision is None:
+                self._last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM attendance').fetchone()[0]
+                self._data = None
+                self._revision = revision
+                self.version += 1
+                self._notify('reload', None)
+                return
+
+            rows = conn.execute('SELECT seq, date, person_id, time, class_id FROM attendance WHERE seq > ? ORDER BY seq',
+                                (self._last_seq,)).fetchall()
+            applied = [(date, _attendance_record(person_id, time, class_id))
+                       for seq, date, person_id, time, class_id in rows]
+            if rows:
+                self._last_seq = rows[-1][0]
+            self._add_to_data(applied)
+            self._revision = revision
+            self.version += 1
+            if applied:
+                self._notify('mark', applied)
+
+    # Accessors
+
+    def as_dict(self):
+        """Return all attendance as {date: [records]}; must not be modified"""
+        with self._lock:
+            self.refresh()
+            if self._data is None:
+                data = {}
+                rows = self.database.connection().execute(
+                    'SELECT date, person_id, time, class_id FROM attendance WHERE seq <= ? ORDER BY seq',
+                    (self._last_seq,))
+                for date, person_id, time, class_id in rows:
+                    data.setdefault(date, []).append(_attendance_record(person_id, time, class_id))
+                self._data = data
+            return self._data
+
+    def records_for(self, date):
+        """Return the attendance records for a date"""
+        rows = self.database.connection().execute(
+            'SELECT person_id, time, class_id FROM attendance WHERE date = ? ORDER BY seq', (date,))
+        return [_attendance_record(*row) for row in rows]
+
+    def is_marked(self, date, person_id):
+        row = self.database.connection().execute(
+            'SELECT 1 FROM attendance WHERE person_id = ? AND date = ?', (person_id, date)).fetchone()
+        return row is not None
+
+    def marks(self):
+        """Return all attendance as a new list of (date, person_id, class_id) tuples"""
+        return self.database.connection().execute(
+            'SELECT date, person_id, class_id FROM attendance ORDER BY seq').fetchall()
+
+    def stamp(self):
+        """Return a token for the current attendance, the same in every process"""
+        with self._lock:
+            self.refresh()
+            return (self._revision,)
+
+    # Mutators
+
+    def mark(self, person_id, date, time, class_id=None):
+        """
+        Record attendance for a person unless already marked on that date
+
+        Returns:
+            True if a new record was added, False if it already existed
+        """
+        return self.mark_many([(person_id, date, time, class_id)])[0]
+
+    def mark_many(self, marks):
+        """
+        Record several attendance marks in a single transaction
+
+        Args:
+            marks: Iterable of (person_id, date, time, class_id) tuples;
+                class_id may be None
+
+        Returns:
+            List with True for each mark that added a new record and False
+            for people already marked on that date (including earlier in
+            the same batch)
+        """
+        with self._lock:
+            try:
+                with self.database.transaction() as conn:
+                    self.refresh()
+                    added = []
+                    applied = []
+                    for person_id, date, time, class_id in marks:
+                        cursor = conn.execute('INSERT OR IGNORE INTO attendance (person_id, date, time, class_id) '
+                                              'VALUES (?, ?, ?, ?)', (person_id, date, time, class_id))
+                        added.append(cursor.rowcount == 1)
+                        if cursor.rowcount == 1:
+                            applied.append((date, _attendance_record(person_id, time, class_id)))
+                            self._last_seq = cursor.lastrowid
+                    revision = self.database.touch(conn, 'attendance') if applied else None
+            except BaseException:
+                # Re-read everything rather than trust what was applied in memory
+                self._revision = None
+                raise
+
+            # Only committed marks reach the cache and the listeners
+            if applied:
+                self._revision = revision
+                self._add_to_data(applied)
+                self.version += 1
+                self._notify('mark', applied)
+            return added
+
+
+class SQLiteAttendanceTable:
+    """
+    The queries of AttendanceTable, run against the attendance table
+
+    Filters use the date index and the enrollments' id and class indexes,
+    and keyset pages walk the (date, time, person_id) index backwards, so
+    nothing is held in memory beyond the rows returned. Match counts are
+    kept until the next change to the attendance or enrollments.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._totals_version = None
+
+    def _filters(self, conn, date, class_id, date_from, date_to, record_class_id=None):
+        """Return the WHERE clause and its parameters for the query filters"""
+        # A date without records is ignored, as AttendanceTable does
+        if date is not None and conn.execute('SELECT 1 FROM attendance WHERE date = ? LIMIT 1', (date,)).fetchone():
+            date_from = date_to = date
+
+        clauses = []
+        params = []
+        if date_from is not None:
+            clauses.append('a.date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append('a.date <= ?')
+            params.append(date_to)
+        if class_id:
+            # People no longer enrolled count as the default class
+            clauses.append('COALESCE(e.class_id, ?) = ?')
+            params.extend([DEFAULT_CLASS_ID, class_id])
+        if record_class_id:
+            # The class shown in the row, as in RECORD_COLUMNS
+            clauses.append('COALESCE(a.class_id, e.class_id, ?) = ?')
+            params.extend([DEFAULT_CLASS_ID, record_class_id])
+        return clauses, params
+
+    def _total(self, conn, clauses, params):
+        version = (self.database.revision('attendance'), self.database.revision('enrollments'))
+        key = (tuple(clauses), tuple(params))
+        with self._lock:
+            if self._totals_version != version:
+                self._totals = {}
+                self._totals_version = version
+            if key in self._totals:
+                return self._totals[key]
+
+        # Each record matches at most one enrollment, so only a class filter needs the join
+        tables = RECORD_TABLES if any('e.' in clause for clause in clauses) else 'attendance a'
+        total = conn.execute(f'SELECT COUNT(*) FROM {tables}{_where(clauses)}', params).fetchone()[0]
+        with self._lock:
+            if self._totals_version == version:
+                self._totals[key] = total
+        return total
+
+    @staticmethod
+    def _records(rows):
+        return [{'id': person_id, 'name': name, 'class_id': class_id, 'date': date, 'time': time}
+                for person_id, name, class_id, date, time in rows]
+
+    @staticmethod
+    def _order(newest_first):
+        # Newest first by (date, time) with ties in insertion order, as
+        # AttendanceTable sorts; otherwise insertion order
+        return 'a.date DESC, a.time DESC, a.seq' if newest_first else 'a.seq'
+
+    def query(self, date=None, class_id=None, date_from=None, date_to=None, newest_first=True, offset=0, limit=None):
+        """
+        Return attendance rows joined with the enrollments, as AttendanceTable.query()
+
+        Returns:
+            Tuple of (rows, total)
+        """
+        with self.database.snapshot() as conn:
+            clauses, params = self._filters(conn, date, class_id, date_from, date_to)
+            total = self._total(conn, clauses, params)
+            rows = conn.execute(f'SELECT {RECORD_COLUMNS} FROM {RECORD_TABLES}{_where(clauses)} '
+                                f'ORDER BY {self._order(newest_first)} LIMIT ? OFFSET ?',
+                                params + [-1 if limit is None else limit, offset])
+            return self._records(rows), total
+
+    def iter_query(self, date=None, class_id=None, date_from=None, date_to=None, newest_first=True, chunk_size=1000):
+        """
+        Yield the rows of query() in lists of up to chunk_size
+
+        The rows are read on a connection of their own inside one read
+        transaction, so records marked after iteration starts are left out.
+        """
+        conn = self.database.connect()
+        try:
+            conn.execute('BEGIN')
+            clauses, params = self._filters(conn, date, class_id, date_from, date_to)
+            cursor = conn.execute(f'SELECT {RECORD_COLUMNS} FROM {RECORD_TABLES}{_where(clauses)} '
+                                  f'ORDER BY {self._order(newest_first)}', params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield self._records(rows)
+        finally:
+            conn.close()
+
+    def page(self, date=None, class_id=None, date_from=None, date_to=None, after=None, limit=100,
+             record_class_id=None):
+        """
+        Return one page of attendance rows, newest first by (date, time,
+        id), as AttendanceTable.page()
+
+        Returns:
+            Tuple of (rows, total, next_key)
+        """
+        with self.database.snapshot() as conn:
+            clauses, params = self._filters(conn, date, class_id, date_from, date_to, record_class_id)
+            total = self._total(conn, clauses, params)
+            if after is not None:
+                clauses = clauses + ['(a.date, a.time, a.person_id) < (?, ?, ?)']
+                params = params + list(after)
+            rows = conn.execute(f'SELECT {RECORD_COLUMNS} FROM {RECORD_TABLES}{_where(clauses)} '
+                                'ORDER BY a.date DESC, a.time DESC, a.person_id DESC LIMIT ?',
+                                params + [limit + 1]).fetchall()
+
+        records = self._records(rows[:limit])
+        next_key = None
+        if len(rows) > limit and records:
+            last = records[-1]
+            next_key = (last['date'], last['time'], last['id'])
+        return records, total, next_key
+
+
+def _where(clauses):
+    return ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+
+class SQLiteAggregates:
+    """
+    The dashboard counts of AttendanceAggregates, as grouped queries
+
+    The counts are computed once and then, as long as the enrollments
+    don't change, only the attendance rows added since are counted in, so
+    marking attendance costs the dashboard O(new records) as it does with
+    AttendanceAggregates.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.Lock()
+        self._state = None  # (attendance revision, enrollments revision, last seq, snapshot)
+
+    def _count(self, conn):
+        last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM attendance').fetchone()[0]
+        enrollment_counts = dict(conn.execute(
+            'SELECT class_id, COUNT(*) FROM enrollments GROUP BY class_id ORDER BY MIN(seq)'))
+        attendance_by_date = dict(conn.execute(
+            'SELECT date, COUNT(*) FROM attendance WHERE seq <= ? GROUP BY date ORDER BY date', (last_seq,)))
+        attendance_by_class = {}
+        # Classes in the order of their first enrollment, as in enrollment_counts
+        rows = conn.execute('SELECT class_id, date, count FROM ('
+                            'SELECT e.class_id, a.date, COUNT(*) AS count, MIN(e.seq) AS first FROM attendance a '
+                            'JOIN enrollments e ON e.id = a.person_id WHERE a.seq <= ? GROUP BY e.class_id, a.date) '
+                            'ORDER BY MIN(first) OVER (PARTITION BY class_id), date', (last_seq,))
+        for class_id, date, count in rows:
+            attendance_by_class.setdefault(class_id, {})[date] = count
+        return last_seq, {
+            'total_enrollments': sum(enrollment_counts.values()),
+            'enrollment_counts': enrollment_counts,
+            'attendance_by_date': attendance_by_date,
+            'attendance_by_class': attendance_by_class
+        }
+
+    @staticmethod
+    def _count_new(conn, last_seq, snapshot):
+        """Return last_seq and a copy of snapshot with the records added after last_seq counted in"""
+        attendance_by_date = dict(snapshot['attendance_by_date'])
+        attendance_by_class = {class_id: dict(dates) for class_id, dates in snapshot['attendance_by_class'].items()}
+        rows = conn.execute('SELECT a.seq, a.date, e.class_id FROM attendance a '
+                            'LEFT JOIN enrollments e ON e.id = a.person_id WHERE a.seq > ? ORDER BY a.seq', (last_seq,))
+        for last_seq, date, class_id in rows:
+            attendance_by_date[date] = attendance_by_date.get(date, 0) + 1
+            if class_id is not None:
+                dates = attendance_by_class.setdefault(class_id, {})
+                dates[date] = dates.get(date, 0) + 1
+        return last_seq, dict(snapshot,
+                              attendance_by_date=dict(sorted(attendance_by_date.items())),
+                              attendance_by_class={class_id: dict(sorted(dates.items()))
+                                                   for class_id, dates in attendance_by_class.items()})
+
+    def snapshot(self):
+        """
+        Return the current aggregates, as AttendanceAggregates.snapshot();
+        the result is shared and must not be modified
+        """
+        with self.database.snapshot() as conn:
+            version = (self.database.revision('attendance'), self.database.revision('enrollments'))
+            with self._lock:
+                state = self._state
+            if state is not None and state[:2] == version:
+                return state[3]
+
+            if state is not None and state[1] == version[1]:
+                last_seq, snapshot = self._count_new(conn, state[2], state[3])
+            else:
+                last_seq, snapshot = self._count(conn)
+
+        with self._lock:
+            self._state = version + (last_seq, snapshot)
+        return snapshot
+
+
+class SQLitePresence:
+    """
+    The chatbot questions of presence.PresenceIndex, as queries
+
+    As with PresenceIndex, someone is present in a class on a date if they
+    were marked present with that class on their record and are still
+    enrolled in it. Class questions filter on the recorded class, so they
+    read the (class_id, date) index, and nothing is held in memory.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    @staticmethod
+    def _present(dates, class_id):
+        """Return the FROM and WHERE clauses selecting the present marks on dates, and their parameters"""
+        sql = (' FROM attendance a JOIN enrollments e ON e.id = a.person_id AND e.class_id = a.class_id'
+               ' WHERE a.date IN (SELECT value FROM json_each(?))')
+        params = [json.dumps(sorted(set(dates)))]
+        if class_id is not None:
+            sql += ' AND a.class_id = ?'
+            params.append(class_id)
+        return sql, params
+
+    def _ids(self, sql, params):
+        return {person_id for person_id, in self.database.connection().execute(sql, params)}
+
+    # Queries
+
+    def has_date(self, date):
+        """Return whether anyone was marked present on date"""
+        row = self.database.connection().execute('SELECT 1 FROM attendance WHERE date = ? LIMIT 1', (date,)).fetchone()
+        return row is not None
+
+    def dates(self, date_from=None, date_to=None):
+        """Return the dates with any attendance, between the given bounds inclusive, in order"""
+        clauses = []
+        params = []
+        if date_from is not None:
+            clauses.append('date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append('date <= ?')
+            params.append(date_to)
+        rows = self.database.connection().execute(
+            f'SELECT DISTINCT date FROM attendance{_where(clauses)} ORDER BY date', params)
+        return [date for date, in rows]
+
+    def class_size(self, class_id=None):
+        """Return the number of people enrolled in class_id, or in any class if None"""
+        if class_id is None:
+            return self.database.connection().execute('SELECT COUNT(*) FROM enrollments').fetchone()[0]
+        return self.database.connection().execute(
+            'SELECT COUNT(*) FROM enrollments WHERE class_id = ?', (class_id,)).fetchone()[0]
+
+    def present(self, date, class_id=None):
+        """Return the ids of the members of class_id (any class if None) present on date"""
+        sql, params = self._present([date], class_id)
+        return self._ids(f'SELECT a.person_id{sql}', params)
+
+    def absent(self, date, class_id=None):
+        """Return the ids of the members of class_id (any class if None) not present on date"""
+        return self.absent_at_least([date], 1, class_id)
+
+    def attendance_rate(self, dates, class_id=None):
+        """
+        Return how much of class_id (any class if None) was present over dates
+
+        Returns:
+            Tuple of (presences, possible): the number of (person, date)
+            presences of current members and members x dates
+        """
+        sql, params = self._present(dates, class_id)
+        with self.database.snapshot() as conn:
+            presences = conn.execute(f'SELECT COUNT(*){sql}', params).fetchone()[0]
+            return presences, self.class_size(class_id) * len(set(dates))
+
+    def present_at_least(self, dates, days, class_id=None):
+        """
+        Return the ids of the members of class_id (any class if None) who
+        were present on at least `days` of the given dates
+        """
+        if days <= 0:
+            raise ValueError('threshold must be positive')
+        sql, params = self._present(dates, class_id)
+        return self._ids(f'SELECT a.person_id{sql} GROUP BY a.person_id HAVING COUNT(*) >= ?', params + [days])
+
+    def absent_at_least(self, dates, days, class_id=None):
+        """
+        Return the ids of the members of class_id (any class if None) who
+        were absent on at least `days` of the given dates
+        """
+        if days <= 0:
+            raise ValueError('threshold must be positive')
+        sql, params = self._present(dates, class_id)
+        clauses = ['? - COALESCE(p.days, 0) >= ?']
+        params += [len(set(dates)), days]
+        if class_id is not None:
+            clauses.append('m.class_id = ?')
+            params.append(class_id)
+        return self._ids(f'SELECT m.id FROM enrollments m LEFT JOIN (SELECT a.person_id, COUNT(*) AS days{sql} '
+                         f'GROUP BY a.person_id) p ON p.person_id = m.id{_where(clauses)}', params)
+
+
+def migrate_json(enrollments_path, attendance_path, classes_path, database_path, overwrite=False):
+    """
+    Copy the JSON data files into a new SQLite database
+
+    Args:
+        enrollments_path: Path of enrollments.json
+        attendance_path: Path of attendance.json; its journal is included
+        classes_path: Path of classes.json
+        database_path: Database file to create
+        overwrite: Replace an existing database file
+
+    Returns:
+        Dict with the number of classes, enrollments and attendance records
+        migrated
+    """
+    if os.path.exists(database_path):
+        if not overwrite:
+            raise FileExistsError(f"{database_path} already exists")
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(database_path + suffix)
+            except FileNotFoundError:
+                pass
+
+    with open(enrollments_path, 'r') as f:
+        enrollments = json.load(f)
+    try:
+        with open(classes_path, 'r') as f:
+            classes = json.load(f)
+    except FileNotFoundError:
+        classes = []
+    attendance = storage.AttendanceLog(attendance_path).as_dict()
+
+    templates = face_utils.pack_templates([record.get('encoding') for record in enrollments])
+    enrollment_rows = []
+    for record, template in zip(enrollments, templates):
+        metadata, thumbnail = split_enrollment(record, template)
+        enrollment_rows.append(_enrollment_row(metadata, template, thumbnail))
+
+    database = Database(database_path)
+    with database.transaction() as conn:
+        conn.executemany('INSERT INTO classes (id, name, created_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET name = excluded.name, created_at = excluded.created_at',
+                         [(cls['id'], cls['name'], cls.get('created_at')) for cls in classes])
+        conn.executemany('INSERT OR IGNORE INTO enrollments (id, name, class_id, enrolled_at, template, thumbnail, data) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)', enrollment_rows)
+        conn.executemany('INSERT OR IGNORE INTO attendance (person_id, date, time, class_id) VALUES (?, ?, ?, ?)',
+                         ((record['id'], date, record['time'], record.get('class_id'))
+                          for date, records in attendance.items() for record in records))
+        counts = {name: conn.execute(f'SELECT COUNT(*) FROM {name}').fetchone()[0]
+                  for name in ('classes', 'enrollments', 'attendance')}
+        for name in counts:
+            database.touch(conn, name)
+
+    if counts['enrollments'] < len(enrollments):
+        logger.warning(f"Skipped {len(enrollments) - counts['enrollments']} enrollments with duplicate ids")
+    logger.info(f"Migrated {counts} from the JSON files to {database_path}")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy the JSON data files into an SQLite database')
+    parser.add_argument('database', nargs='?', default='attendance.db')
+    parser.add_argument('--enrollments', default='enrollments.json')
+    parser.add_argument('--attendance', default='attendance.json')
+    parser.add_argument('--classes', default='classes.json')
+    parser.add_argument('--force', action='store_true', help='overwrite an existing database')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        counts = migrate_json(args.enrollments, args.attendance, args.classes, args.database, overwrite=args.force)
+    except FileExistsError as e:
+        sys.exit(f"{e}; use --force to overwrite it")
+    print(f"Migrated {counts['enrollments']} enrollments, {counts['attendance']} attendance records and "
+          f"{counts['classes']} classes to {args.database}; set STORAGE_BACKEND=sqlite to use it")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
+// Records are fetched from /api/attendance one page at a time: the first
+// page when the filters change, the next ones as the user scrolls down
+const PAGE_SIZE = 100;
+
+// Paging state for the current filters
+let nextCursor = null;
+let loadedCount = 0;
+let loading = false;
+let requestGeneration = 0;
+
+// Class id -> name, for the Class column
+let classNames = {};
+
 // Load attendance records when visiting the records page
 document.addEventListener('DOMContentLoaded', () => {
-    // Load classes for the class filter
-    loadClasses();
-    
     // Filter attendance records by date
     const dateFilter = document.getElementById('dateFilter');
     
@@ -22,61 +32,158 @@ document.addEventListener('DOMContentLoaded', () => {
         classFilter.addEventListener('change', filterRecords);
     }
     
+    // Load more records on demand, and automatically when the end of the
+    // table scrolls into view
+    const loadMoreBtn = document.getElementById('loadMoreBtn');
+    if (loadMoreBtn) {
+        loadMoreBtn.addEventListener('click', loadNextPage);
+    }
+    const sentinel = document.getElementById('recordsSentinel');
+    if (sentinel && 'IntersectionObserver' in window) {
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextPage();
+            }
+        }).observe(sentinel);
+    }
+    
     // Set up export buttons
     setupExportButtons();
     
-    // Initial filter
-    filterRecords();
+    // Load classes for the class filter and names, then the first page
+    loadClasses().finally(filterRecords);
 });
 
-// Filter attendance records by date and class
+// Start over from the first page of records matching the filters
 function filterRecords() {
+    const recordsBody = document.getElementById('recordsBody');
+    if (recordsBody) {
+        recordsBody.innerHTML = '';
+    }
+    
+    nextCursor = null;
+    loadedCount = 0;
+    loading = false;
+    requestGeneration++;
+    
+    loadNextPage(true);
+    
+    // Update export buttons with current filters
+    updateExportUrls();
+}
+
+// Query string for the current filters and page
+function attendanceQuery(cursor) {
     const dateFilter = document.getElementById('dateFilter');
     const classFilter = document.getElementById('classFilter');
-    const recordRows = document.querySelectorAll('.attendance-record');
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
     
-    if (!recordRows) return;
+    // A single day is a one-day range, so days without records show none
+    if (dateFilter && dateFilter.value) {
+        params.append('from', dateFilter.value);
+        params.append('to', dateFilter.value);
+    }
     
-    const selectedDate = dateFilter ? dateFilter.value : '';
-    const selectedClass = classFilter ? classFilter.value : '';
+    // Filter on the class shown in each row, as the page always has
+    if (classFilter && classFilter.value) {
+        params.append('record_class_id', classFilter.value);
+    }
     
-    // Show/hide rows based on filters
-    recordRows.forEach(row => {
-        const recordDate = row.getAttribute('data-date');
-        const recordClass = row.getAttribute('data-class-id');
-        
-        const dateMatch = !selectedDate || recordDate === selectedDate;
-        const classMatch = !selectedClass || recordClass === selectedClass;
+    if (cursor) {
+        params.append('cursor', cursor);
+    }
+    
+    return params.toString();
+}
+
+// Fetch and append the next page of records
+function loadNextPage(firstPage = false) {
+    if (loading || (!firstPage && !nextCursor)) return;
+    
+    loading = true;
+    const generation = requestGeneration;
+    
+    fetch(`/api/attendance?${attendanceQuery(firstPage ? null : nextCursor)}`)
+        .then(response => response.json())
+        .then(data => {
+            // Ignore pages of filters that have changed since
+            if (generation !== requestGeneration) return;
+            
+            if (data.success) {
+                appendRecords(data.records);
+                nextCursor = data.next_cursor;
+                updateSummary(data.total);
+            } else {
+                console.error('Error loading attendance records:', data.error);
+            }
+        })
+        .catch(error => {
+            console.error('Error fetching attendance records:', error);
+        })
+        .finally(() => {
+            if (generation === requestGeneration) {
+                loading = false;
+            }
+        });
+}
+
+// Add table rows for a page of records
+function appendRecords(records) {
+    const recordsBody = document.getElementById('recordsBody');
+    if (!recordsBody) return;
+    
+    const fragment = document.createDocumentFragment();
+    records.forEach(record => {
+        const row = document.createElement('tr');
+        row.className = 'attendance-record';
+        row.dataset.date = record.date;
+        row.dataset.classId = record.class_id;
         
-        if (dateMatch && classMatch) {
-            row.style.display = '';
-        } else {
-            row.style.display = 'none';
-        }
+        const className = classNames[record.class_id] || 'Default Class';
+        [record.name, className, record.date, record.time].forEach((value, index) => {
+            const cell = document.createElement('td');
+            if (index === 1) {
+                cell.className = 'class-name';
+            }
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        fragment.appendChild(row);
     });
     
-    // Show message if no records match the filter
-    const visibleRows = document.querySelectorAll('.attendance-record:not([style*="display: none"])');
+    recordsBody.appendChild(fragment);
+    loadedCount += records.length;
+}
+
+// Show the record count and whether more pages are available
+function updateSummary(total) {
+    const summary = document.getElementById('recordsSummary');
     const noRecordsMessage = document.getElementById('noRecordsMessage');
+    const loadMoreBtn = document.getElementById('loadMoreBtn');
+    
+    if (summary) {
+        summary.textContent = total ? `Showing ${loadedCount} of ${total} records` : '';
+    }
     
     if (noRecordsMessage) {
-        if (visibleRows.length === 0) {
-            noRecordsMessage.style.display = '';
-        } else {
-            noRecordsMessage.style.display = 'none';
-        }
+        noRecordsMessage.style.display = total ? 'none' : '';
     }
     
-    // Update export buttons with current filters
-    updateExportUrls();
+    if (loadMoreBtn) {
+        loadMoreBtn.style.display = nextCursor ? '' : 'none';
+    }
 }
 
 // Load classes for the dropdown
 function loadClasses() {
-    fetch('/api/classes')
+    return fetch('/api/classes')
         .then(response => response.json())
         .then(data => {
             if (data.success) {
+                classNames = {};
+                data.classes.forEach(classItem => {
+                    classNames[classItem.id] = classItem.name;
+                });
                 populateClassDropdown(data.classes);
             } else {
                 console.error('Error loading classes:', data.error);
@@ -124,10 +231,7 @@ function setupExportButtons() {
     if (exportPdfBtn) {
         exportPdfBtn.addEventListener('click', function(e) {
             e.preventDefault();
-            const url = this.getAttribute('data-url');
-            if (url) {
-                window.location.href = url;
-            }
+            exportPdf(this);
         });
     }
     
@@ -135,15 +239,54 @@ function setupExportButtons() {
     updateExportUrls();
 }
 
-// Update export URLs based on current filters
-function updateExportUrls() {
-    const exportCsvBtn = document.getElementById('exportCsvBtn');
-    const exportPdfBtn = document.getElementById('exportPdfBtn');
-    const dateFilter = document.getElementById('dateFilter');
-    const classFilter = document.getElementById('classFilter');
+// PDF reports are rendered in the background: start the job, poll its
+// status and download the report once it is ready
+function exportPdf(button) {
+    if (button.classList.contains('disabled')) return;
     
-    if (!exportCsvBtn && !exportPdfBtn) return;
+    const label = button.textContent;
+    button.classList.add('disabled');
+    button.textContent = 'Preparing PDF...';
+    
+    const finish = () => {
+        button.classList.remove('disabled');
+        button.textContent = label;
+    };
+    
+    const poll = data => {
+        if (!data.success || data.status === 'failed') {
+            console.error('Error generating PDF report:', data.error);
+            alert('Error exporting data. Please try again.');
+            finish();
+        } else if (data.status === 'done') {
+            window.location.href = data.download_url;
+            finish();
+        } else {
+            setTimeout(() => {
+                fetch(data.status_url)
+                    .then(response => response.json())
+                    .then(poll)
+                    .catch(error => {
+                        console.error('Error checking PDF report:', error);
+                        finish();
+                    });
+            }, 1000);
+        }
+    };
     
+    fetch(`/api/reports/attendance_pdf?${exportQuery().toString()}`, { method: 'POST' })
+        .then(response => response.json())
+        .then(poll)
+        .catch(error => {
+            console.error('Error starting PDF report:', error);
+            finish();
+        });
+}
+
+// Export filters matching the current page filters
+function exportQuery() {
+    const dateFilter = document.getElementById('dateFilter');
+    const classFilter = document.getElementById('classFilter');
     const params = new URLSearchParams();
     
     if (dateFilter && dateFilter.value) {
@@ -154,6 +297,17 @@ function updateExportUrls() {
         params.append('class_id', classFilter.value);
     }
     
+    return params;
+}
+
+// Update export URLs based on current filters
+function updateExportUrls() {
+    const exportCsvBtn = document.getElementById('exportCsvBtn');
+    const exportPdfBtn = document.getElementById('exportPdfBtn');
+    
+    if (!exportCsvBtn && !exportPdfBtn) return;
+    
+    const params = exportQuery();
     const queryString = params.toString() ? `?${params.toString()}` : '';
     
     if (exportCsvBtn) {
@@ -2,9 +2,53 @@
 
 let videoElement = document.getElementById('videoElement');
 let captureButton = document.getElementById('captureButton');
+let autoScanButton = document.getElementById('autoScanButton');
 let recognitionResult = document.getElementById('recognitionResult');
 let cameraStream = null;
 
+// Frames are compared by a small grayscale copy; a frame whose average
+// pixel differs from the last one sent by less than CHANGE_THRESHOLD (of
+// 255) shows the same scene and is not uploaded again
+const SIGNATURE_WIDTH = 32;
+const SIGNATURE_HEIGHT = 24;
+const CHANGE_THRESHOLD = 6;
+
+// The result of a manual capture is reused for an unchanged scene this long
+const RESULT_REUSE_MS = 10000;
+
+// While scanning automatically, the camera is sampled every
+// SAMPLE_INTERVAL_MS and changed frames are sent BATCH_SIZE at a time, or
+// once the oldest has waited BATCH_MAX_WAIT_MS
+const SAMPLE_INTERVAL_MS = 400;
+const BATCH_SIZE = 3;
+const BATCH_MAX_WAIT_MS = 1000;
+
+// Upload sizes from best to lightest. Slow or busy responses move to a
+// lighter one, a run of fast responses back to a better one.
+const QUALITY_LEVELS = [
+    { scale: 1.0, quality: 0.9 },
+    { scale: 1.0, quality: 0.75 },
+    { scale: 0.75, quality: 0.7 },
+    { scale: 0.5, quality: 0.6 }
+];
+const SLOW_RESPONSE_MS = 1500;
+const FAST_RESPONSE_MS = 400;
+const FAST_RESPONSES_TO_RECOVER = 5;
+
+// Wait before retrying when the server is busy without saying for how long
+const DEFAULT_RETRY_MS = 2000;
+
+let signatureCanvas = null;
+let qualityLevel = 0;
+let fastResponses = 0;
+let retryAt = 0;                  // No uploads before this time, as asked by the server
+let lastCapture = null;           // { signature, result, at } of the last manual capture
+let scanTimer = null;
+let lastScanSignature = null;     // Signature of the last frame queued while scanning
+let queuedFrames = [];
+let batchTimer = null;
+let uploadingBatch = false;
+
 // Initialize the camera when the page loads
 document.addEventListener('DOMContentLoaded', () => {
     initCamera();
@@ -26,10 +70,13 @@ function initCamera() {
             videoElement.srcObject = stream;
             videoElement.play();
             
-            // Enable the capture button once camera is working
+            // Enable the capture buttons once camera is working
             if (captureButton) {
                 captureButton.disabled = false;
             }
+            if (autoScanButton) {
+                autoScanButton.disabled = false;
+            }
         })
         .catch(function(error) {
             console.error("Camera error:", error);
@@ -49,7 +96,38 @@ function initCamera() {
     }
 }
 
-// Capture a frame from the video stream
+// Compute the grayscale signature of the current video frame
+function frameSignature() {
+    if (!signatureCanvas) {
+        signatureCanvas = document.createElement('canvas');
+        signatureCanvas.width = SIGNATURE_WIDTH;
+        signatureCanvas.height = SIGNATURE_HEIGHT;
+    }
+    const context = signatureCanvas.getContext('2d', { willReadFrequently: true });
+    context.drawImage(videoElement, 0, 0, SIGNATURE_WIDTH, SIGNATURE_HEIGHT);
+    const pixels = context.getImageData(0, 0, SIGNATURE_WIDTH, SIGNATURE_HEIGHT).data;
+    
+    const signature = new Uint8Array(SIGNATURE_WIDTH * SIGNATURE_HEIGHT);
+    for (let i = 0; i < signature.length; i++) {
+        // Luma from the red, green and blue channels
+        signature[i] = (77 * pixels[4 * i] + 150 * pixels[4 * i + 1] + 29 * pixels[4 * i + 2]) >> 8;
+    }
+    return signature;
+}
+
+// Tell whether two signatures show the same scene
+function sameScene(a, b) {
+    if (!a || !b) {
+        return false;
+    }
+    let difference = 0;
+    for (let i = 0; i < a.length; i++) {
+        difference += Math.abs(a[i] - b[i]);
+    }
+    return difference / a.length < CHANGE_THRESHOLD;
+}
+
+// Capture a frame from the video stream, at the current upload quality
 function captureFrame() {
     return new Promise((resolve, reject) => {
         if (!videoElement || !cameraStream) {
@@ -58,9 +136,10 @@ function captureFrame() {
         }
         
         // Create a canvas element to capture the frame
+        const level = QUALITY_LEVELS[qualityLevel];
         const canvas = document.createElement('canvas');
-        canvas.width = videoElement.videoWidth;
-        canvas.height = videoElement.videoHeight;
+        canvas.width = Math.round(videoElement.videoWidth * level.scale);
+        canvas.height = Math.round(videoElement.videoHeight * level.scale);
         
         // Draw the current video frame to the canvas
         const context = canvas.getContext('2d');
@@ -69,8 +148,105 @@ function captureFrame() {
         // Convert the canvas to a blob
         canvas.toBlob((blob) => {
             resolve(blob);
-        }, 'image/jpeg', 0.9);
+        }, 'image/jpeg', level.quality);
+    });
+}
+
+// Adapt the upload quality to how quickly the server answered
+function adjustQuality(elapsedMs, busy) {
+    if (busy || elapsedMs > SLOW_RESPONSE_MS) {
+        qualityLevel = Math.min(qualityLevel + 1, QUALITY_LEVELS.length - 1);
+        fastResponses = 0;
+    } else if (elapsedMs < FAST_RESPONSE_MS && ++fastResponses >= FAST_RESPONSES_TO_RECOVER) {
+        qualityLevel = Math.max(qualityLevel - 1, 0);
+        fastResponses = 0;
+    }
+}
+
+// Read the Retry-After header of a busy response, in milliseconds
+function retryDelay(response) {
+    const header = response.headers.get('Retry-After');
+    if (header) {
+        const seconds = Number(header);
+        if (!isNaN(seconds)) {
+            return seconds * 1000;
+        }
+        const date = Date.parse(header);
+        if (!isNaN(date)) {
+            return Math.max(date - Date.now(), 0);
+        }
+    }
+    return DEFAULT_RETRY_MS;
+}
+
+// Post frames for recognition, backing off while the server is busy
+async function postFrames(url, formData) {
+    const started = performance.now();
+    const response = await fetch(url, {
+        method: 'POST',
+        body: formData
     });
+    
+    const busy = response.status === 429 || response.status === 503;
+    if (busy) {
+        retryAt = Date.now() + retryDelay(response);
+    }
+    adjustQuality(performance.now() - started, busy);
+    if (busy) {
+        return { success: false, busy: true };
+    }
+    return await response.json();
+}
+
+// Show the server's answer for a recognized (or unrecognized) face
+function showResult(result) {
+    if (!recognitionResult) {
+        return;
+    }
+    
+    if (result.success) {
+        if (result.recognized) {
+            // Person recognized
+            recognitionResult.className = 'recognition-result recognition-success';
+            if (result.newAttendance) {
+                recognitionResult.innerHTML = `
+                    <h4>Welcome, ${result.name}!</h4>
+                    <p>Your attendance has been recorded.</p>
+                `;
+            } else {
+                recognitionResult.innerHTML = `
+                    <h4>Hello again, ${result.name}!</h4>
+                    <p>${result.message}</p>
+                `;
+            }
+        } else {
+            // No match found
+            recognitionResult.className = 'recognition-result recognition-warning';
+            recognitionResult.innerHTML = `
+                <h4>Face not recognized</h4>
+                <p>Please enroll in the system or try again.</p>
+            `;
+        }
+    } else {
+        // Error in processing
+        recognitionResult.className = 'recognition-result recognition-error';
+        recognitionResult.innerHTML = `
+            <h4>Error</h4>
+            <p>${result.error || 'Failed to process face recognition'}</p>
+        `;
+    }
+}
+
+// Show that the server asked to wait before sending more frames
+function showBusy() {
+    if (recognitionResult) {
+        const seconds = Math.max(Math.ceil((retryAt - Date.now()) / 1000), 1);
+        recognitionResult.className = 'recognition-result recognition-warning';
+        recognitionResult.innerHTML = `
+            <h4>Server busy</h4>
+            <p>Please try again in ${seconds} second${seconds === 1 ? '' : 's'}.</p>
+        `;
+    }
 }
 
 // Capture and recognize face
@@ -80,6 +256,18 @@ async function captureFace() {
     }
     
     try {
+        if (Date.now() < retryAt) {
+            showBusy();
+            return;
+        }
+        
+        // An unchanged scene gets the same answer as a moment ago
+        const signature = frameSignature();
+        if (lastCapture && Date.now() - lastCapture.at < RESULT_REUSE_MS && sameScene(signature, lastCapture.signature)) {
+            showResult(lastCapture.result);
+            return;
+        }
+        
         // Update UI to show we're processing
         if (recognitionResult) {
             recognitionResult.className = 'recognition-result recognition-warning';
@@ -94,44 +282,14 @@ async function captureFace() {
         formData.append('image', imageBlob, 'capture.jpg');
         
         // Send to server for recognition
-        const response = await fetch('/api/recognize', {
-            method: 'POST',
-            body: formData
-        });
-        
-        const result = await response.json();
-        
-        if (result.success) {
-            if (result.recognized) {
-                // Person recognized
-                recognitionResult.className = 'recognition-result recognition-success';
-                if (result.newAttendance) {
-                    recognitionResult.innerHTML = `
-                        <h4>Welcome, ${result.name}!</h4>
-                        <p>Your attendance has been recorded.</p>
-                    `;
-                } else {
-                    recognitionResult.innerHTML = `
-                        <h4>Hello again, ${result.name}!</h4>
-                        <p>${result.message}</p>
-                    `;
-                }
-            } else {
-                // No match found
-                recognitionResult.className = 'recognition-result recognition-warning';
-                recognitionResult.innerHTML = `
-                    <h4>Face not recognized</h4>
-                    <p>Please enroll in the system or try again.</p>
-                `;
-            }
-        } else {
-            // Error in processing
-            recognitionResult.className = 'recognition-result recognition-error';
-            recognitionResult.innerHTML = `
-                <h4>Error</h4>
-                <p>${result.error || 'Failed to process face recognition'}</p>
-            `;
+        const result = await postFrames('/api/recognize', formData);
+        if (result.busy) {
+            showBusy();
+            return;
         }
+        
+        showResult(result);
+        lastCapture = result.success ? { signature: signature, result: result, at: Date.now() } : null;
     } catch (error) {
         console.error("Error during face capture:", error);
         if (recognitionResult) {
@@ -148,6 +306,103 @@ async function captureFace() {
     }
 }
 
+// Start or stop recognizing automatically, for unattended kiosks
+function toggleAutoScan() {
+    if (scanTimer) {
+        clearInterval(scanTimer);
+        clearTimeout(batchTimer);
+        scanTimer = null;
+        batchTimer = null;
+        queuedFrames = [];
+        lastScanSignature = null;
+    } else {
+        scanTimer = setInterval(sampleFrame, SAMPLE_INTERVAL_MS);
+    }
+    
+    if (autoScanButton) {
+        autoScanButton.classList.toggle('btn-success', !scanTimer);
+        autoScanButton.classList.toggle('btn-danger', !!scanTimer);
+        autoScanButton.querySelector('.auto-scan-label').textContent = scanTimer ? 'Stop Scanning' : 'Auto Scan';
+    }
+}
+
+// Queue the current frame for recognition if the scene changed
+async function sampleFrame() {
+    if (!cameraStream || !videoElement.videoWidth || Date.now() < retryAt) {
+        return;
+    }
+    
+    const signature = frameSignature();
+    if (sameScene(signature, lastScanSignature)) {
+        return;
+    }
+    lastScanSignature = signature;
+    
+    try {
+        queuedFrames.push(await captureFrame());
+    } catch (error) {
+        console.error("Error capturing frame:", error);
+        return;
+    }
+    // Keep only the newest frames while a batch is on its way
+    queuedFrames = queuedFrames.slice(-BATCH_SIZE);
+    
+    if (queuedFrames.length >= BATCH_SIZE) {
+        sendBatch();
+    } else if (!batchTimer) {
+        batchTimer = setTimeout(sendBatch, BATCH_MAX_WAIT_MS);
+    }
+}
+
+// Send the queued frames in one request
+async function sendBatch() {
+    clearTimeout(batchTimer);
+    batchTimer = null;
+    if (uploadingBatch || !queuedFrames.length) {
+        return;
+    }
+    
+    const frames = queuedFrames;
+    queuedFrames = [];
+    uploadingBatch = true;
+    try {
+        const formData = new FormData();
+        frames.forEach((frame, i) => formData.append('images', frame, `frame${i}.jpg`));
+        
+        const result = await postFrames('/api/recognize/batch', formData);
+        if (result.busy) {
+            // The frames are stale by the time the server can take them
+            queuedFrames = [];
+            lastScanSignature = null;
+            showBusy();
+            return;
+        }
+        if (!result.success) {
+            showResult(result);
+            return;
+        }
+        
+        // Show a newly recorded person first, then anyone recognized
+        const results = result.results;
+        const shown = results.find(r => r.recognized && r.newAttendance)
+            || results.find(r => r.recognized)
+            || results.find(r => !r.error);
+        if (shown) {
+            showResult(Object.assign({ success: true }, shown));
+        }
+    } catch (error) {
+        console.error("Error sending frames:", error);
+    } finally {
+        uploadingBatch = false;
+        // Frames queued meanwhile go out now if there are enough of them
+        if (scanTimer && queuedFrames.length >= BATCH_SIZE) {
+            sendBatch();
+        } else if (scanTimer && queuedFrames.length && !batchTimer) {
+            batchTimer = setTimeout(sendBatch, BATCH_MAX_WAIT_MS);
+        }
+    }
+}
+
 // Stop camera when leaving the page
 window.addEventListener('beforeunload', () => {
     if (cameraStream) {
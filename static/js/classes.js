@@ -5,12 +5,17 @@ document.addEventListener('DOMContentLoaded', function() {
     setupEventListeners();
 });
 
+// Version of the class list on screen, sent with changes so they are
+// refused if someone else changed the classes meanwhile
+let classesVersion = null;
+
 // Load all classes
 function loadClasses() {
     fetch('/api/classes')
         .then(response => response.json())
         .then(data => {
             if (data.success) {
+                classesVersion = data.version;
                 displayClasses(data.classes);
                 populateClassDropdowns(data.classes);
             } else {
@@ -194,12 +199,17 @@ async function deleteClass(classId) {
     
     try {
         const response = await fetch(`/api/classes/${classId}`, {
-            method: 'DELETE'
+            method: 'DELETE',
+            headers: classesVersion ? { 'If-Match': `"${classesVersion}"` } : {}
         });
         
         const data = await response.json();
         
-        if (data.success) {
+        if (response.status === 409) {
+            alert(data.error);
+            loadClasses();
+            loadEnrollments();
+        } else if (data.success) {
             alert(`Class deleted successfully. ${data.message}`);
             
             // Reload data
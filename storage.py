@@ -0,0 +1,782 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; locking becomes a no-op
+    fcntl = None
+
+import face_utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLASS_ID = 'default'
+
+# The attendance journal is folded into the snapshot once it grows past
+# the snapshot's own size (and at least this many bytes), which keeps the
+# cost of compaction constant per mark on average
+MIN_COMPACT_BYTES = 64 * 1024
+
+
+# Paths whose file_lock the current thread holds, with their nesting depth
+_held_locks = threading.local()
+
+
+class VersionConflict(Exception):
+    """Raised when a write was based on a version of the data that is no longer current"""
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive inter-process lock on path + '.lock'
+
+    The lock is reentrant within a thread, so a store method holding it
+    can call others that take it too.
+    """
+    held = _held_locks.__dict__.setdefault('depths', {})
+    if held.get(path):
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held[path] = 1
+        try:
+            yield
+        finally:
+            del held[path]
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_json_atomic(path, data):
+    """
+    Replace a JSON file atomically
+
+    The data goes to a temporary file next to path, which is flushed to
+    disk and then renamed over path, so readers in other processes see
+    either the old or the new contents, never a truncated file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def file_stamp(path):
+    """
+    Return (inode, mtime_ns, size) of a file or None if missing
+
+    Every atomic write creates a new inode, so the stamp changes with each
+    write even within the file system's timestamp resolution.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def version_tag(stamp):
+    """Return a file stamp as a short string for clients to send back"""
+    if stamp is None:
+        return None
+    return '-'.join(format(value, 'x') for value in stamp)
+
+
+class EnrollmentStore:
+    """
+    Process-level cache of the records in the enrollments file
+
+    The file is parsed once and kept in memory together with an
+    id -> {name, class_id} index. Every accessor compares the file's
+    modification stamp against the one that was loaded, so changes made by
+    other processes are picked up, while writes made through the store
+    update the cache directly without re-reading the file.
+
+    The returned records are shared with the cache and must not be modified
+    by callers; use the mutator methods instead. Mutators hold an
+    inter-process lock on the file, apply the change to its latest
+    contents and replace it atomically, so concurrent writers in several
+    processes don't lose each other's updates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = 0
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._loaded = False
+        self._records = []
+        self._by_id = {}
+        self._by_class = {}
+        self._info = {}
+        self._face_index = None
+        self._listeners = []
+
+    def _file_stamp(self):
+        return file_stamp(self.path)
+
+    def _read(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, records):
+        write_json_atomic(self.path, records)
+
+    def subscribe(self, listener):
+        """
+        Call listener(event, payload) after every change to the enrollments
+
+        Events are 'reload' with the full list of records after they were
+        (re)loaded from disk, 'add' and 'remove' with a list of records, and
+        'update' with a list of (old, new) record pairs. Listeners run with
+        the store's lock held and must not call back into the store.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            if self._loaded:
+                listener('reload', self._records)
+
+    def _notify(self, event, payload):
+        for listener in self._listeners:
+            listener(event, payload)
+
+    def _set_records(self, records, stamp, face_index=None, change=None):
+        """
+        Replace the cached records and rebuild the lookup indexes
+
+        A face index that was already updated to match records can be
+        passed in to be kept; otherwise it is rebuilt on next use. change
+        is the (event, payload) to report to listeners, a reload if None.
+        """
+        by_id = {}
+        by_class = {}
+        info = {}
+        for record in records:
+            class_id = record.get('class_id', DEFAULT_CLASS_ID)
+            by_id[record['id']] = record
+            by_class.setdefault(class_id, []).append(record)
+            info[record['id']] = {'name': record['name'], 'class_id': class_id}
+
+        self._records = records
+        self._by_id = by_id
+        self._by_class = by_class
+        self._info = info
+        self._face_index = face_index
+        self._stamp = stamp
+        self._loaded = True
+        self.version += 1
+        self._notify(*(change or ('reload', records)))
+
+    def refresh(self):
+        """Reload the file if it changed since it was last loaded"""
+        stamp = self._file_stamp()
+        if self._loaded and stamp == self._stamp:
+            return
+
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return
+
+            if stamp is None:
+                self._set_records([], None)
+                return
+
+            try:
+                records = self._read()
+            except (FileNotFoundError, json.JSONDecodeError):
+                # A partially written file; keep what we have and retry on
+                # the next access
+                logger.warning(f"Could not read {self.path}, using cached enrollments")
+                if not self._loaded:
+                    self._set_records([], None)
+                    self._stamp = None
+                return
+
+            logger.debug(f"Loaded {len(records)} enrollments from {self.path}")
+            self._set_records(records, stamp)
+
+    def _save(self, records, update_index=None, change=None):
+        """
+        Write records to disk and make them the cached state
+
+        Args:
+            update_index: Function applying the same change to the face
+                index in place, so it doesn't need a rebuild
+            change: (event, payload) describing the change to listeners;
+                reported as a reload if None
+        """
+        self._write(records)
+        self._cache(records, update_index, change)
+
+    def _cache(self, records, update_index=None, change=None):
+        """Make records, already saved, the cached state; see _save"""
+        face_index = self._face_index
+        if face_index is not None and update_index is not None:
+            update_index(face_index)
+        else:
+            face_index = None
+        self._set_records(records, self._file_stamp(), face_index, change)
+
+    # Accessors
+
+    def all(self):
+        """Return the list of all enrollment records"""
+        self.refresh()
+        return self._records
+
+    def count(self):
+        self.refresh()
+        return len(self._records)
+
+    def get(self, person_id):
+        """Return the enrollment record for person_id or None"""
+        self.refresh()
+        return self._by_id.get(person_id)
+
+    def for_class(self, class_id):
+        """Return the enrollment records that belong to class_id"""
+        self.refresh()
+        return self._by_class.get(class_id, [])
+
+    def info(self, person_id):
+        """Return {'name', 'class_id'} for person_id or None"""
+        self.refresh()
+        return self._info.get(person_id)
+
+    def id_to_info(self):
+        """Return the id -> {'name', 'class_id'} mapping for all enrollments"""
+        self.refresh()
+        return self._info
+
+    def stamp(self):
+        """
+        Return a token for the current enrollments that, unlike version,
+        is the same in every process and across restarts
+        """
+        self.refresh()
+        return self._stamp
+
+    def version_tag(self):
+        """Return the current version as a string, for optimistic concurrency checks by clients"""
+        return version_tag(self.stamp())
+
+    def _check_version(self, expected_version):
+        # Must be called with the locks held and the state refreshed
+        if expected_version is not None and expected_version != version_tag(self._stamp):
+            raise VersionConflict(f"{self.path} has changed since version {expected_version}")
+
+    def face_index(self):
+        """
+        Return a face_utils.FaceIndex over all enrollments
+
+        The index is built on first use and kept up to date by the store's
+        own writes; it is rebuilt when the file changes on disk.
+        """
+        self.refresh()
+        with self._lock:
+            if self._face_index is None:
+                self._face_index = self._build_face_index()
+            return self._face_index
+
+    def _build_face_index(self):
+        return face_utils.FaceIndex(self._records)
+
+    # Mutators
+
+    def add(self, record):
+        """Append a new enrollment record and save the file"""
+        self.add_many([record])
+
+    def add_many(self, records):
+        """Append new enrollment records and save the file once"""
+        records = list(records)
+
+        def update_index(index):
+            for record in records:
+                index.add(record)
+
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            self._save(self._records + records, update_index, ('add', records))
+
+    def remove(self, person_id, expected_version=None):
+        """
+        Remove the enrollment for person_id and save the file
+
+        Args:
+            person_id: Id of the enrollment
+            expected_version: version_tag() the caller based the removal
+                on, if it must not happen after other changes
+
+        Returns:
+            The removed record or None if no such enrollment exists
+
+        Raises:
+            VersionConflict: If expected_version is no longer current
+        """
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            self._check_version(expected_version)
+            removed = self._by_id.get(person_id)
+            if removed is None:
+                return None
+            self._save([r for r in self._records if r['id'] != person_id],
+                       lambda index: index.remove(person_id), ('remove', [removed]))
+            return removed
+
+    def reassign_class(self, old_class_id, new_class_id):
+        """
+        Move every enrollment in old_class_id to new_class_id
+
+        Returns:
+            Number of enrollments that were moved
+        """
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            records = []
+            moved = []
+            for record in self._records:
+                if record.get('class_id') == old_class_id:
+                    moved.append((record, dict(record, class_id=new_class_id)))
+                    record = moved[-1][1]
+                records.append(record)
+
+            if moved:
+                self._save(records, lambda index: index.update([new for old, new in moved], repack=False),
+                           ('update', moved))
+            return len(moved)
+
+    def update_encodings(self, encodings):
+        """
+        Replace the encodings of enrollments
+
+        Args:
+            encodings: Dict of person id -> new encoding
+
+        Returns:
+            Number of enrollments that were updated
+        """
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            records = []
+            updated = []
+            for record in self._records:
+                if record['id'] in encodings:
+                    updated.append((record, dict(record, encoding=encodings[record['id']])))
+                    record = updated[-1][1]
+                records.append(record)
+
+            if updated:
+                # The face index is rebuilt on next use
+                self._save(records, change=('update', updated))
+            return len(updated)
+
+
+class AttendanceLog:
+    """
+    Attendance records kept as a snapshot file plus an append-only journal
+
+    The snapshot (attendance.json) keeps the {date: [records]} layout. Each
+    new mark is appended to the journal as one JSON line, so recording
+    attendance doesn't rewrite the history. Records are held in memory
+    together with a per-day set of marked ids for duplicate checks; other
+    processes' appends are picked up by reading only the new journal bytes.
+    """
+
+    def __init__(self, path, journal_path=None):
+        self.path = path
+        self.journal_path = journal_path or os.path.splitext(path)[0] + '.log'
+        self.version = 0
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._snapshot_stamp = None
+        self._journal_id = None
+        self._journal_offset = 0
+        self._data = {}
+        self._marked = {}
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """
+        Call listener(event, payload) after every change to the attendance
+
+        Events are 'reload' with the {date: [records]} data after it was
+        (re)loaded from disk and 'mark' with a list of new (date, record)
+        pairs. Listeners run with the log's lock held and must not call
+        back into the log.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            if self._loaded:
+                listener('reload', self._data)
+
+    def _notify(self, event, payload):
+        for listener in self._listeners:
+            listener(event, payload)
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _apply(self, date, record):
+        """Add a record to the in-memory state unless the person is already marked"""
+        marked = self._marked.setdefault(date, set())
+        if record['id'] in marked:
+            return False
+        marked.add(record['id'])
+        self._data.setdefault(date, []).append(record)
+        return True
+
+    def _replay(self, start):
+        """
+        Apply complete journal lines from byte offset start onwards
+
+        Returns:
+            List of the (date, record) pairs that were new
+        """
+        with open(self.journal_path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+
+        # Only consume up to the last newline; a trailing partial line is
+        # still being written
+        end = data.rfind(b'\n') + 1
+        applied = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                date = entry.pop('date')
+            except (ValueError, KeyError):
+                logger.warning(f"Skipping malformed line in {self.journal_path}")
+                continue
+            if self._apply(date, entry):
+                applied.append((date, entry))
+        self._journal_offset = start + end
+        return applied
+
+    def _reload(self, snapshot_stat):
+        """Rebuild the in-memory state from the snapshot and the whole journal"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except json.JSONDecodeError:
+            logger.warning(f"Could not read {self.path}, using cached attendance")
+            if self._loaded:
+                return
+            data = {}
+
+        self._data = {}
+        self._marked = {}
+        for date, records in data.items():
+            self._data[date] = list(records)
+            self._marked[date] = {record['id'] for record in records}
+
+        self._snapshot_stamp = (snapshot_stat.st_mtime_ns, snapshot_stat.st_size) if snapshot_stat else None
+        self._journal_id = None
+        self._journal_offset = 0
+        journal_stat = self._stat(self.journal_path)
+        if journal_stat:
+            self._journal_id = journal_stat.st_ino
+            self._replay(0)
+        self._loaded = True
+
+    def refresh(self):
+        """Pick up changes to the snapshot or journal made by other processes"""
+        with self._lock:
+            snapshot_stat = self._stat(self.path)
+            snapshot_stamp = (snapshot_stat.st_mtime_ns, snapshot_stat.st_size) if snapshot_stat else None
+            journal_stat = self._stat(self.journal_path)
+
+            if (not self._loaded or snapshot_stamp != self._snapshot_stamp
+                    or (journal_stat is None and self._journal_offset)
+                    or (journal_stat and (journal_stat.st_ino != self._journal_id
+                                          or journal_stat.st_size < self._journal_offset))):
+                # The snapshot was rewritten or the journal truncated/replaced
+                self._reload(snapshot_stat)
+                self.version += 1
+                self._notify('reload', self._data)
+            elif journal_stat and journal_stat.st_size > self._journal_offset:
+                applied = self._replay(self._journal_offset)
+                self.version += 1
+                if applied:
+                    self._notify('mark', applied)
+
+    # Accessors
+
+    def as_dict(self):
+        """Return all attendance as {date: [records]}; must not be modified"""
+        self.refresh()
+        return self._data
+
+    def records_for(self, date):
+        """Return the attendance records for a date"""
+        self.refresh()
+        return self._data.get(date, [])
+
+    def is_marked(self, date, person_id):
+        self.refresh()
+        return person_id in self._marked.get(date, ())
+
+    def marks(self):
+        """Return all attendance as a new list of (date, person_id, class_id) tuples"""
+        with self._lock:
+            self.refresh()
+            return [(date, record['id'], record.get('class_id'))
+                    for date, records in self._data.items() for record in records]
+
+    def stamp(self):
+        """
+        Return a token for the current attendance that, unlike version, is
+        the same in every process and across restarts
+        """
+        with self._lock:
+            self.refresh()
+            return (self._snapshot_stamp, self._journal_id, self._journal_offset)
+
+    # Mutators
+
+    def mark(self, person_id, date, time, class_id=None):
+        """
+        Record attendance for a person unless already marked on that date
+
+        Returns:
+            True if a new record was added, False if it already existed
+        """
+        return self.mark_many([(person_id, date, time, class_id)])[0]
+
+    def mark_many(self, marks):
+        """
+        Record several attendance marks with a single journal write
+
+        Args:
+            marks: Iterable of (person_id, date, time, class_id) tuples;
+                class_id may be None
+
+        Returns:
+            List with True for each mark that added a new record and False
+            for people already marked on that date (including earlier in
+            the same batch)
+        """
+        with self._lock, file_lock(self.journal_path):
+            self.refresh()
+
+            added = []
+            applied = []
+            lines = []
+            for person_id, date, time, class_id in marks:
+                record = {'id': person_id, 'time': time}
+                if class_id is not None:
+                    record['class_id'] = class_id
+
+                is_new = self._apply(date, record)
+                added.append(is_new)
+                if is_new:
+                    applied.append((date, record))
+                    lines.append(json.dumps(dict({'date': date}, **record)) + '\n')
+
+            if not lines:
+                return added
+
+            data = ''.join(lines).encode('utf-8')
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                journal_stat = os.fstat(fd)
+                if journal_stat.st_size > self._journal_offset:
+                    # Terminate a partial line left by a crashed writer
+                    data = b'\n' + data
+                os.write(fd, data)
+            except OSError:
+                # The records were already applied in memory; rebuild from disk
+                self._loaded = False
+                raise
+            finally:
+                os.close(fd)
+
+            self._journal_id = journal_stat.st_ino
+            self._journal_offset = journal_stat.st_size + len(data)
+            self.version += 1
+            self._notify('mark', applied)
+
+            if self._journal_offset > max(MIN_COMPACT_BYTES, (self._snapshot_stamp or (0, 0))[1]):
+                self._compact()
+            return added
+
+    def compact(self):
+        """Fold the journal into the snapshot file"""
+        with self._lock, file_lock(self.journal_path):
+            self.refresh()
+            self._compact()
+
+    def _compact(self):
+        # Must be called with both locks held and the state refreshed
+        write_json_atomic(self.path, self._data)
+
+        # A crash before the truncate only leaves entries that are already
+        # in the snapshot, which are skipped on replay
+        with open(self.journal_path, 'w'):
+            pass
+
+        snapshot_stat = self._stat(self.path)
+        journal_stat = self._stat(self.journal_path)
+        self._snapshot_stamp = (snapshot_stat.st_mtime_ns, snapshot_stat.st_size)
+        self._journal_id = journal_stat.st_ino
+        self._journal_offset = 0
+        logger.info(f"Compacted attendance journal into {self.path}")
+
+
+class ClassStore:
+    """
+    Process-level cache of the classes file
+
+    Like EnrollmentStore, the list is reloaded when the file's stamp
+    changes and mutators lock the file, apply the change to its latest
+    contents and replace it atomically. A missing or unreadable file reads
+    as just the default class.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = 0
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._loaded = False
+        self._classes = []
+        self._names = {}
+
+    def _set_classes(self, classes, stamp):
+        self._classes = classes
+        self._names = {c['id']: c['name'] for c in classes}
+        self._stamp = stamp
+        self._loaded = True
+        self.version += 1
+
+    def refresh(self):
+        """Reload the file if it changed since it was last loaded"""
+        stamp = file_stamp(self.path)
+        if self._loaded and stamp == self._stamp:
+            return
+
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return
+
+            try:
+                with open(self.path, 'r') as f:
+                    classes = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                if stamp is not None:
+                    logger.warning(f"Could not read {self.path}, using the default class")
+                classes = [default_class()]
+            self._set_classes(classes, stamp)
+
+    # Accessors
+
+    def all(self):
+        """Return the list of class records; must not be modified"""
+        self.refresh()
+        return self._classes
+
+    def names(self):
+        """Return the class id -> name mapping"""
+        self.refresh()
+        return self._names
+
+    def get(self, class_id):
+        self.refresh()
+        for cls in self._classes:
+            if cls['id'] == class_id:
+                return cls
+        return None
+
+    def version_tag(self):
+        """Return the current version as a string, for optimistic concurrency checks by clients"""
+        self.refresh()
+        return version_tag(self._stamp)
+
+    # Mutators
+
+    def _update(self, change, expected_version):
+        """
+        Apply change(classes) -> (new classes, result) to the latest classes
+        and save them, under the file lock
+        """
+        with self._lock, file_lock(self.path):
+            self.refresh()
+            if expected_version is not None and expected_version != version_tag(self._stamp):
+                raise VersionConflict(f"{self.path} has changed since version {expected_version}")
+            classes, result = change(list(self._classes))
+            if classes is not None:
+                write_json_atomic(self.path, classes)
+                self._set_classes(classes, file_stamp(self.path))
+            return result
+
+    def add(self, name, expected_version=None):
+        """
+        Create a class and save the file
+
+        Returns:
+            The new class record
+
+        Raises:
+            VersionConflict: If expected_version is no longer current
+        """
+        def change(classes):
+            # Ids are based on the creation time, made unique if needed
+            taken = {cls['id'] for cls in classes}
+            number = int(time.time())
+            while f"class_{number}" in taken:
+                number += 1
+            new_class = {'id': f"class_{number}", 'name': name, 'created_at': datetime.now().isoformat()}
+            return classes + [new_class], new_class
+
+        return self._update(change, expected_version)
+
+    def remove(self, class_id, expected_version=None):
+        """
+        Delete a class and save the file
+
+        Returns:
+            The removed class record or None if no such class exists
+
+        Raises:
+            VersionConflict: If expected_version is no longer current
+        """
+        def change(classes):
+            for i, cls in enumerate(classes):
+                if cls['id'] == class_id:
+                    return classes[:i] + classes[i + 1:], cls
+            return None, None
+
+        return self._update(change, expected_version)
+
+
+def default_class():
+    return {"id": DEFAULT_CLASS_ID, "name": "Default Class", "created_at": datetime.now().isoformat()}